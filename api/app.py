@@ -1,5 +1,5 @@
 from flask import Flask, jsonify
-from prometheus_client import make_wsgi_app, Counter, Histogram, Gauge
+from prometheus_client import make_wsgi_app, Counter, Histogram, Gauge, REGISTRY
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
 import os
 import redis
@@ -7,6 +7,7 @@ import requests
 
 from middleware.rate_limiter import init_rate_limiter
 from config.config import Config
+from services.metrics import RedisMetricsCollector
 
 Config.validate()
 
@@ -18,6 +19,8 @@ EMAILS_PROCESSED = Counter('emails_processed_total', 'Total emails processed', [
 PROCESSING_TIME = Histogram('email_processing_seconds', 'Time spent processing emails')
 LLM_LATENCY = Histogram('llm_response_seconds', 'LLM generation latency')
 QUEUE_SIZE = Gauge('email_queue_size', 'Current size of the email queue')
+# Counters/summaries recorded by workers in Redis (caches, LLM calls, ...)
+REGISTRY.register(RedisMetricsCollector())
 
 # Add prometheus wsgi middleware to route /metrics requests
 app.wsgi_app = DispatcherMiddleware(app.wsgi_app, {
@@ -45,6 +45,7 @@ if page == "Dashboard":
         success_count = int(r.get('emails:status:Success:count') or 0)
         failed_count = int(r.get('emails:status:Failed:count') or 0)
         ignored_count = int(r.get('emails:status:Ignored:count') or 0)
+        needs_review_count = int(r.get('emails:status:NeedsReview:count') or 0)
         total_processed = success_count + failed_count + ignored_count
         
         success_rate = round((success_count / total_processed * 100), 1) if total_processed > 0 else 0
@@ -83,8 +84,8 @@ if page == "Dashboard":
 
     with chart_col2:
         df_status = pd.DataFrame({
-            'Status': ['Success', 'Failed', 'Ignored'],
-            'Count': [success_count, failed_count, ignored_count]
+            'Status': ['Success', 'Failed', 'Ignored', 'Needs Review'],
+            'Count': [success_count, failed_count, ignored_count, needs_review_count]
         })
         fig_pie = px.pie(df_status, values='Count', names='Status', title='Processing Status')
         st.plotly_chart(fig_pie, use_container_width=True)
@@ -0,0 +1,108 @@
+import os
+import signal
+import sys
+import time
+from redis import Redis
+from rq import Queue
+from services.gmail_service import get_emails_by_ids, get_gmail_service, list_message_ids
+from services.inbox_sync import InboxSync
+from services.dedup import MessageClaims
+from services.leader_election import LeaderElection
+from utils.logger import get_logger
+from dotenv import load_dotenv
+
+from config.config import Config
+
+load_dotenv()
+Config.validate()
+logger = get_logger(__name__)
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+CHECK_INTERVAL = int(os.getenv('CHECK_INTERVAL_MINUTES', 5)) * 60
+# 'history' transfers only new mail since the last poll; 'poll' re-lists is:unread every time
+GMAIL_SYNC_MODE = os.getenv('GMAIL_SYNC_MODE', 'history')
+# A standby producer takes over at most this many seconds after the leader dies
+LEADER_TTL = int(os.getenv('PRODUCER_LEADER_TTL_SECONDS', 15))
+LEADER_KEY = 'producer:leader'
+# 'sync' enqueues one job per email; 'async' enqueues batches that a worker
+# processes concurrently (services/async_processor.py)
+PIPELINE_MODE = os.getenv('PIPELINE_MODE', 'sync')
+ASYNC_BATCH_SIZE = int(os.getenv('ASYNC_BATCH_SIZE', 16))
+
+def fetch_and_queue_emails(gmail_service, inbox_sync, claims, q):
+    """
+    One poll: fetch new emails from Gmail and push them to the 'emails' queue.
+    """
+    logger.info("checking_new_emails")
+    # Bodies are downloaded only for messages not already queued or handled
+    if GMAIL_SYNC_MODE == 'history':
+        emails, history_id = inbox_sync.fetch_changes(id_filter=claims.unclaimed)
+    else:
+        message_ids = claims.unclaimed(list_message_ids(gmail_service, query='is:unread'))
+        emails = get_emails_by_ids(gmail_service, message_ids) if message_ids else []
+        history_id = None
+    new_emails = []
+    for email in emails:
+        # Skip messages already queued/handled by this or another fetcher
+        if claims.claim_for_enqueue(email.id):
+            new_emails.append(email)
+        else:
+            logger.info("skipped_duplicate_email", email_id=email.id)
+
+    if PIPELINE_MODE == 'async':
+        batches = [new_emails[i:i + ASYNC_BATCH_SIZE] for i in range(0, len(new_emails), ASYNC_BATCH_SIZE)]
+        jobs = [('services.async_processor.process_email_batch', batch, batch) for batch in batches]
+    else:
+        jobs = [('services.email_processor.process_email', email, [email]) for email in new_emails]
+
+    for position, (func, payload, job_emails) in enumerate(jobs):
+        # Note: Pickling complex objects like EmailMessage is fine with RQ
+        try:
+            q.enqueue(func, payload)
+        except Exception:
+            # Let the next poll pick up whatever was not enqueued
+            for _, _, pending in jobs[position:]:
+                for email in pending:
+                    claims.release_enqueue(email.id)
+            raise
+        for email in job_emails:
+            logger.info("enqueued_email", email_id=email.id)
+    if history_id is not None:
+        # Advance the checkpoint only after everything is enqueued
+        inbox_sync.commit(history_id)
+
+def run_producer():
+    """
+    Polls Gmail while this process holds the cluster-wide producer lease.
+    Run several replicas for failover: only the leader talks to the Gmail API.
+    """
+    redis_conn = Redis.from_url(REDIS_URL)
+    q = Queue('emails', connection=redis_conn)
+    gmail_service = get_gmail_service()
+    inbox_sync = InboxSync(gmail_service, redis_conn)
+    claims = MessageClaims(redis_conn)
+
+    election = LeaderElection(redis_conn, LEADER_KEY, ttl=LEADER_TTL)
+    election.start()
+
+    def shutdown(signum, frame):
+        election.stop()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    logger.info("starting_email_producer", sync_mode=GMAIL_SYNC_MODE, identity=election.identity)
+    while True:
+        election.wait_for_leadership()
+        try:
+            fetch_and_queue_emails(gmail_service, inbox_sync, claims, q)
+        except Exception as e:
+            logger.error("fetcher_error", error=str(e))
+
+        # Sleep until the next poll, but react quickly if leadership is lost
+        next_poll = time.time() + CHECK_INTERVAL
+        while time.time() < next_poll and election.is_leader:
+            time.sleep(1)
+
+if __name__ == '__main__':
+    run_producer()
@@ -0,0 +1,96 @@
+"""
+Compares the ANN index types the index builder supports against the exact
+(flat) baseline: build time, recall@k and single-query search latency.
+
+Vectors are synthetic and clustered (real embeddings cluster by topic, which
+is what IVF relies on), unit-normalized like all-minilm output:
+    python scripts/benchmark_ann.py --vectors 200000 --dim 384
+    python scripts/benchmark_ann.py --types hnsw ivf_pq --metric ip
+
+Search parameters come from the same RAG_* settings the builder uses
+(RAG_HNSW_EF_SEARCH, RAG_IVF_NPROBE, ...), so they can be tuned here first.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import faiss
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from services.index_builder import make_index  # noqa: E402
+
+
+def make_vectors(n, dim, clusters, seed, latent_dim=32):
+    # Sentence embeddings have a much lower intrinsic dimension than their size:
+    # sample a clustered latent space and project it into dim dimensions.
+    structure = np.random.default_rng(0)
+    centers = 3.0 * structure.standard_normal((clusters, latent_dim)).astype(np.float32)
+    projection = structure.standard_normal((latent_dim, dim)).astype(np.float32)
+    rng = np.random.default_rng(seed)
+    latent = centers[rng.integers(0, clusters, n)] + rng.standard_normal((n, latent_dim)).astype(np.float32)
+    vectors = latent @ projection + 0.1 * rng.standard_normal((n, dim)).astype(np.float32)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def build(index_type, metric, vectors):
+    start = time.perf_counter()
+    index = make_index(index_type, metric, vectors)
+    index.add_with_ids(vectors, np.arange(len(vectors), dtype=np.int64))
+    return index, time.perf_counter() - start
+
+
+def search_one_by_one(index, queries, k):
+    # Workers search one email at a time, so latency is measured per query
+    timings = []
+    found = []
+    for query in queries:
+        start = time.perf_counter()
+        _, ids = index.search(query.reshape(1, -1), k)
+        timings.append(time.perf_counter() - start)
+        found.append(ids[0])
+    return np.array(found), timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--vectors', type=int, default=200000, help='Knowledge-base size')
+    parser.add_argument('--dim', type=int, default=384, help='Embedding dimension (all-minilm: 384)')
+    parser.add_argument('--clusters', type=int, default=200, help='Topics in the synthetic data')
+    parser.add_argument('--queries', type=int, default=500, help='Number of queries')
+    parser.add_argument('--k', type=int, default=10, help='Neighbours per query for recall@k')
+    parser.add_argument('--metric', choices=['l2', 'ip'], default='l2')
+    parser.add_argument('--types', nargs='+', default=['hnsw', 'ivf_flat', 'ivf_pq'],
+                        choices=['hnsw', 'ivf_flat', 'ivf_pq'], help='Index types to compare with flat')
+    parser.add_argument('--threads', type=int, default=1, help='FAISS threads (workers search single-threaded)')
+    args = parser.parse_args()
+
+    faiss.omp_set_num_threads(args.threads)
+    print(f"🧪 {args.vectors} vectors x {args.dim}d, {args.queries} queries, k={args.k}, metric={args.metric}")
+    vectors = make_vectors(args.vectors, args.dim, args.clusters, seed=0)
+    queries = make_vectors(args.queries, args.dim, args.clusters, seed=1)
+
+    baseline, build_time = build('flat', args.metric, vectors)
+    truth, timings = search_one_by_one(baseline, queries, args.k)
+    print(f"\n{'index':<10} {'build, s':>9} {'recall@k':>9} {'mean, ms':>9} {'p95, ms':>8} {'speedup':>8}")
+    flat_mean = statistics.mean(timings)
+
+    def report(name, build_time, found, timings):
+        recall = np.mean([len(set(f) & set(t)) / args.k for f, t in zip(found, truth)])
+        mean = statistics.mean(timings)
+        p95 = sorted(timings)[int(0.95 * (len(timings) - 1))]
+        print(f"{name:<10} {build_time:>9.2f} {recall:>9.3f} {mean * 1000:>9.3f} {p95 * 1000:>8.3f} {flat_mean / mean:>7.1f}x")
+
+    report('flat', build_time, truth, timings)
+    for index_type in args.types:
+        index, build_time = build(index_type, args.metric, vectors)
+        found, timings = search_one_by_one(index, queries, args.k)
+        report(index_type, build_time, found, timings)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Micro-benchmark: per-call requests.post vs the pooled OllamaClient session.
+
+Starts a local stub of the Ollama API (no model needed), sends the same
+embedding requests both ways and reports latency and TCP connections opened.
+
+    python scripts/benchmark_ollama_pool.py --calls 500
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from services.llm_service import OllamaClient  # noqa: E402
+
+connections = 0
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep-alive, like Ollama
+    disable_nagle_algorithm = True # Go's net/http (Ollama) sets TCP_NODELAY too
+
+    def setup(self):
+        global connections
+        super().setup()
+        connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = json.dumps({'embedding': [0.0] * 384}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def run(label, send, calls):
+    global connections
+    connections = 0
+    start = time.perf_counter()
+    for _ in range(calls):
+        send()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<28} {elapsed / calls * 1000:7.3f} ms/call  connections={connections}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ollama connection pooling micro-benchmark")
+    parser.add_argument("--calls", type=int, default=500)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/api"
+    payload = {"model": "all-minilm", "prompt": "Где мой заказ?"}
+
+    def unpooled():
+        response = requests.post(f"{base_url}/embeddings", headers={"Content-Type": "application/json"},
+                                 data=json.dumps(payload), timeout=30)
+        response.raise_for_status()
+        return response.json()
+
+    client = OllamaClient(base_url=base_url)
+
+    print(f"📊 {args.calls} embedding calls against a local stub server")
+    run("requests.post per call", unpooled, args.calls)
+    run("OllamaClient (pooled)", lambda: client.post("embeddings", payload, operation="embed"), args.calls)
+    server.shutdown()
@@ -0,0 +1,85 @@
+"""
+Benchmark: prompt prefill time per email, one-shot /api/generate prompts vs
+/api/chat with constant system prompts (prefix reuse).
+
+Sends the classify and the reply request for each sample email to a real
+Ollama (OLLAMA_HOST), in both request formats, and reports the prompt tokens
+evaluated and the prefill time (prompt_eval_duration) per email. Generation
+is capped at one token so only the prompt is measured.
+
+"generate" rebuilds the whole prompt text per email, as before the system
+prompts were split out; "chat" sends the constant system prompt plus the
+email, so Ollama only prefills the user message once the prefix is cached.
+
+Run from the project root:
+    python scripts/benchmark_prefill.py --emails 20
+    python scripts/benchmark_prefill.py --model gemma:7b
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from services.email_processor import OLLAMA_LLM_MODEL  # noqa: E402
+from services.llm_service import (  # noqa: E402
+    OllamaClient, _build_classify_request, _build_generate_request
+)
+
+SAMPLE_EMAILS = [
+    "Где мой заказ #48213? Оформила неделю назад.",
+    "Как вернуть куртку, если не подошел размер?",
+    "Можно ли оплатить заказ при получении?",
+    "Какие сроки доставки в Новосибирск?",
+    "Не могу войти в личный кабинет, пишет неверный пароль.",
+    "Есть ли в наличии платье из новой коллекции в размере M?",
+]
+SAMPLE_CONTEXT = ("Вопрос: Как отследить заказ?\nОтвет: Статус заказа доступен в личном кабинете "
+                  "в разделе «Мои заказы».\n\nВопрос: Сроки доставки?\nОтвет: От 2 до 7 рабочих дней.")
+
+
+def as_generate(chat_request):
+    """
+    The same request as one /api/generate prompt, without keep_alive.
+    """
+    prompt = "\n".join(message["content"] for message in chat_request["messages"])
+    return {"model": chat_request["model"], "prompt": prompt, "stream": False,
+            "options": dict(chat_request["options"], num_predict=1)}
+
+
+def as_chat(chat_request):
+    return dict(chat_request, options=dict(chat_request["options"], num_predict=1))
+
+
+def run(label, client, endpoint, convert, model, emails):
+    tokens = prefill_ns = 0
+    start = time.perf_counter()
+    for email in emails:
+        for request in (_build_classify_request(email, model), _build_generate_request(email, SAMPLE_CONTEXT, model)):
+            result = client.post(endpoint, convert(request), operation="generate")
+            tokens += result.get("prompt_eval_count", 0)
+            prefill_ns += result.get("prompt_eval_duration", 0)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<10} prompt tokens/email {tokens / len(emails):7.1f}  "
+          f"prefill {prefill_ns / 1e6 / len(emails):8.1f} ms/email  total {elapsed / len(emails) * 1000:8.1f} ms/email")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', default=OLLAMA_LLM_MODEL, help='Ollama LLM model')
+    parser.add_argument('--emails', type=int, default=12, help='Number of emails per format')
+    args = parser.parse_args()
+
+    emails = [SAMPLE_EMAILS[i % len(SAMPLE_EMAILS)] + f" ({i})" for i in range(args.emails)]
+    client = OllamaClient()
+    print(f"🔥 Loading {args.model}...")
+    client.post("chat", as_chat(_build_classify_request("warm-up", args.model)), operation="generate")
+
+    print(f"📊 {args.emails} emails, classify + reply prompt each")
+    run("generate", client, "generate", as_generate, args.model, emails)
+    run("chat", client, "chat", as_chat, args.model, emails)
+
+
+if __name__ == '__main__':
+    main()
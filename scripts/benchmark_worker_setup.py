@@ -0,0 +1,51 @@
+"""
+Measures per-job setup time of the email worker.
+
+Before: every RQ job ran 'services.email_processor.EmailProcessor().process_email',
+so each job rebuilt the Gmail client and reloaded the FAISS index and documents.
+After: jobs call 'services.email_processor.process_email', which reuses the
+processor warmed up at worker start.
+
+Run from the project root with the same token.pickle / embeddings the worker uses:
+    python scripts/benchmark_worker_setup.py --jobs 20
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from services import email_processor  # noqa: E402
+
+
+def time_setup(make_processor, jobs):
+    timings = []
+    for _ in range(jobs):
+        start = time.perf_counter()
+        make_processor()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def report(label, timings):
+    print(f"{label:<28} mean={statistics.mean(timings) * 1000:9.2f} ms  "
+          f"p95={sorted(timings)[int(len(timings) * 0.95) - 1] * 1000:9.2f} ms  "
+          f"total={sum(timings):7.2f} s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-job setup time: fresh vs warm EmailProcessor")
+    parser.add_argument("--jobs", type=int, default=20, help="Number of simulated jobs")
+    args = parser.parse_args()
+
+    print(f"📊 Simulating setup for {args.jobs} jobs...")
+    before = time_setup(email_processor.EmailProcessor, args.jobs)
+
+    email_processor.warm_up()
+    after = time_setup(email_processor.get_processor, args.jobs)
+
+    report("Before (processor per job)", before)
+    report("After (warm processor)", after)
+    print(f"✅ Setup time saved per job: {(statistics.mean(before) - statistics.mean(after)) * 1000:.2f} ms")
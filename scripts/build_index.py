@@ -0,0 +1,44 @@
+"""
+Builds or incrementally updates the knowledge-base FAISS index.
+
+Only knowledge_base/*.md files whose content changed since the last build are
+re-embedded; deleted files are removed from the index. The new version is
+published atomically through embeddings/manifest.json; running workers pick
+it up between jobs. In production embeddings/ is a volume shared by all
+workers (k8s/index-build-job.yml, the index-builder compose service).
+
+Run from the project root (Ollama must be reachable at OLLAMA_HOST):
+    python scripts/build_index.py
+    python scripts/build_index.py --full   # ignore the previous build
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from services.email_processor import EMBEDDINGS_DIR, OLLAMA_EMBEDDING_MODEL  # noqa: E402
+from services.index_builder import build_index  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--kb-dir', default='knowledge_base', help='Directory with *.md knowledge-base files')
+    parser.add_argument('--out', default=EMBEDDINGS_DIR, help='Directory for the index, documents and manifest')
+    parser.add_argument('--model', default=OLLAMA_EMBEDDING_MODEL, help='Ollama embedding model')
+    parser.add_argument('--full', action='store_true', help='Re-embed every file instead of only changed ones')
+    args = parser.parse_args()
+
+    print(f"🔨 Building index from {args.kb_dir} with {args.model}...")
+    start = time.perf_counter()
+    manifest = build_index(args.kb_dir, args.model, args.out, force=args.full)
+    if manifest is None:
+        print("❌ Index build failed, the previous version is still active")
+        sys.exit(1)
+    print(f"✅ Index version {manifest['version']}: {len(manifest['files'])} documents "
+          f"in {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -31,7 +31,7 @@ def simulate_email(sender, subject, body):
     q = Queue('emails', connection=r)
     
     # We need to enqueue the function call
-    q.enqueue('services.email_processor.EmailProcessor().process_email', email_obj)
+    q.enqueue('services.email_processor.process_email', email_obj)
     
     print(f"✅ Simulated email sent!")
     print(f"From: {sender}")
@@ -0,0 +1,73 @@
+"""
+Trains the pre-classifier's linear model from logged LLM relevance decisions.
+
+Every email escalated to the LLM classifier is logged to Redis
+(preclassifier:samples) as its hashed features and the LLM decision. This script holds out a share of them, reports how
+many held-out emails the model would decide on its own at the configured
+thresholds and how accurate those decisions are, then saves the model to
+PRECLASSIFIER_MODEL_PATH. Workers load it on startup.
+
+Run from the project root:
+    python scripts/train_preclassifier.py
+    python scripts/train_preclassifier.py --dry-run   # evaluate only
+"""
+import argparse
+import json
+import os
+import random
+import sys
+
+import redis
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from services.pre_classifier import (  # noqa: E402
+    PRECLASSIFIER_HIGH, PRECLASSIFIER_LOW, PRECLASSIFIER_MODEL_PATH, REDIS_URL, SAMPLES_KEY, sample_features,
+    train_linear_model,
+)
+
+
+def evaluate(model, samples, high, low):
+    decided = correct = 0
+    for sample in samples:
+        probability = model.feature_probability(sample_features(sample))
+        if low < probability < high:
+            continue
+        decided += 1
+        correct += (probability >= high) == sample['relevant']
+    return decided, correct
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', default=PRECLASSIFIER_MODEL_PATH, help='Where to save the model')
+    parser.add_argument('--holdout', type=float, default=0.2, help='Share of samples used for evaluation')
+    parser.add_argument('--min-samples', type=int, default=200, help='Refuse to train on fewer samples')
+    parser.add_argument('--dry-run', action='store_true', help='Evaluate without saving the model')
+    args = parser.parse_args()
+
+    samples = [json.loads(raw) for raw in redis.from_url(REDIS_URL).lrange(SAMPLES_KEY, 0, -1)]
+    if len(samples) < args.min_samples:
+        print(f"❌ Only {len(samples)} samples logged, need at least {args.min_samples}")
+        sys.exit(1)
+    relevant = sum(sample['relevant'] for sample in samples)
+    print(f"📥 {len(samples)} samples ({relevant} relevant, {len(samples) - relevant} irrelevant)")
+
+    random.Random(0).shuffle(samples)
+    split = int(len(samples) * (1 - args.holdout))
+    train, holdout = samples[:split], samples[split:]
+    model = train_linear_model(train)
+    decided, correct = evaluate(model, holdout, PRECLASSIFIER_HIGH, PRECLASSIFIER_LOW)
+    print(f"📊 Held out {len(holdout)}: decided without the LLM {decided} ({decided / max(len(holdout), 1):.0%}), "
+          f"accuracy on those {correct / max(decided, 1):.1%}")
+
+    if args.dry_run:
+        return
+    model = train_linear_model(samples)
+    model.save(args.out, samples=len(samples), holdout_coverage=decided / max(len(holdout), 1),
+               holdout_accuracy=correct / max(decided, 1))
+    print(f"✅ Model saved to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Trains the embedding relevance head used with RELEVANCE_MODE=embedding.
+
+Emails the head could not decide are classified by the LLM, and each such
+decision is logged to Redis (relevance:samples) with the email embedding and
+its distance to the nearest knowledge-base document. This script holds out
+a share of them, reports how many held-out emails the head would decide
+without the LLM at the configured thresholds and how accurate those
+decisions are, then saves the head to RELEVANCE_HEAD_PATH. Workers load it
+on startup.
+
+Run from the project root:
+    python scripts/train_relevance_head.py
+    python scripts/train_relevance_head.py --dry-run   # evaluate only
+"""
+import argparse
+import json
+import os
+import random
+import sys
+
+import redis
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from services.email_processor import OLLAMA_EMBEDDING_MODEL  # noqa: E402
+from services.relevance_head import (  # noqa: E402
+    RELEVANCE_HEAD_PATH, RELEVANCE_HIGH, RELEVANCE_LOW, REDIS_URL, SAMPLES_KEY, _decode, train_relevance_head,
+)
+
+
+def evaluate(head, samples, high, low):
+    decided = correct = 0
+    for sample in samples:
+        probability = head.probability(_decode(sample['vector']), sample['distance'])
+        if low < probability < high:
+            continue
+        decided += 1
+        correct += (probability >= high) == sample['relevant']
+    return decided, correct
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', default=RELEVANCE_HEAD_PATH, help='Where to save the head')
+    parser.add_argument('--model', default=OLLAMA_EMBEDDING_MODEL, help='Embedding model the samples come from')
+    parser.add_argument('--holdout', type=float, default=0.2, help='Share of samples used for evaluation')
+    parser.add_argument('--min-samples', type=int, default=200, help='Refuse to train on fewer samples')
+    parser.add_argument('--dry-run', action='store_true', help='Evaluate without saving the head')
+    args = parser.parse_args()
+
+    samples = [json.loads(raw) for raw in redis.from_url(REDIS_URL).lrange(SAMPLES_KEY, 0, -1)]
+    # Samples from a previous embedding model have another dimension
+    dimension = len(_decode(samples[0]['vector'])) if samples else 0
+    samples = [sample for sample in samples if len(_decode(sample['vector'])) == dimension]
+    if len(samples) < args.min_samples:
+        print(f"❌ Only {len(samples)} samples logged, need at least {args.min_samples}")
+        sys.exit(1)
+    relevant = sum(sample['relevant'] for sample in samples)
+    print(f"📥 {len(samples)} samples of dimension {dimension} ({relevant} relevant, {len(samples) - relevant} irrelevant)")
+
+    random.Random(0).shuffle(samples)
+    split = int(len(samples) * (1 - args.holdout))
+    train, holdout = samples[:split], samples[split:]
+    head = train_relevance_head(train, args.model)
+    decided, correct = evaluate(head, holdout, RELEVANCE_HIGH, RELEVANCE_LOW)
+    print(f"📊 Held out {len(holdout)}: decided without the LLM {decided} ({decided / max(len(holdout), 1):.0%}), "
+          f"accuracy on those {correct / max(decided, 1):.1%}")
+
+    if args.dry_run:
+        return
+    head = train_relevance_head(samples, args.model)
+    head.save(args.out, samples=len(samples), holdout_coverage=decided / max(len(holdout), 1),
+              holdout_accuracy=correct / max(decided, 1))
+    print(f"✅ Relevance head saved to {args.out}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+import asyncio
+import os
+import threading
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from tenacity import retry, stop_after_attempt, wait_exponential
+from services.email_processor import (
+    get_processor, EmailJob, OLLAMA_CLASSIFY_FALLBACK_MODEL, OLLAMA_CLASSIFY_MODEL, OLLAMA_EMBEDDING_MODEL,
+    OLLAMA_GENERATE_MODEL
+)
+from services.gmail_service import send_email_reply, mark_email_as_read
+from services.llm_service import (
+    AsyncOllamaClient, classify_email_async, generate_response_ollama_async, get_embeddings_ollama_async
+)
+from services.rag_service import RAG_MAX_DISTANCE, RAG_TOP_K, retrieve_documents_batch
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# Emails processed concurrently by one worker process, and per-stage limits so
+# a burst cannot queue more requests on Ollama than it can usefully run.
+ASYNC_MAX_IN_FLIGHT = int(os.getenv('ASYNC_MAX_IN_FLIGHT', 8))
+STAGE_CONCURRENCY = {
+    'classify': int(os.getenv('ASYNC_CLASSIFY_CONCURRENCY', 4)),
+    'embed': int(os.getenv('ASYNC_EMBED_CONCURRENCY', 8)),
+    'generate': int(os.getenv('ASYNC_GENERATE_CONCURRENCY', 4)),
+}
+# Concurrent emails are embedded together: a batch is sent when it reaches
+# EMBED_BATCH_MAX texts or EMBED_BATCH_WINDOW_MS after its first text arrived.
+EMBED_BATCH_MAX = int(os.getenv('EMBED_BATCH_MAX', 32))
+EMBED_BATCH_WINDOW = float(os.getenv('EMBED_BATCH_WINDOW_MS', 20)) / 1000
+# Knowledge-base searches are batched the same way into one FAISS call; embeddings
+# of a batch resolve together, so a short window is enough to collect them.
+SEARCH_BATCH_MAX = int(os.getenv('SEARCH_BATCH_MAX', 64))
+SEARCH_BATCH_WINDOW = float(os.getenv('SEARCH_BATCH_WINDOW_MS', 2)) / 1000
+
+class MicroBatcher(ABC):
+    """
+    Collects items submitted by concurrent coroutines and hands them to
+    _send(batch) as one batch of (item, future) pairs: when max_batch items
+    are pending or window seconds after the first one arrived.
+    """
+
+    def __init__(self, max_batch, window):
+        self.max_batch = max_batch
+        self.window = window
+        self.pending = []
+        self._timer = None
+        # The event loop only keeps weak references to tasks
+        self._tasks = set()
+
+    async def _submit(self, item):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((item, future))
+        if len(self.pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.ensure_future(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    @abstractmethod
+    async def _send(self, batch):
+        """
+        Resolves the future of every (item, future) pair in batch.
+        """
+
+class EmbeddingBatcher(MicroBatcher):
+    """
+    Micro-batches embedding requests from concurrent coroutines into single
+    /api/embed calls. embed(text) resolves to the vector or None on failure.
+    """
+
+    def __init__(self, client, model, semaphore, max_batch=EMBED_BATCH_MAX, window=EMBED_BATCH_WINDOW):
+        super().__init__(max_batch, window)
+        self.client = client
+        self.model = model
+        self.semaphore = semaphore
+
+    async def embed(self, text):
+        return await self._submit(text)
+
+    async def _send(self, batch):
+        try:
+            async with self.semaphore:
+                vectors = await get_embeddings_ollama_async(self.client, [text for text, _ in batch], self.model)
+            logger.info("embedding_batch_sent", size=len(batch))
+        except Exception as e:
+            logger.error("embedding_batch_failed", size=len(batch), error=str(e))
+            vectors = None
+        for position, (_, future) in enumerate(batch):
+            if not future.done():
+                future.set_result(None if vectors is None else vectors[position].tolist())
+
+class SearchBatcher(MicroBatcher):
+    """
+    Micro-batches knowledge-base searches from concurrent coroutines into one
+    retrieve_documents_batch call per KnowledgeBase snapshot: one FAISS search
+    over an (n, d) matrix and one retrieval-cache round trip.
+    search(knowledge_base, vector) resolves to the matches for that vector.
+    """
+
+    def __init__(self, max_batch=SEARCH_BATCH_MAX, window=SEARCH_BATCH_WINDOW):
+        super().__init__(max_batch, window)
+
+    async def search(self, knowledge_base, vector):
+        return await self._submit((knowledge_base, vector))
+
+    async def _send(self, batch):
+        # A reload between jobs can leave searches for two snapshots in one window
+        groups = {}
+        for (knowledge_base, vector), future in batch:
+            groups.setdefault(id(knowledge_base), (knowledge_base, []))[1].append((vector, future))
+
+        loop = asyncio.get_running_loop()
+        for knowledge_base, items in groups.values():
+            query_matrix = np.array([vector for vector, _ in items], dtype=np.float32)
+            try:
+                # FAISS releases the GIL; keep the event loop free while it scans
+                results = await loop.run_in_executor(
+                    None, retrieve_documents_batch, knowledge_base.faiss_index, query_matrix,
+                    knowledge_base.documents, RAG_TOP_K, RAG_MAX_DISTANCE, knowledge_base.version
+                )
+            except Exception as e:
+                logger.error("search_batch_failed", size=len(items), error=str(e))
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            logger.info("search_batch_done", size=len(items))
+            for (_, future), matches in zip(items, results):
+                if not future.done():
+                    future.set_result(matches)
+
+class AsyncEmailProcessor:
+    """
+    asyncio version of EmailProcessor.process_email: keeps up to
+    ASYNC_MAX_IN_FLIGHT emails in flight, with a semaphore per Ollama stage.
+    Reuses the warm EmailProcessor for the Gmail client, knowledge base,
+    dedup claims and dashboard tracking, and EmailJob for the decisions.
+    Redis is blocking (redis-py), so every EmailJob step that touches it runs
+    in the default executor instead of the event loop.
+    """
+
+    def __init__(self, processor, client):
+        self.processor = processor
+        self.client = client
+        self.in_flight = asyncio.Semaphore(ASYNC_MAX_IN_FLIGHT)
+        self.stages = {stage: asyncio.Semaphore(limit) for stage, limit in STAGE_CONCURRENCY.items()}
+        self.embedder = EmbeddingBatcher(client, OLLAMA_EMBEDDING_MODEL, self.stages['embed'])
+        self.searcher = SearchBatcher()
+        # The Gmail discovery client (httplib2) is not thread-safe, so Gmail
+        # calls are serialized on one thread; they are cheap next to the LLM calls.
+        self.gmail_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gmail')
+
+    async def process_batch(self, emails):
+        """
+        Processes the emails concurrently. Raises if any of them failed, so RQ
+        records the job as failed; emails already handled are skipped when the
+        batch is retried.
+        """
+        # Between jobs: a newly published index applies to the whole batch
+        await self._blocking(self.processor.refresh_knowledge_base)
+        results = await asyncio.gather(*(self.process_email(email) for email in emails), return_exceptions=True)
+        failed = [email.id for email, result in zip(emails, results) if isinstance(result, Exception)]
+        logger.info("batch_processed", emails=len(emails), failed=len(failed))
+        if failed:
+            raise RuntimeError(f"{len(failed)} of {len(emails)} emails failed: {', '.join(failed)}")
+
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(min=4, max=10))
+    async def process_email(self, email_data):
+        async with self.in_flight:
+            await self._process_email(email_data)
+
+    async def _process_email(self, email_data):
+        logger.info("processing_email", email_id=email_data.id, sender=email_data.sender, mode="async")
+        job = EmailJob(self.processor, email_data, self.processor.knowledge_base)
+        if not await self._blocking(job.begin):
+            return
+
+        try:
+            await self._process(job)
+        except Exception as e:
+            await self._blocking(job.fail, e)
+            raise e # Retry will catch this
+
+    async def _process(self, job):
+        email = job.email
+        if job.reply_sent:
+            # An earlier attempt sent the reply and failed afterwards
+            await self._gmail(mark_email_as_read, email.id)
+            await self._blocking(job.replied)
+            return
+
+        # 1. Classify: local pre-classifier first, then (RELEVANCE_MODE=embedding) the email
+        # embedding, the LLM only for emails neither can decide
+        decision = job.pre_classify()
+        if job.wants_embedding_relevance(decision):
+            embedding = await self.embedder.embed(email.text)
+            if embedding:
+                decision = job.decide_from_embedding(embedding, await self.searcher.search(job.knowledge_base, embedding))
+        classification = None
+        if decision.escalate:
+            async with self.stages['classify']:
+                classification = await classify_email_async(
+                    self.client, email.text, model=OLLAMA_CLASSIFY_MODEL, fallback_model=OLLAMA_CLASSIFY_FALLBACK_MODEL
+                )
+        is_relevant = await self._blocking(job.relevance, decision, classification)
+        if is_relevant is None:
+            await self._blocking(job.finish, "NeedsReview")
+            return
+        if not is_relevant:
+            await self._gmail(mark_email_as_read, email.id)
+            await self._blocking(job.finish, "Ignored")
+            return
+
+        # 2. RAG Search: a decisive keyword match needs no embedding call
+        matches = job.lexical_matches()
+        if matches is None:
+            if job.vector_matches is None:
+                embedding = await self.embedder.embed(email.text)
+                if not embedding:
+                    await self._blocking(job.abort, "embedding_failed")
+                    return
+                job.use_vector_matches(embedding, await self.searcher.search(job.knowledge_base, embedding))
+            matches = job.hybrid_matches()
+
+        # 3. Generate Response
+        context, answer = await self._blocking(job.cached_answer, matches)
+        if answer is None:
+            async with self.stages['generate']:
+                answer = await generate_response_ollama_async(self.client, email.text, context,
+                                                              model=OLLAMA_GENERATE_MODEL)
+            await self._blocking(job.store_answer, context, answer)
+
+        # 4. Send Reply
+        if not answer:
+            await self._blocking(job.abort, "empty_answer")
+            return
+        if not await self._gmail(send_email_reply, email.id, email.sender, email.subject, answer, email.thread_id):
+            raise RuntimeError("sending the reply failed") # Not recorded as sent: the retry sends it
+        await self._blocking(job.sent)
+        await self._gmail(mark_email_as_read, email.id)
+        await self._blocking(job.replied)
+
+    @staticmethod
+    async def _blocking(func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def _gmail(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.gmail_executor, func, self.processor.gmail_service, *args)
+
+
+# One event loop per worker process, running in a background thread, so the
+# async Ollama connection pool survives across RQ jobs.
+_loop = None
+_loop_lock = threading.Lock()
+_async_processor = None
+
+
+def _get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, daemon=True, name='async-processor').start()
+    return _loop
+
+
+async def _process_batch(emails):
+    global _async_processor
+    if _async_processor is None:
+        _async_processor = AsyncEmailProcessor(get_processor(), AsyncOllamaClient())
+    return await _async_processor.process_batch(emails)
+
+
+def process_email_batch(emails):
+    """
+    RQ job entry point for the async pipeline: processes a batch of emails
+    concurrently in this worker process.
+    """
+    return asyncio.run_coroutine_threadsafe(_process_batch(emails), _get_loop()).result()
@@ -0,0 +1,133 @@
+import os
+import uuid
+from redis.exceptions import WatchError
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+# queued:   set by the producer, blocks re-enqueueing the same message while it waits in the queue
+# inflight: held by the worker processing the message, must outlive the RQ job timeout
+# replied:  set as soon as the reply is sent, so a retry after a later failure does not send it again
+# done:     set once the message is handled, so late duplicates are dropped by the worker
+QUEUED_TTL = int(os.getenv('DEDUP_QUEUED_TTL_SECONDS', 24 * 3600))
+INFLIGHT_TTL = int(os.getenv('DEDUP_INFLIGHT_TTL_SECONDS', 600))
+DONE_TTL = int(os.getenv('DEDUP_DONE_TTL_SECONDS', 7 * 24 * 3600))
+
+class MessageClaims:
+    """
+    Redis-backed claims keyed on Gmail message ID, so each email is enqueued
+    and processed once even with several fetchers and workers.
+    Redis errors fail open: a duplicate reply is better than a lost email.
+    """
+
+    def __init__(self, redis_conn):
+        self.redis = redis_conn
+        self.owner = uuid.uuid4().hex
+
+    def claim_for_enqueue(self, message_id):
+        """
+        Returns True if the caller should enqueue the message.
+        """
+        try:
+            if self.redis.exists(self._key('done', message_id)):
+                return False
+            return bool(self.redis.set(self._key('queued', message_id), self.owner, nx=True, ex=QUEUED_TTL))
+        except Exception as e:
+            logger.error("dedup_claim_failed", email_id=message_id, error=str(e))
+            return True
+
+    def unclaimed(self, message_ids):
+        """
+        Returns the message_ids that are neither queued nor done, in order, so
+        the producer downloads only bodies it may enqueue. On Redis errors all
+        IDs are returned; claim_for_enqueue still decides.
+        """
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for message_id in message_ids:
+                pipe.exists(self._key('queued', message_id), self._key('done', message_id))
+            return [message_id for message_id, claimed in zip(message_ids, pipe.execute()) if not claimed]
+        except Exception as e:
+            logger.error("dedup_unclaimed_failed", error=str(e))
+            return list(message_ids)
+
+    def release_enqueue(self, message_id):
+        """
+        Drops the queued claim, e.g. when enqueueing failed.
+        """
+        try:
+            self.redis.delete(self._key('queued', message_id))
+        except Exception as e:
+            logger.error("dedup_release_failed", email_id=message_id, error=str(e))
+
+    def begin(self, message_id):
+        """
+        Returns True if this worker may process the message now; False if it
+        is already done or another worker has it in flight.
+        """
+        try:
+            if self.redis.exists(self._key('done', message_id)):
+                return False
+            return bool(self.redis.set(self._key('inflight', message_id), self.owner, nx=True, ex=INFLIGHT_TTL))
+        except Exception as e:
+            logger.error("dedup_begin_failed", email_id=message_id, error=str(e))
+            return True
+
+    def mark_replied(self, message_id):
+        """
+        Records that the reply was sent; call right after sending it.
+        """
+        try:
+            self.redis.set(self._key('replied', message_id), 1, ex=DONE_TTL)
+        except Exception as e:
+            logger.error("dedup_mark_replied_failed", email_id=message_id, error=str(e))
+
+    def replied(self, message_id):
+        """
+        True if an earlier attempt already sent the reply.
+        """
+        try:
+            return bool(self.redis.exists(self._key('replied', message_id)))
+        except Exception as e:
+            logger.error("dedup_replied_check_failed", email_id=message_id, error=str(e))
+            return False
+
+    def complete(self, message_id):
+        """
+        Marks the message as handled and releases the in-flight claim.
+        """
+        try:
+            pipe = self.redis.pipeline()
+            pipe.set(self._key('done', message_id), 1, ex=DONE_TTL)
+            pipe.delete(self._key('queued', message_id))
+            pipe.delete(self._key('replied', message_id))
+            pipe.execute()
+            self.abort(message_id)
+        except Exception as e:
+            logger.error("dedup_complete_failed", email_id=message_id, error=str(e))
+
+    def abort(self, message_id):
+        """
+        Releases the in-flight claim so a retry can pick the message up again,
+        and the queued claim so the next poll can re-enqueue it once RQ gives up.
+        """
+        key = self._key('inflight', message_id)
+        self.release_enqueue(message_id)
+        try:
+            # Delete only if we still own it: it may have expired and been re-claimed
+            with self.redis.pipeline() as pipe:
+                pipe.watch(key)
+                if pipe.get(key) == self.owner.encode():
+                    pipe.multi()
+                    pipe.delete(key)
+                    pipe.execute()
+                else:
+                    pipe.unwatch()
+        except WatchError:
+            pass
+        except Exception as e:
+            logger.error("dedup_abort_failed", email_id=message_id, error=str(e))
+
+    @staticmethod
+    def _key(state, message_id):
+        return f'emails:dedup:{state}:{message_id}'
@@ -0,0 +1,89 @@
+import os
+import numpy as np
+from services.rag_service import KnowledgeDocument
+
+# File layout (little-endian):
+#   magic (8 bytes) | n (uint64) | ids int64[n], sorted | offsets int64[n * FIELDS + 1] | UTF-8 blob
+# offsets[i * FIELDS + f] is where field f of the i-th document starts in the blob.
+MAGIC = b'KBDOCS01'
+FIELDS = ('question', 'answer', 'keywords', 'source_file')
+HEADER_SIZE = len(MAGIC) + 8
+
+def write_document_store(path, documents):
+    """
+    Writes {doc_id: KnowledgeDocument} in the DocumentStore format.
+    """
+    ids = np.array(sorted(documents), dtype='<i8')
+    chunks = []
+    offsets = [0]
+    for doc_id in ids:
+        doc = documents[int(doc_id)]
+        for field in FIELDS:
+            chunk = getattr(doc, field).encode('utf-8')
+            chunks.append(chunk)
+            offsets.append(offsets[-1] + len(chunk))
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(np.array([len(ids)], dtype='<u8').tobytes())
+        f.write(ids.tobytes())
+        f.write(np.array(offsets, dtype='<i8').tobytes())
+        for chunk in chunks:
+            f.write(chunk)
+
+class DocumentStore:
+    """
+    Read-only {doc_id: KnowledgeDocument} mapping backed by one mmap'd file.
+
+    Worker processes on a node share the file's pages through the page
+    cache instead of each holding an unpickled copy. Documents are decoded
+    on access; only the matched ones ever are.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        data = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(data[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f'{path} is not a document store')
+        n = int(data[len(MAGIC):HEADER_SIZE].view('<u8')[0])
+        ids_end = HEADER_SIZE + 8 * n
+        offsets_end = ids_end + 8 * (n * len(FIELDS) + 1)
+        self.ids = data[HEADER_SIZE:ids_end].view('<i8')
+        self.offsets = data[ids_end:offsets_end].view('<i8')
+        self.blob = data[offsets_end:]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _position(self, doc_id):
+        position = int(np.searchsorted(self.ids, doc_id))
+        if position >= len(self.ids) or self.ids[position] != doc_id:
+            raise KeyError(doc_id)
+        return position
+
+    def __contains__(self, doc_id):
+        try:
+            self._position(doc_id)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, doc_id):
+        start = self._position(doc_id) * len(FIELDS)
+        values = [bytes(self.blob[self.offsets[start + i]:self.offsets[start + i + 1]]).decode('utf-8')
+                  for i in range(len(FIELDS))]
+        return KnowledgeDocument(*values)
+
+    def __iter__(self):
+        return (int(doc_id) for doc_id in self.ids)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return ((doc_id, self[doc_id]) for doc_id in self)
+
+def is_document_store(path):
+    if not os.path.exists(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
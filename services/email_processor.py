@@ -2,8 +2,15 @@
 import time
 from tenacity import retry, stop_after_attempt, wait_exponential
 from services.gmail_service import get_gmail_service, send_email_reply, mark_email_as_read
-from services.llm_service import classify_email, generate_response_ollama, get_embedding_ollama
-from services.rag_service import search_knowledge_base, load_faiss_index, load_indexed_documents
+from services.llm_service import GENERATION_ERROR_REPLY, Classification, classify_email, generate_response_ollama, get_embedding_ollama
+from services.rag_service import RAG_TOP_K, retrieve_documents, pack_context, load_faiss_index, load_indexed_documents, file_fingerprint
+from services.index_builder import MANIFEST_NAME, resolve_index_files
+from services.lexical_index import LexicalIndex, hybrid_matches
+from services.pre_classifier import get_pre_classifier
+from services.relevance_head import RELEVANCE_MODE, get_embedding_relevance
+from services.response_cache import get_response_cache
+from services.dedup import MessageClaims
+from services import metrics
 from utils.logger import get_logger
 import os
 from datetime import datetime
@@ -14,88 +21,345 @@ logger = get_logger(__name__)
 # Load configuration
 OLLAMA_LLM_MODEL = os.getenv("OLLAMA_LLM_MODEL", "gemma:7b")
 OLLAMA_EMBEDDING_MODEL = os.getenv("OLLAMA_EMBEDDING_MODEL", "all-minilm")
+# Per-task models. Classification is a cascade: the small OLLAMA_CLASSIFY_MODEL
+# answers first, OLLAMA_CLASSIFY_FALLBACK_MODEL only when that answer is neither
+# ДА nor НЕТ. Set both to the same model to disable the cascade.
+OLLAMA_CLASSIFY_MODEL = os.getenv("OLLAMA_CLASSIFY_MODEL") or "gemma:2b"
+OLLAMA_CLASSIFY_FALLBACK_MODEL = os.getenv("OLLAMA_CLASSIFY_FALLBACK_MODEL") or OLLAMA_LLM_MODEL
+OLLAMA_GENERATE_MODEL = os.getenv("OLLAMA_GENERATE_MODEL") or OLLAMA_LLM_MODEL
+EMBEDDINGS_DIR = "embeddings"
+# Legacy fixed paths, used until scripts/build_index.py has written a manifest
 FAISS_INDEX_PATH = "embeddings/knowledge_base.index"
 DOCUMENTS_PATH = "embeddings/documents.pkl"
+# How often a worker looks for a newly published index (manifest mtime), between jobs
+KB_RELOAD_CHECK_SECONDS = float(os.getenv("KB_RELOAD_CHECK_SECONDS", 10))
+NO_MATCH_REPLY = "Спасибо за ваше письмо. Мы получили ваш запрос и постараемся ответить на него как можно скорее."
+
+class KnowledgeBase:
+    """
+    One loaded index version: FAISS index, documents and version together.
+    Never mutated, only replaced as a whole, so a job that took a reference
+    keeps a consistent pair even if a reload happens meanwhile.
+    """
+
+    def __init__(self, faiss_index, documents, version, source_mtime=None, lexical=None):
+        self.faiss_index = faiss_index
+        self.documents = documents
+        # BM25 over question + keywords, built with the snapshot
+        self.lexical = lexical if lexical is not None else LexicalIndex(documents)
+        # Identifies the loaded index in shared search-cache keys
+        self.version = version
+        self.source_mtime = source_mtime
+
+def _kb_source_mtime():
+    """
+    mtime of the file that changes when a new index is published, or None.
+    """
+    for path in (os.path.join(EMBEDDINGS_DIR, MANIFEST_NAME), FAISS_INDEX_PATH):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+    return None
+
+class EmailJob:
+    """
+    One email going through the pipeline: its state and the decisions shared
+    by EmailProcessor.process_email and AsyncEmailProcessor. The caller makes
+    the Ollama, FAISS and Gmail calls; methods here do local work and Redis
+    round trips (claims, dashboard tracking, caches, training samples), so
+    async code runs the latter in an executor.
+    """
+
+    def __init__(self, processor, email_data, knowledge_base):
+        self.processor = processor
+        self.email = email_data
+        self.knowledge_base = knowledge_base
+        self.claims = processor._get_claims()
+        self.embedding = None
+        self.vector_matches = None
+        self.started = time.time()
+        self.reply_sent = False
+
+    def begin(self):
+        """
+        Claims the email; False if another worker holds or has finished it (duplicate enqueue).
+        reply_sent tells whether an earlier attempt already sent the reply.
+        """
+        if not self.claims.begin(self.email.id):
+            logger.info("email_already_claimed", email_id=self.email.id)
+            return False
+        self.started = time.time()
+        self.reply_sent = self.claims.replied(self.email.id)
+        self._track("Processing")
+        return True
+
+    def pre_classify(self):
+        return get_pre_classifier().classify(self.email)
+
+    def wants_embedding_relevance(self, decision):
+        return decision.escalate and RELEVANCE_MODE == 'embedding'
+
+    def use_vector_matches(self, embedding, vector_matches):
+        """
+        Keeps the email embedding and its knowledge-base matches for retrieval and the response cache.
+        """
+        self.embedding = embedding
+        self.vector_matches = vector_matches
+
+    def decide_from_embedding(self, embedding, vector_matches):
+        self.use_vector_matches(embedding, vector_matches)
+        return get_embedding_relevance(OLLAMA_EMBEDDING_MODEL).decide(embedding, vector_matches)
+
+    def relevance(self, decision, classification=None):
+        """
+        True/False, or None when the email is left for a person. classification
+        is the LLM answer for an escalated decision; an LLM decision is logged
+        as training data for the pre-classifier and the relevance head.
+        Raises if Ollama was unavailable, so the claim is released and the email retried.
+        """
+        email_id = self.email.id
+        if classification is None:
+            logger.info("pre_classified", email_id=email_id, relevant=decision.relevant, reason=decision.reason)
+            return decision.relevant
+        if classification.status == Classification.ERROR:
+            raise RuntimeError(f"classification failed, model {classification.model} unavailable")
+        if classification.status == Classification.NEEDS_REVIEW:
+            # Left unread in the inbox for a person instead of being dropped as irrelevant
+            logger.warning("email_needs_review", email_id=email_id, model=classification.model)
+            return None
+
+        is_relevant = classification.relevant
+        logger.info("email_classified", email_id=email_id, relevant=is_relevant,
+                    confidence=classification.confidence, model=classification.model)
+        get_pre_classifier().log_decision(self.email, is_relevant)
+        if self.vector_matches is not None:
+            get_embedding_relevance(OLLAMA_EMBEDDING_MODEL).log_decision(self.embedding, self.vector_matches,
+                                                                          is_relevant)
+        return is_relevant
+
+    def lexical_matches(self):
+        """
+        Matches of a decisive keyword hit, answered without an embedding call; None otherwise.
+        """
+        matches = self.knowledge_base.lexical.decisive_matches(self.email.text)
+        if not matches:
+            return None
+        metrics.incr('retrieval_requests', path='lexical')
+        return matches
+
+    def hybrid_matches(self):
+        matches = hybrid_matches(self.knowledge_base.lexical, self.email.text, self.vector_matches, RAG_TOP_K)
+        metrics.incr('retrieval_requests', path='hybrid')
+        return matches
+
+    def cached_answer(self, matches):
+        """
+        Returns (context, answer): NO_MATCH_REPLY without matches, a cached
+        reply for a near-duplicate question, or answer None when it must be generated.
+        """
+        email_id = self.email.id
+        if not matches:
+            logger.info("no_knowledge_match", email_id=email_id)
+            return None, NO_MATCH_REPLY
+        logger.info("knowledge_match_found", email_id=email_id, questions=[document.question for document, _ in matches])
+        context = pack_context(matches)
+        answer = get_response_cache().get(context, OLLAMA_GENERATE_MODEL, self.email.text, self.embedding)
+        if answer is not None:
+            logger.info("response_cache_hit", email_id=email_id)
+        return context, answer
+
+    def store_answer(self, context, answer):
+        if answer and answer != GENERATION_ERROR_REPLY:
+            get_response_cache().set(context, OLLAMA_GENERATE_MODEL, self.email.text, answer, self.email.sender,
+                                     self.embedding, self.email.subject)
+
+    def sent(self):
+        """
+        Records the sent reply before anything else can fail, so a retry only marks the email read.
+        """
+        self.reply_sent = True
+        self.claims.mark_replied(self.email.id)
+
+    def replied(self):
+        logger.info("reply_sent", email_id=self.email.id)
+        self.processor._track_success(time.time() - self.started)
+        self._track("Replied")
+        self.claims.complete(self.email.id)
+
+    def finish(self, status):
+        """
+        Done without a reply (Ignored, NeedsReview).
+        """
+        self.processor._track_status(status)
+        self._track(status)
+        self.claims.complete(self.email.id)
+
+    def abort(self, reason):
+        """
+        Gives up without a retry and releases the claim.
+        """
+        logger.error(reason, email_id=self.email.id)
+        self.processor._track_status("Failed")
+        self.claims.abort(self.email.id)
+
+    def fail(self, error):
+        """
+        Releases the claim before the error propagates to the retry.
+        """
+        logger.error("processing_error", email_id=self.email.id, error=str(error))
+        self.claims.abort(self.email.id)
+        self.processor._track_status("Failed")
+        self._track("Failed")
+
+    def _track(self, status):
+        self.processor._track_recent_activity(self.email.id, self.email.sender, self.email.subject, status)
 
 class EmailProcessor:
     def __init__(self):
         self.gmail_service = get_gmail_service()
-        self.faiss_index = load_faiss_index(FAISS_INDEX_PATH)
-        self.indexed_documents = load_indexed_documents(DOCUMENTS_PATH)
+        self.knowledge_base = self._load_knowledge_base()
+        self._kb_checked_at = time.monotonic()
         
         if not self.gmail_service:
             logger.error("Failed to initialize Gmail Service")
-        if not self.faiss_index or not self.indexed_documents:
+        if not self.knowledge_base.faiss_index or not self.knowledge_base.documents:
             logger.error("Failed to load Knowledge Base")
 
+    def _load_knowledge_base(self, current_version=None):
+        """
+        Loads the published index version; returns None if it is current_version.
+        """
+        source_mtime = _kb_source_mtime()
+        index_path, documents_path, manifest = resolve_index_files(EMBEDDINGS_DIR, FAISS_INDEX_PATH, DOCUMENTS_PATH)
+        version = manifest['version'] if manifest else file_fingerprint(index_path)
+        if current_version is not None and version == current_version:
+            return None
+        faiss_index = load_faiss_index(index_path)
+        documents = load_indexed_documents(documents_path)
+        return KnowledgeBase(faiss_index, documents, version, source_mtime)
+
+    def refresh_knowledge_base(self):
+        """
+        Picks up a newly published index; call between jobs. Checks the
+        manifest mtime at most every KB_RELOAD_CHECK_SECONDS, loads the new
+        version completely and only then swaps it in. A version that fails
+        to load is ignored and the current one stays active.
+        Returns the KnowledgeBase to use for the next job.
+        """
+        current = self.knowledge_base
+        now = time.monotonic()
+        if now - self._kb_checked_at < KB_RELOAD_CHECK_SECONDS:
+            return current
+        self._kb_checked_at = now
+
+        source_mtime = _kb_source_mtime()
+        if source_mtime == current.source_mtime:
+            return current
+        candidate = self._load_knowledge_base(current.version)
+        if candidate is None:
+            # Same content republished: remember the new mtime, keep the loaded index
+            self.knowledge_base = KnowledgeBase(current.faiss_index, current.documents, current.version, source_mtime,
+                                                current.lexical)
+            return self.knowledge_base
+        if not candidate.faiss_index or not candidate.documents or candidate.faiss_index.ntotal != len(candidate.documents):
+            logger.error("knowledge_base_reload_failed", version=candidate.version, current_version=current.version)
+            return current
+
+        self.knowledge_base = candidate
+        logger.info("knowledge_base_reloaded", version=candidate.version, previous_version=current.version,
+                    documents=len(candidate.documents))
+        return candidate
+
     @retry(stop=stop_after_attempt(3), wait=wait_exponential(min=4, max=10))
     def process_email(self, email_data):
         """
         Process a single email: Classify -> RAG Search -> Generate Response -> Send Reply
         email_data: dict or EmailMessage object
         """
-        email_id = email_data.id
-        sender = email_data.sender
-        subject = email_data.subject
-        text = email_data.text
-        thread_id = email_data.thread_id
-
-        logger.info("processing_email", email_id=email_id, sender=sender)
-        
-        # Metrics: Start processing
-        start_time = time.time()
-        self._track_recent_activity(email_id, sender, subject, "Processing")
+        logger.info("processing_email", email_id=email_data.id, sender=email_data.sender)
+        job = EmailJob(self, email_data, self.refresh_knowledge_base())
+        if not job.begin():
+            return
 
         try:
-            # 1. Classify
-            is_relevant = classify_email(text, model=OLLAMA_LLM_MODEL)
-            if not is_relevant:
-                logger.info("email_irrelevant", email_id=email_id)
-                mark_email_as_read(self.gmail_service, email_id)
-                self._track_status("Ignored")
-                self._track_recent_activity(email_id, sender, subject, "Ignored")
-                return
-
-            # 2. RAG Search
-            email_embedding = get_embedding_ollama(text, model=OLLAMA_EMBEDDING_MODEL)
-            if not email_embedding:
-                logger.error("embedding_failed", email_id=email_id)
-                self._track_status("Failed")
-                return
-
-            matched_document = search_knowledge_base(self.faiss_index, email_embedding, self.indexed_documents)
-            
-            # 3. Generate Response
-            if matched_document:
-                logger.info("knowledge_match_found", email_id=email_id, question=matched_document.question)
-                answer = generate_response_ollama(text, matched_document.answer, model=OLLAMA_LLM_MODEL)
-            else:
-                logger.info("no_knowledge_match", email_id=email_id)
-                answer = "Спасибо за ваше письмо. Мы получили ваш запрос и постараемся ответить на него как можно скорее."
-
-            # 4. Send Reply
-            if answer:
-                send_email_reply(self.gmail_service, email_id, sender, subject, answer, thread_id)
-                mark_email_as_read(self.gmail_service, email_id)
-                logger.info("reply_sent", email_id=email_id)
-                
-                # Metrics: Success
-                duration = time.time() - start_time
-                self._track_success(duration)
-                self._track_recent_activity(email_id, sender, subject, "Replied")
-
+            self._process(job)
         except Exception as e:
-            logger.error("processing_error", email_id=email_id, error=str(e))
-            self._track_status("Failed")
-            self._track_recent_activity(email_id, sender, subject, "Failed")
+            job.fail(e)
             raise e # Retry will catch this
 
+    def _process(self, job):
+        email = job.email
+        knowledge_base = job.knowledge_base
+        if job.reply_sent:
+            # An earlier attempt sent the reply and failed afterwards
+            mark_email_as_read(self.gmail_service, email.id)
+            job.replied()
+            return
+
+        # 1. Classify: local pre-classifier first, then (RELEVANCE_MODE=embedding) the email
+        # embedding, the LLM only for emails neither can decide
+        decision = job.pre_classify()
+        if job.wants_embedding_relevance(decision):
+            embedding = get_embedding_ollama(email.text, model=OLLAMA_EMBEDDING_MODEL)
+            if embedding:
+                decision = job.decide_from_embedding(embedding, self._search(knowledge_base, embedding))
+        classification = None
+        if decision.escalate:
+            classification = classify_email(email.text, model=OLLAMA_CLASSIFY_MODEL,
+                                            fallback_model=OLLAMA_CLASSIFY_FALLBACK_MODEL)
+        is_relevant = job.relevance(decision, classification)
+        if is_relevant is None:
+            job.finish("NeedsReview")
+            return
+        if not is_relevant:
+            mark_email_as_read(self.gmail_service, email.id)
+            job.finish("Ignored")
+            return
+
+        # 2. RAG Search: a decisive keyword match needs no embedding call
+        matches = job.lexical_matches()
+        if matches is None:
+            if job.vector_matches is None:
+                embedding = get_embedding_ollama(email.text, model=OLLAMA_EMBEDDING_MODEL)
+                if not embedding:
+                    job.abort("embedding_failed")
+                    return
+                job.use_vector_matches(embedding, self._search(knowledge_base, embedding))
+            matches = job.hybrid_matches()
+
+        # 3. Generate Response (one call covering every matched topic)
+        context, answer = job.cached_answer(matches)
+        if answer is None:
+            answer = generate_response_ollama(email.text, context, model=OLLAMA_GENERATE_MODEL)
+            job.store_answer(context, answer)
+
+        # 4. Send Reply
+        if not answer:
+            job.abort("empty_answer")
+            return
+        if not send_email_reply(self.gmail_service, email.id, email.sender, email.subject, answer, email.thread_id):
+            raise RuntimeError("sending the reply failed") # Not recorded as sent: the retry sends it
+        job.sent()
+        mark_email_as_read(self.gmail_service, email.id)
+        job.replied()
+
+    @staticmethod
+    def _search(knowledge_base, embedding):
+        return retrieve_documents(knowledge_base.faiss_index, embedding, knowledge_base.documents,
+                                  index_version=knowledge_base.version)
+
     def _get_redis(self):
         if not hasattr(self, 'redis_conn'):
             import redis
             self.redis_conn = redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379/0'))
         return self.redis_conn
 
+    def _get_claims(self):
+        if not hasattr(self, 'claims'):
+            self.claims = MessageClaims(self._get_redis())
+        return self.claims
+
     def _track_success(self, duration):
         r = self._get_redis()
         try:
@@ -133,3 +397,37 @@ class EmailProcessor:
             r.ltrim('emails:recent', 0, 49) # Keep last 50
         except Exception:
             pass
+
+
+# A single EmailProcessor per worker process. Building one is expensive
+# (Gmail discovery client, OAuth token load/refresh, FAISS index and
+# documents unpickling), so RQ jobs go through `process_email` below
+# instead of constructing a fresh processor for every message.
+_processor = None
+
+
+def get_processor():
+    """
+    Returns the worker-wide EmailProcessor, creating it on first use.
+    """
+    global _processor
+    if _processor is None:
+        _processor = EmailProcessor()
+    return _processor
+
+
+def warm_up():
+    """
+    Builds the processor ahead of the first job so the first email
+    does not pay the setup cost. Called once at worker start.
+    """
+    start_time = time.time()
+    get_processor()
+    logger.info("processor_warmed_up", duration=round(time.time() - start_time, 3))
+
+
+def process_email(email_data):
+    """
+    RQ job entry point: processes an email with the warm per-process processor.
+    """
+    return get_processor().process_email(email_data)
@@ -0,0 +1,116 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import redis
+from services import metrics
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+EMBEDDING_CACHE_TTL = int(os.getenv('EMBEDDING_CACHE_TTL_SECONDS', 30 * 24 * 3600))
+EMBEDDING_CACHE_LOCAL_SIZE = int(os.getenv('EMBEDDING_CACHE_LOCAL_SIZE', 2048))
+
+def normalize_text(text):
+    """
+    Collapses whitespace so re-wrapped copies of the same text share one entry.
+    """
+    return ' '.join(text.split())
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding cache: key = sha256(model, normalized text).
+
+    Two tiers: an in-process LRU of EMBEDDING_CACHE_LOCAL_SIZE vectors in front
+    of Redis, where vectors are stored as raw float32 bytes with a TTL.
+    Redis errors degrade to the local tier only.
+    """
+
+    def __init__(self, redis_conn=None, local_size=EMBEDDING_CACHE_LOCAL_SIZE, ttl=EMBEDDING_CACHE_TTL):
+        self.redis = redis_conn
+        self.local_size = local_size
+        self.ttl = ttl
+        self.local = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'local_hit': 0, 'redis_hit': 0, 'miss': 0}
+
+    @staticmethod
+    def key(model, text):
+        digest = hashlib.sha256(f'{model}\0{normalize_text(text)}'.encode('utf-8')).hexdigest()
+        return f'emb:{digest}'
+
+    def get_many(self, model, texts):
+        """
+        Returns a list aligned with texts: a float32 vector, or None on a miss.
+        """
+        keys = [self.key(model, text) for text in texts]
+        results = [None] * len(texts)
+        remote = []
+        with self.lock:
+            for position, key in enumerate(keys):
+                vector = self.local.get(key)
+                if vector is not None:
+                    self.local.move_to_end(key)
+                    results[position] = vector
+                else:
+                    remote.append(position)
+        local_hits = len(texts) - len(remote)
+
+        redis_hits = 0
+        if remote and self.redis is not None:
+            try:
+                values = self.redis.mget([keys[position] for position in remote])
+            except Exception as e:
+                logger.error("embedding_cache_get_failed", error=str(e))
+                values = [None] * len(remote)
+            for position, value in zip(remote, values):
+                if value is not None:
+                    vector = np.frombuffer(value, dtype=np.float32)
+                    results[position] = vector
+                    self._remember(keys[position], vector)
+                    redis_hits += 1
+
+        self._count(local_hits, redis_hits, len(remote) - redis_hits)
+        return results
+
+    def set_many(self, model, texts, vectors):
+        entries = [(self.key(model, text), np.asarray(vector, dtype=np.float32)) for text, vector in zip(texts, vectors)]
+        for key, vector in entries:
+            self._remember(key, vector)
+        if self.redis is None or not entries:
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for key, vector in entries:
+                pipe.set(key, vector.tobytes(), ex=self.ttl)
+            pipe.execute()
+        except Exception as e:
+            logger.error("embedding_cache_set_failed", error=str(e))
+
+    def _remember(self, key, vector):
+        with self.lock:
+            self.local[key] = vector
+            self.local.move_to_end(key)
+            while len(self.local) > self.local_size:
+                self.local.popitem(last=False)
+
+    def _count(self, local_hits, redis_hits, misses):
+        self.stats['local_hit'] += local_hits
+        self.stats['redis_hit'] += redis_hits
+        self.stats['miss'] += misses
+        metrics.incr('embedding_cache_requests', local_hits, result='local_hit')
+        metrics.incr('embedding_cache_requests', redis_hits, result='redis_hit')
+        metrics.incr('embedding_cache_requests', misses, result='miss')
+
+_cache = None
+
+def get_embedding_cache():
+    """
+    Returns the process-wide EmbeddingCache.
+    """
+    global _cache
+    if _cache is None:
+        _cache = EmbeddingCache(redis.from_url(REDIS_URL))
+    return _cache
@@ -21,13 +21,15 @@ TOKEN_FILE = 'token.pickle'
 CREDS_FILE = 'credentials.json'
 
 class EmailMessage:
-    def __init__(self, id, sender, recipient, subject, text, thread_id):
+    def __init__(self, id, sender, recipient, subject, text, thread_id, headers=None):
         self.id = id
         self.sender = sender
         self.recipient = recipient
         self.subject = subject
         self.text = text
         self.thread_id = thread_id
+        # Subset of METADATA_HEADERS used by the pre-classifier (bulk-mail markers)
+        self.headers = headers or {}
 
 def get_gmail_service():
     """
@@ -39,53 +41,164 @@ def get_gmail_service():
 
     return build('gmail', 'v1', credentials=creds)
 
-def get_new_emails(service, user_id='me', query='is:unread'):
+# Gmail accepts up to 100 calls per batch request, but larger batches are
+# more likely to hit per-user rate limits (429), so stay below the cap.
+GMAIL_BATCH_SIZE = min(int(os.getenv('GMAIL_BATCH_SIZE', 50)), 100)
+GMAIL_PAGE_SIZE = 500 # Maximum maxResults for messages.list
+METADATA_HEADERS = ['From', 'To', 'Subject', 'List-Unsubscribe', 'Precedence', 'Auto-Submitted']
+
+def list_message_ids(service, user_id='me', query='is:unread', max_messages=None):
     """
-    Fetches unread emails.
+    Lists message IDs matching the query, following nextPageToken.
     """
-    try:
-        response = service.users().messages().list(userId=user_id, q=query).execute()
-        messages = response.get('messages', [])
-        email_list = []
+    message_ids = []
+    page_token = None
+    while True:
+        response = service.users().messages().list(
+            userId=user_id, q=query, maxResults=GMAIL_PAGE_SIZE, pageToken=page_token
+        ).execute()
+        message_ids.extend(m['id'] for m in response.get('messages', []))
+        page_token = response.get('nextPageToken')
+        if not page_token or (max_messages and len(message_ids) >= max_messages):
+            break
+    return message_ids[:max_messages] if max_messages else message_ids
+
+def get_messages_batch(service, message_ids, user_id='me', format='full', metadata_headers=None):
+    """
+    Fetches messages through Gmail batch requests, GMAIL_BATCH_SIZE calls per HTTP round trip.
+    Returns the raw message resources in the order of message_ids; failed ones are skipped.
+    """
+    results = {}
 
-        if not messages:
-            logging.info('No unread messages found.')
+    def on_response(request_id, response, exception):
+        if exception is not None:
+            logging.error(f'Error fetching message {request_id}: {exception}')
         else:
-            for message_item in messages:
-                msg = service.users().messages().get(userId=user_id, id=message_item['id'], format='full').execute()
-                payload = msg['payload']
-                headers = payload['headers']
-
-                sender = next((h['value'] for h in headers if h['name'] == 'From'), 'Unknown Sender')
-                subject = next((h['value'] for h in headers if h['name'] == 'Subject'), 'No Subject')
-                recipient = next((h['value'] for h in headers if h['name'] == 'To'), 'Unknown Recipient')
-                thread_id = msg['threadId']
-
-                msg_text = ""
-                def get_text_part(parts):
-                    for part in parts:
-                        if part['mimeType'] == 'text/plain' and 'body' in part and 'data' in part['body']:
-                            return base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
-                        elif 'parts' in part:
-                            recursive_text = get_text_part(part['parts'])
-                            if recursive_text:
-                                return recursive_text
-                    return None
-
-                if 'parts' in payload:
-                    msg_text = get_text_part(payload['parts'])
-                elif 'body' in payload and 'data' in payload['body']:
-                    msg_text = base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8')
-                
-                if not msg_text:
-                    msg_text = "[Text not found]"
-
-                email_list.append(EmailMessage(message_item['id'], sender, recipient, subject, msg_text, thread_id))
-        return email_list
+            results[request_id] = response
+
+    for start in range(0, len(message_ids), GMAIL_BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=on_response)
+        for message_id in message_ids[start:start + GMAIL_BATCH_SIZE]:
+            params = {'userId': user_id, 'id': message_id, 'format': format}
+            if format == 'metadata' and metadata_headers:
+                params['metadataHeaders'] = metadata_headers
+            batch.add(service.users().messages().get(**params), request_id=message_id)
+        batch.execute()
+
+    return [results[message_id] for message_id in message_ids if message_id in results]
+
+def get_headers(msg):
+    """
+    Returns message headers as a dict (first occurrence wins).
+    """
+    headers = {}
+    for header in msg.get('payload', {}).get('headers', []):
+        headers.setdefault(header['name'], header['value'])
+    return headers
+
+def _get_text_part(parts):
+    for part in parts:
+        if part['mimeType'] == 'text/plain' and 'body' in part and 'data' in part['body']:
+            return base64.urlsafe_b64decode(part['body']['data']).decode('utf-8')
+        elif 'parts' in part:
+            recursive_text = _get_text_part(part['parts'])
+            if recursive_text:
+                return recursive_text
+    return None
+
+def parse_message(msg):
+    """
+    Converts a Gmail message resource fetched with format='full' into an EmailMessage.
+    """
+    payload = msg['payload']
+    headers = get_headers(msg)
+
+    sender = headers.get('From', 'Unknown Sender')
+    subject = headers.get('Subject', 'No Subject')
+    recipient = headers.get('To', 'Unknown Recipient')
+    thread_id = msg['threadId']
+
+    msg_text = ""
+    if 'parts' in payload:
+        msg_text = _get_text_part(payload['parts'])
+    elif 'body' in payload and 'data' in payload['body']:
+        msg_text = base64.urlsafe_b64decode(payload['body']['data']).decode('utf-8')
+
+    if not msg_text:
+        msg_text = "[Text not found]"
+
+    kept_headers = {name.lower() for name in METADATA_HEADERS}
+    classifier_headers = {name: value for name, value in headers.items() if name.lower() in kept_headers}
+
+    return EmailMessage(msg['id'], sender, recipient, subject, msg_text, thread_id, classifier_headers)
+
+def get_emails_by_ids(service, message_ids, user_id='me', message_filter=None):
+    """
+    Downloads and parses the given messages in batches.
+    message_filter: optional callable(headers: dict) -> bool. When set, only
+    metadata is fetched first and full bodies are downloaded for messages it accepts.
+    """
+    if message_filter is not None:
+        metadata = get_messages_batch(service, message_ids, user_id=user_id,
+                                      format='metadata', metadata_headers=METADATA_HEADERS)
+        message_ids = [msg['id'] for msg in metadata if message_filter(get_headers(msg))]
+        logging.info(f'{len(message_ids)} of {len(metadata)} messages passed the metadata filter.')
+
+    email_list = []
+    for msg in get_messages_batch(service, message_ids, user_id=user_id, format='full'):
+        try:
+            email_list.append(parse_message(msg))
+        except Exception as e:
+            logging.error(f"Error parsing message {msg.get('id')}: {e}")
+    return email_list
+
+def get_new_emails(service, user_id='me', query='is:unread', message_filter=None, max_messages=None):
+    """
+    Fetches unread emails: all result pages, message bodies in batch requests.
+    """
+    try:
+        message_ids = list_message_ids(service, user_id=user_id, query=query, max_messages=max_messages)
+        if not message_ids:
+            logging.info('No unread messages found.')
+            return []
+        return get_emails_by_ids(service, message_ids, user_id=user_id, message_filter=message_filter)
     except Exception as e:
         logging.error(f'Error fetching emails: {e}')
         return []
 
+def get_current_history_id(service, user_id='me'):
+    """
+    Returns the mailbox's current historyId.
+    """
+    return service.users().getProfile(userId=user_id).execute()['historyId']
+
+def list_history_message_ids(service, start_history_id, user_id='me', label_id='INBOX'):
+    """
+    Lists unread messages added to the label since start_history_id via users.history.list.
+    Returns (message_ids, latest_history_id). Raises HttpError 404 when
+    start_history_id is too old and a full sync is required.
+    """
+    message_ids = []
+    seen = set()
+    latest_history_id = start_history_id
+    page_token = None
+    while True:
+        response = service.users().history().list(
+            userId=user_id, startHistoryId=start_history_id, historyTypes=['messageAdded'],
+            labelId=label_id, maxResults=GMAIL_PAGE_SIZE, pageToken=page_token
+        ).execute()
+        for record in response.get('history', []):
+            for added in record.get('messagesAdded', []):
+                message = added['message']
+                if 'UNREAD' in message.get('labelIds', []) and message['id'] not in seen:
+                    seen.add(message['id'])
+                    message_ids.append(message['id'])
+        latest_history_id = response.get('historyId', latest_history_id)
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            break
+    return message_ids, latest_history_id
+
 def send_email_reply(service, original_message_id: str, to: str, subject: str, message_text: str, thread_id: str):
     """
     Sends a reply.
@@ -0,0 +1,247 @@
+import glob
+import hashlib
+import json
+import os
+import faiss
+import numpy as np
+from services.document_store import write_document_store
+from services.rag_service import load_indexed_documents, parse_knowledge_base_file
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+MANIFEST_NAME = 'manifest.json'
+# flat (exhaustive), hnsw, ivf_flat or ivf_pq; metric l2, or ip (cosine on normalized vectors)
+RAG_INDEX_TYPE = os.getenv('RAG_INDEX_TYPE', 'flat')
+RAG_METRIC = os.getenv('RAG_METRIC', 'l2')
+RAG_HNSW_M = int(os.getenv('RAG_HNSW_M', 32))
+RAG_HNSW_EF_CONSTRUCTION = int(os.getenv('RAG_HNSW_EF_CONSTRUCTION', 80))
+RAG_HNSW_EF_SEARCH = int(os.getenv('RAG_HNSW_EF_SEARCH', 64))
+RAG_IVF_NLIST = int(os.getenv('RAG_IVF_NLIST', 1024))
+RAG_IVF_NPROBE = int(os.getenv('RAG_IVF_NPROBE', 16))
+RAG_PQ_M = int(os.getenv('RAG_PQ_M', 48))
+# k-means wants ~39 training points per centroid; PQ trains 256 centroids per sub-quantizer
+IVF_MIN_POINTS_PER_LIST = 39
+PQ_MIN_TRAINING_POINTS = IVF_MIN_POINTS_PER_LIST * 256
+# HNSW graphs cannot drop vectors, so edits and deletions rebuild the whole index
+REMOVABLE_INDEX_TYPES = ('flat', 'ivf_flat', 'ivf_pq')
+# Versions kept on disk besides the current one, for readers still loading the previous manifest
+KEEP_PREVIOUS_VERSIONS = 1
+
+def file_sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def embedding_text(doc):
+    # Question + answer: the text embedded for every indexed document
+    return f"Вопрос: {doc.question}\nОтвет: {doc.answer}"
+
+def load_manifest(embeddings_dir):
+    path = os.path.join(embeddings_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def resolve_index_files(embeddings_dir, legacy_index_path, legacy_documents_path):
+    """
+    Returns (index_path, documents_path, manifest) for the current KB version.
+    Falls back to the legacy fixed paths when no manifest has been written.
+    """
+    manifest = load_manifest(embeddings_dir)
+    if manifest is None:
+        return legacy_index_path, legacy_documents_path, None
+    return (os.path.join(embeddings_dir, manifest['index_file']),
+            os.path.join(embeddings_dir, manifest['documents_file']),
+            manifest)
+
+def _pq_subquantizers(dimension, requested):
+    # The sub-quantizer count must divide the dimension
+    return max(m for m in range(1, min(requested, dimension) + 1) if dimension % m == 0)
+
+def make_index(index_type, metric, vectors):
+    """
+    Creates an empty index of the given type, trained on vectors if it needs training.
+    Every returned index supports add_with_ids. IVF types fall back to a
+    smaller variant (or flat) when there are too few vectors to train them.
+    """
+    n, dimension = vectors.shape
+    metric_type = faiss.METRIC_INNER_PRODUCT if metric == 'ip' else faiss.METRIC_L2
+
+    if index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(dimension, RAG_HNSW_M, metric_type)
+        index.hnsw.efConstruction = RAG_HNSW_EF_CONSTRUCTION
+        index.hnsw.efSearch = RAG_HNSW_EF_SEARCH
+        return faiss.IndexIDMap(index)
+
+    if index_type in ('ivf_flat', 'ivf_pq'):
+        nlist = min(RAG_IVF_NLIST, n // IVF_MIN_POINTS_PER_LIST)
+        if nlist < 1:
+            logger.warning("index_type_fallback", index_type=index_type, fallback='flat', vectors=n)
+            return make_index('flat', metric, vectors)
+        if index_type == 'ivf_pq' and n < PQ_MIN_TRAINING_POINTS:
+            logger.warning("index_type_fallback", index_type=index_type, fallback='ivf_flat', vectors=n)
+            index_type = 'ivf_flat'
+        codec = 'Flat' if index_type == 'ivf_flat' else f'PQ{_pq_subquantizers(dimension, RAG_PQ_M)}'
+        index = faiss.index_factory(dimension, f'IVF{nlist},{codec}', metric_type)
+        index.train(vectors)
+        index.nprobe = min(RAG_IVF_NPROBE, nlist)
+        return index
+
+    if index_type != 'flat':
+        raise ValueError(f'Unknown RAG_INDEX_TYPE: {index_type}')
+    return faiss.IndexIDMap(faiss.IndexFlat(dimension, metric_type))
+
+def _atomic_write(path, write):
+    tmp_path = f'{path}.tmp'
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+def _load_previous(embeddings_dir, embedding_model, index_type, metric, force):
+    """
+    Loads the last build if it can be updated in place, else returns (None, None, None).
+    """
+    manifest = None if force else load_manifest(embeddings_dir)
+    if manifest is None:
+        return None, None, None
+    if (manifest.get('model'), manifest.get('index_type', 'flat'), manifest.get('metric', 'l2')) != (embedding_model, index_type, metric):
+        logger.info("index_config_changed", model=embedding_model, index_type=index_type, metric=metric)
+        return None, None, None
+    try:
+        # A writable copy: the previous build is updated in place
+        index = faiss.read_index(os.path.join(embeddings_dir, manifest['index_file']))
+    except Exception as e:
+        logger.warning("previous_index_unusable", error=str(e))
+        return None, None, None
+    documents = load_indexed_documents(os.path.join(embeddings_dir, manifest['documents_file']))
+    if len(documents) != index.ntotal:
+        logger.warning("previous_documents_unusable", documents=len(documents), vectors=index.ntotal)
+        return None, None, None
+    return manifest, index, documents
+
+def build_index(kb_dir, embedding_model, embeddings_dir, force=False, index_type=RAG_INDEX_TYPE, metric=RAG_METRIC):
+    """
+    Incrementally (re)builds the knowledge-base index.
+
+    Each knowledge_base/*.md file is hashed; only new or changed files are
+    embedded, deleted ones are removed. Every file keeps a stable FAISS ID
+    (IndexIDMap), and the document store maps those IDs to KnowledgeDocument.
+    Index and documents are written under version-named files and published
+    by atomically replacing manifest.json, so readers never see a mix of versions.
+    A change of model, index type or metric, or an edit to an HNSW index,
+    rebuilds (and retrains) everything; the embedding cache keeps that cheap.
+
+    Returns the manifest of the current version, or None if the build failed.
+    """
+    from services.llm_service import get_embeddings_ollama
+
+    manifest, index, documents = _load_previous(embeddings_dir, embedding_model, index_type, metric, force)
+    old_files = manifest['files'] if manifest else {}
+    next_id = manifest['next_id'] if manifest else 0
+    documents = dict(documents) if documents else {}
+
+    current = {os.path.basename(path): (path, file_sha256(path))
+               for path in sorted(glob.glob(os.path.join(kb_dir, '*.md')))}
+
+    removed = [name for name in old_files if name not in current]
+    changed = [name for name, (_, sha) in current.items() if name in old_files and old_files[name]['sha256'] != sha]
+    added = [name for name in current if name not in old_files]
+    logger.info("index_build_plan", unchanged=len(current) - len(changed) - len(added),
+                changed=len(changed), added=len(added), removed=len(removed))
+
+    if manifest and not (removed or changed or added):
+        logger.info("index_up_to_date", version=manifest['version'])
+        return manifest
+
+    files = {name: entry for name, entry in old_files.items() if name not in removed}
+    rebuild = index is None
+    if not rebuild and (removed or changed) and index_type not in REMOVABLE_INDEX_TYPES:
+        logger.info("index_full_rebuild_required", index_type=index_type)
+        rebuild = True
+    if rebuild:
+        index = None
+        documents = {}
+
+    # Parse what needs embedding; unparsable files are dropped from the index
+    to_embed = []
+    for name in (list(current) if rebuild else changed + added):
+        doc = parse_knowledge_base_file(current[name][0])
+        if name in files:
+            doc_id = files[name]['id']
+        else:
+            doc_id = next_id
+            next_id += 1
+        if doc is None:
+            files.pop(name, None)
+            removed.append(name)
+            documents.pop(doc_id, None)
+            continue
+        files[name] = {'sha256': current[name][1], 'id': doc_id}
+        to_embed.append((doc_id, doc))
+
+    vectors = None
+    if to_embed:
+        vectors = get_embeddings_ollama([embedding_text(doc) for _, doc in to_embed], embedding_model)
+        if vectors is None or len(vectors) != len(to_embed):
+            logger.error("index_build_embedding_failed", documents=len(to_embed))
+            return None
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if metric == 'ip':
+            faiss.normalize_L2(vectors)
+
+    if rebuild:
+        if vectors is None:
+            logger.error("index_build_no_documents", kb_dir=kb_dir)
+            return None
+        index = make_index(index_type, metric, vectors)
+
+    stale_ids = [old_files[name]['id'] for name in removed + changed if name in old_files]
+    if stale_ids and not rebuild:
+        index.remove_ids(np.array(stale_ids, dtype=np.int64))
+        for doc_id in stale_ids:
+            documents.pop(doc_id, None)
+    if to_embed:
+        index.add_with_ids(vectors, np.array([doc_id for doc_id, _ in to_embed], dtype=np.int64))
+        documents.update(to_embed)
+
+    return _publish(embeddings_dir, embedding_model, index_type, metric, index, documents, files, next_id, manifest)
+
+def _publish(embeddings_dir, embedding_model, index_type, metric, index, documents, files, next_id, previous):
+    version_source = json.dumps({'model': embedding_model, 'index_type': index_type, 'metric': metric, 'files': files},
+                                sort_keys=True)
+    version = hashlib.sha256(version_source.encode('utf-8')).hexdigest()[:16]
+    manifest = {
+        'version': version,
+        'model': embedding_model,
+        'index_type': index_type,
+        'metric': metric,
+        'dimension': index.d,
+        'index_file': f'knowledge_base.{version}.index',
+        'documents_file': f'documents.{version}.kbdocs',
+        'next_id': next_id,
+        'files': files,
+        'previous_versions': ([previous['version']] + previous.get('previous_versions', []))[:KEEP_PREVIOUS_VERSIONS]
+                             if previous and previous['version'] != version else
+                             (previous or {}).get('previous_versions', []),
+    }
+
+    os.makedirs(embeddings_dir, exist_ok=True)
+    _atomic_write(os.path.join(embeddings_dir, manifest['index_file']), lambda path: faiss.write_index(index, path))
+
+    _atomic_write(os.path.join(embeddings_dir, manifest['documents_file']),
+                  lambda path: write_document_store(path, documents))
+
+    def write_manifest(path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+    _atomic_write(os.path.join(embeddings_dir, MANIFEST_NAME), write_manifest)
+
+    _remove_old_versions(embeddings_dir, {version, *manifest['previous_versions']})
+    logger.info("index_published", version=version, documents=index.ntotal)
+    return manifest
+
+def _remove_old_versions(embeddings_dir, keep_versions):
+    for pattern in ('knowledge_base.*.index', 'documents.*.kbdocs', 'documents.*.pkl'):
+        for path in glob.glob(os.path.join(embeddings_dir, pattern)):
+            if path.split('.')[-2] not in keep_versions:
+                os.remove(path)
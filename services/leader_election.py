@@ -0,0 +1,95 @@
+import threading
+import uuid
+from redis.exceptions import WatchError
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+class LeaderElection:
+    """
+    Redis lease-based leader election: the leader holds `key` with a TTL and
+    renews it every ttl/3 seconds from a background thread. If the leader
+    dies, the lease expires and a standby takes over within about one TTL.
+    """
+
+    def __init__(self, redis_conn, key, ttl=15):
+        self.redis = redis_conn
+        self.key = key
+        self.ttl = ttl
+        self.identity = uuid.uuid4().hex
+        self._is_leader = threading.Event()
+        self._stopped = threading.Event()
+
+    @property
+    def is_leader(self):
+        return self._is_leader.is_set()
+
+    def acquire_or_renew(self):
+        """
+        Renews the lease if we hold it, otherwise tries to take it.
+        Returns True while this process is the leader.
+        """
+        try:
+            with self.redis.pipeline() as pipe:
+                pipe.watch(self.key)
+                current = pipe.get(self.key)
+                if current == self.identity.encode():
+                    pipe.multi()
+                    pipe.expire(self.key, self.ttl)
+                    pipe.execute()
+                    leader = True
+                elif current is None:
+                    pipe.multi()
+                    pipe.set(self.key, self.identity, nx=True, ex=self.ttl)
+                    leader = bool(pipe.execute()[0])
+                else:
+                    pipe.unwatch()
+                    leader = False
+        except WatchError:
+            leader = False
+        except Exception as e:
+            # Without Redis we cannot prove the lease is ours: step down
+            logger.error("leader_election_error", key=self.key, error=str(e))
+            leader = False
+
+        if leader != self.is_leader:
+            logger.info("leadership_changed", key=self.key, leader=leader, identity=self.identity)
+        if leader:
+            self._is_leader.set()
+        else:
+            self._is_leader.clear()
+        return leader
+
+    def start(self):
+        """
+        Starts the background thread that keeps acquiring/renewing the lease.
+        """
+        thread = threading.Thread(target=self._run, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        """
+        Stops renewing and releases the lease if held, so a standby takes over immediately.
+        """
+        self._stopped.set()
+        self._is_leader.clear()
+        try:
+            with self.redis.pipeline() as pipe:
+                pipe.watch(self.key)
+                if pipe.get(self.key) == self.identity.encode():
+                    pipe.multi()
+                    pipe.delete(self.key)
+                    pipe.execute()
+                else:
+                    pipe.unwatch()
+        except Exception as e:
+            logger.error("leader_release_failed", key=self.key, error=str(e))
+
+    def wait_for_leadership(self, timeout=None):
+        return self._is_leader.wait(timeout)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.acquire_or_renew()
+            self._stopped.wait(self.ttl / 3)
@@ -0,0 +1,131 @@
+import math
+import os
+import re
+from collections import Counter, defaultdict
+
+# BM25 over question + keywords (the "# Ключевые слова" section) of every document
+BM25_K1 = 1.5
+BM25_B = 0.75
+# Crude stemming for Russian: compare words by their first STEM_LENGTH letters,
+# so "заказ", "заказа" and "заказов" are one term
+STEM_LENGTH = 5
+STOP_WORDS = frozenset(
+    'и в во на с со по к ко о об у за из от до для не ни ли а но или же бы то это как что '
+    'я вы мы он она они мне меня вам вас нам нас ваш ваша ваше ваши the a an to of and or is'.split()
+)
+# A lexical result is used without an embedding call only for short emails
+# whose best document covers most terms and clearly beats the runner-up
+LEXICAL_MAX_QUERY_TERMS = int(os.getenv('LEXICAL_MAX_QUERY_TERMS', 6))
+LEXICAL_MIN_COVERAGE = float(os.getenv('LEXICAL_MIN_COVERAGE', 0.6))
+LEXICAL_DECISIVE_RATIO = float(os.getenv('LEXICAL_DECISIVE_RATIO', 1.5))
+# Share of email terms a document must contain to be fused with the vector results
+LEXICAL_FUSION_MIN_COVERAGE = float(os.getenv('LEXICAL_FUSION_MIN_COVERAGE', 0.25))
+# Reciprocal rank fusion constant (Cormack et al.: 60)
+RRF_K = int(os.getenv('RRF_K', 60))
+
+def tokenize(text):
+    """
+    Lowercased, stemmed terms without stop words and bare numbers (order numbers).
+    """
+    terms = []
+    for word in re.findall(r'\w+', text.lower().replace('ё', 'е')):
+        if word in STOP_WORDS or word.isdigit():
+            continue
+        terms.append(word[:STEM_LENGTH])
+    return terms
+
+class LexicalIndex:
+    """
+    In-memory BM25 inverted index over the knowledge-base documents.
+
+    documents is the same mapping the vector search resolves IDs against:
+    a list (legacy documents.pkl) or {doc_id: KnowledgeDocument}. Only term
+    postings are kept; documents are looked up there on a hit, so an mmap'd
+    DocumentStore is not copied into memory.
+    """
+
+    def __init__(self, documents):
+        items = documents.items() if hasattr(documents, 'items') else enumerate(documents or [])
+        self.documents = documents
+        self.lengths = {}
+        self.postings = defaultdict(dict)
+        for doc_id, document in items:
+            terms = tokenize(f'{document.question} {document.keywords}')
+            self.lengths[doc_id] = len(terms)
+            for term, count in Counter(terms).items():
+                self.postings[term][doc_id] = count
+        self.average_length = sum(self.lengths.values()) / len(self.lengths) if self.lengths else 0.0
+
+    def _idf(self, term):
+        n = len(self.postings.get(term, ()))
+        return math.log(1 + (len(self.lengths) - n + 0.5) / (n + 0.5))
+
+    def search(self, text, k, min_coverage=0.0):
+        """
+        Returns [(document, BM25 score), ...] for the k best-scoring documents
+        that contain at least min_coverage of the distinct terms of text.
+        """
+        terms = tokenize(text)
+        if not terms:
+            return []
+        distinct = len(set(terms))
+        return [(self.documents[doc_id], score) for doc_id, score, matched_terms in self._score(terms)
+                if matched_terms / distinct >= min_coverage][:k]
+
+    def decisive_matches(self, text):
+        """
+        Returns [(document, score)] when the lexical result alone is reliable
+        enough to answer without vector search, else [].
+        """
+        terms = tokenize(text)
+        if not terms or len(terms) > LEXICAL_MAX_QUERY_TERMS:
+            return []
+        scored = self._score(terms)
+        if not scored:
+            return []
+        doc_id, score, matched_terms = scored[0]
+        if matched_terms / len(set(terms)) < LEXICAL_MIN_COVERAGE:
+            return []
+        if len(scored) > 1 and score < LEXICAL_DECISIVE_RATIO * scored[1][1]:
+            return []
+        return [(self.documents[doc_id], score)]
+
+    def _score(self, terms):
+        scores = defaultdict(float)
+        matched = Counter()
+        for term in set(terms):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = self._idf(term)
+            for doc_id, count in postings.items():
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths[doc_id] / self.average_length)
+                scores[doc_id] += idf * count * (BM25_K1 + 1) / (count + norm)
+                matched[doc_id] += 1
+        return sorted(((doc_id, score, matched[doc_id]) for doc_id, score in scores.items()),
+                      key=lambda item: item[1], reverse=True)
+
+def reciprocal_rank_fusion(*rankings, k=None, rrf_k=RRF_K):
+    """
+    Fuses ranked [(document, score_or_distance), ...] lists by reciprocal rank:
+    score = sum(1 / (rrf_k + rank)). Documents are identified by source file.
+    Returns [(document, fused score), ...], best first, at most k.
+    """
+    fused = defaultdict(float)
+    by_key = {}
+    for ranking in rankings:
+        for rank, (document, _) in enumerate(ranking, start=1):
+            key = document.source_file
+            by_key.setdefault(key, document)
+            fused[key] += 1.0 / (rrf_k + rank)
+    ranked = sorted(fused.items(), key=lambda item: item[1], reverse=True)[:k]
+    return [(by_key[key], score) for key, score in ranked]
+
+def hybrid_matches(lexical_index, text, vector_matches, k):
+    """
+    Fuses vector matches with the BM25 matches for text (RRF), at most k.
+    """
+    lexical = lexical_index.search(text, k, min_coverage=LEXICAL_FUSION_MIN_COVERAGE)
+    if not lexical:
+        return vector_matches[:k]
+    return reciprocal_rank_fusion(vector_matches, lexical, k=k)
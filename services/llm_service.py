@@ -1,141 +1,848 @@
 # ollama_utils.py
+import os
+import asyncio
+import bisect
+import contextlib
+import hashlib
+import threading
+import time
+import httpx
+import numpy as np
 import requests
 import json
 import logging
-from typing import Optional, List
+from typing import Optional, List, Tuple
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from services.embedding_cache import get_embedding_cache, normalize_text
+from services import metrics
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-OLLAMA_API_BASE_URL = "http://ollama:11434/api" # Стандартная конечная точка API Ollama
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://ollama:11434")
+OLLAMA_API_BASE_URL = f"{OLLAMA_HOST.rstrip('/')}/api" # Стандартная конечная точка API Ollama
+# Несколько серверов Ollama через запятую (см. OllamaRouter); по умолчанию только OLLAMA_HOST
+OLLAMA_HOSTS = [host.strip().rstrip('/') for host in (os.getenv("OLLAMA_HOSTS") or OLLAMA_HOST).split(",") if host.strip()]
+OLLAMA_API_BASE_URLS = [f"{host}/api" for host in OLLAMA_HOSTS]
+OLLAMA_ROUTING = os.getenv("OLLAMA_ROUTING", "least_outstanding") # least_outstanding | model_hash
+OLLAMA_BREAKER_FAILURES = int(os.getenv("OLLAMA_BREAKER_FAILURES", 3))
+OLLAMA_BREAKER_RESET_SECONDS = float(os.getenv("OLLAMA_BREAKER_RESET_SECONDS", 30))
+OLLAMA_HEALTH_CHECK_SECONDS = float(os.getenv("OLLAMA_HEALTH_CHECK_SECONDS", 10))
+
+# Пул соединений и повторы
+OLLAMA_POOL_SIZE = int(os.getenv("OLLAMA_POOL_SIZE", 10))
+OLLAMA_MAX_RETRIES = int(os.getenv("OLLAMA_MAX_RETRIES", 2))
+OLLAMA_BACKOFF_FACTOR = float(os.getenv("OLLAMA_BACKOFF_FACTOR", 0.5))
+
+# Сколько текстов отправлять в одном запросе /api/embed
+OLLAMA_EMBED_BATCH_SIZE = int(os.getenv("OLLAMA_EMBED_BATCH_SIZE", 64))
+
+# Таймауты (секунды): на установку соединения и на ответ для каждой операции
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", 3))
+OLLAMA_TIMEOUTS = {
+    "embed": float(os.getenv("OLLAMA_EMBED_TIMEOUT", 30)),
+    "classify": float(os.getenv("OLLAMA_CLASSIFY_TIMEOUT", 30)),
+    "generate": float(os.getenv("OLLAMA_GENERATE_TIMEOUT", 30)),
+}
+
+# Потоковая генерация: ответ читается по токенам, и генерация прерывается
+# по бюджету времени, бюджету токенов или маркеру конца ответа.
+# В потоковом режиме OLLAMA_GENERATE_TIMEOUT — таймаут ожидания очередного фрагмента.
+OLLAMA_GENERATE_STREAM = os.getenv("OLLAMA_GENERATE_STREAM", "false").lower() == "true"
+GENERATE_MAX_SECONDS = float(os.getenv("GENERATE_MAX_SECONDS", 60))
+GENERATE_MAX_TOKENS = int(os.getenv("GENERATE_MAX_TOKENS", 512))
+GENERATE_STOP_MARKER = os.getenv("GENERATE_STOP_MARKER", "\n---")
+
+# Ответ классификатора с уверенностью ниже порога не принимается: письмо
+# переходит к следующей модели каскада, а затем на ручную проверку
+CLASSIFY_MIN_CONFIDENCE = float(os.getenv("CLASSIFY_MIN_CONFIDENCE", 0.7))
+
+# Сколько Ollama держит модель загруженной после запроса: выгрузка модели
+# сбрасывает и кэш системных промптов
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+
+class Backend:
+    """
+    Один сервер Ollama в OllamaRouter: число запросов в работе и состояние
+    предохранителя (circuit breaker).
+    """
+    def __init__(self, url: str):
+        self.url = url.rstrip('/') # .../api
+        self.outstanding = 0
+        self.failures = 0 # Ошибок подряд
+        self.open_until = 0.0 # Предохранитель разомкнут до этого момента (time.monotonic)
+        self.probing = False # После паузы пропускается один пробный запрос
+
+class OllamaRouter:
+    """
+    Распределяет запросы между серверами Ollama (OLLAMA_HOSTS).
+
+    routing="least_outstanding" выбирает сервер с наименьшим числом запросов в работе,
+    routing="model_hash" — консистентное хеширование по имени модели, чтобы каждая
+    модель (и ее кэш промптов) жила на своем сервере, а при его отказе переезжала
+    на следующий по кольцу. После failure_threshold ошибок подряд (соединение, 5xx)
+    предохранитель сервера размыкается на reset_seconds, затем пропускается один
+    пробный запрос. Если разомкнуты все, запросы идут на все серверы как обычно.
+    Общий для потоков и event loop процесса.
+    """
+    VIRTUAL_NODES = 64
+
+    def __init__(self, urls: List[str], routing: str = OLLAMA_ROUTING,
+                 failure_threshold: int = OLLAMA_BREAKER_FAILURES, reset_seconds: float = OLLAMA_BREAKER_RESET_SECONDS):
+        if routing not in ("least_outstanding", "model_hash"):
+            raise ValueError(f"Неизвестный OLLAMA_ROUTING: {routing}")
+        self.backends = [Backend(url) for url in urls]
+        self.routing = routing
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self._turn = 0
+        self._ring = sorted((_ring_hash(f"{backend.url}#{i}"), position)
+                            for position, backend in enumerate(self.backends) for i in range(self.VIRTUAL_NODES))
+        self._health_thread = None
+
+    def _available(self, backend: Backend, now: float) -> bool:
+        if backend.failures < self.failure_threshold:
+            return True
+        return now >= backend.open_until and not backend.probing
+
+    def acquire(self, model: Optional[str] = None, exclude=()) -> Backend:
+        """
+        Выбирает сервер для запроса; после запроса обязательно вызвать release().
+        exclude — серверы, уже не ответившие на этот запрос.
+        """
+        with self.lock:
+            now = time.monotonic()
+            candidates = [backend for backend in self.backends if backend not in exclude] or self.backends
+            candidates = [backend for backend in candidates if self._available(backend, now)] or candidates
+            if self.routing == "model_hash":
+                backend = self._by_hash(model or "", candidates)
+            else:
+                self._turn += 1
+                # При равной загрузке — по кругу
+                backend = min(candidates, key=lambda b: (b.outstanding, (self.backends.index(b) - self._turn) % len(self.backends)))
+            if backend.failures >= self.failure_threshold:
+                backend.probing = True
+            backend.outstanding += 1
+            return backend
+
+    def _by_hash(self, key: str, candidates: List[Backend]) -> Backend:
+        start = bisect.bisect(self._ring, (_ring_hash(key), len(self.backends)))
+        for offset in range(len(self._ring)):
+            backend = self.backends[self._ring[(start + offset) % len(self._ring)][1]]
+            if backend in candidates:
+                return backend
+        return candidates[0]
+
+    def release(self, backend: Backend, endpoint: str, duration: float, ok: bool):
+        """
+        Учитывает результат запроса: задержка в гистограмме сервера и состояние предохранителя.
+        """
+        with self.lock:
+            backend.outstanding -= 1
+            backend.probing = False
+            opened = self._record(backend, ok)
+        if opened:
+            logging.warning(f"Сервер Ollama {backend.url} отключен на {self.reset_seconds:.0f} с после "
+                            f"{backend.failures} ошибок подряд")
+        metrics.observe_histogram("ollama_request_seconds", duration, backend=backend.url, endpoint=endpoint)
+        metrics.incr("ollama_requests", backend=backend.url, result="ok" if ok else "error")
+
+    def _record(self, backend: Backend, ok: bool) -> bool:
+        if ok:
+            backend.failures = 0
+            return False
+        backend.failures += 1
+        if backend.failures >= self.failure_threshold:
+            backend.open_until = time.monotonic() + self.reset_seconds
+            return True
+        return False
+
+    def check_health(self, timeout: float = OLLAMA_CONNECT_TIMEOUT):
+        """
+        Опрашивает /api/version каждого сервера: недоступный отключается сразу,
+        ответивший снова принимает запросы.
+        """
+        for backend in self.backends:
+            try:
+                requests.get(f"{backend.url}/version", timeout=timeout).raise_for_status()
+                ok = True
+            except requests.exceptions.RequestException:
+                ok = False
+            with self.lock:
+                was_open = backend.failures >= self.failure_threshold
+                if ok:
+                    backend.failures = 0
+                else:
+                    backend.failures = max(backend.failures + 1, self.failure_threshold)
+                    backend.open_until = time.monotonic() + self.reset_seconds
+            if not ok and not was_open:
+                logging.warning(f"Сервер Ollama {backend.url} не отвечает на проверку, отключен")
+            elif ok and was_open:
+                logging.info(f"Сервер Ollama {backend.url} снова доступен")
+
+    def start_health_checks(self, interval: float = OLLAMA_HEALTH_CHECK_SECONDS):
+        """
+        Запускает фоновые проверки раз в interval секунд (если серверов больше одного).
+        """
+        if len(self.backends) < 2 or self._health_thread is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                self.check_health()
+
+        self._health_thread = threading.Thread(target=run, daemon=True, name="ollama-health")
+        self._health_thread.start()
+
+def _ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+def _is_backend_failure(error: Exception) -> bool:
+    """
+    Ошибка сервера, а не запроса: соединение, таймаут, 5xx. После нее запрос можно
+    отправить на другой сервер, кроме таймаута чтения (генерация уже шла).
+    """
+    if isinstance(error, (requests.exceptions.HTTPError, httpx.HTTPStatusError)):
+        return error.response is not None and error.response.status_code >= 500
+    return isinstance(error, (requests.exceptions.RequestException, httpx.HTTPError))
+
+def _can_fail_over(error: Exception) -> bool:
+    if isinstance(error, (requests.exceptions.HTTPError, httpx.HTTPStatusError)):
+        return error.response is not None and error.response.status_code in AsyncOllamaClient.RETRY_STATUSES
+    return isinstance(error, (requests.exceptions.ConnectionError, httpx.ConnectError))
+
+_router: Optional[OllamaRouter] = None
+
+def get_ollama_router() -> OllamaRouter:
+    """
+    Возвращает общий для процесса OllamaRouter по OLLAMA_HOSTS с фоновыми проверками.
+    """
+    global _router
+    if _router is None:
+        _router = OllamaRouter(OLLAMA_API_BASE_URLS)
+        _router.start_health_checks()
+    return _router
+
+class OllamaClient:
+    """
+    Клиент Ollama с общим пулом keep-alive соединений (requests.Session),
+    таймаутами для каждой операции и повторами с экспоненциальной задержкой.
+    Сервер для каждого запроса выбирает OllamaRouter; base_url — один заданный сервер.
+    """
+    def __init__(self, base_url: Optional[str] = None, pool_size: int = OLLAMA_POOL_SIZE,
+                 max_retries: int = OLLAMA_MAX_RETRIES, backoff_factor: float = OLLAMA_BACKOFF_FACTOR,
+                 router: Optional[OllamaRouter] = None):
+        self.router = router or (OllamaRouter([base_url]) if base_url else get_ollama_router())
+        # Повторяем только ошибки соединения и 502/503/504: повтор после таймаута
+        # чтения заново запустил бы уже потраченную генерацию.
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=0,
+            status=max_retries,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(["GET", "POST"]),
+            backoff_factor=backoff_factor,
+            raise_on_status=False,
+        )
+        # Соединения хранятся по серверам: pool_connections — число серверов
+        adapter = HTTPAdapter(pool_connections=len(self.router.backends), pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Content-Type": "application/json"})
+
+    def post(self, endpoint: str, payload: dict, operation: str) -> dict:
+        """
+        Отправляет POST на /api/<endpoint> и возвращает JSON ответа.
+        Если сервер недоступен, запрос отправляется на следующий.
+        Бросает requests.exceptions.RequestException при ошибке.
+        """
+        timeout = (OLLAMA_CONNECT_TIMEOUT, OLLAMA_TIMEOUTS[operation])
+        failed = []
+        while True:
+            backend = self.router.acquire(payload.get("model"), exclude=failed)
+            started = time.monotonic()
+            try:
+                response = self.session.post(f"{backend.url}/{endpoint}", data=json.dumps(payload), timeout=timeout)
+                response.raise_for_status() # Вызывает исключение для HTTP ошибок
+                result = response.json()
+            except requests.exceptions.RequestException as e:
+                self.router.release(backend, endpoint, time.monotonic() - started, ok=not _is_backend_failure(e))
+                failed.append(backend)
+                if not _can_fail_over(e) or len(failed) >= len(self.router.backends):
+                    raise
+                logging.warning(f"Сервер Ollama {backend.url} недоступен ({e}), запрос отправлен на другой")
+                continue
+            self.router.release(backend, endpoint, time.monotonic() - started, ok=True)
+            return result
+
+    def stream(self, endpoint: str, payload: dict, operation: str):
+        """
+        Отправляет POST на /api/<endpoint> с "stream": true и выдает объекты NDJSON по мере поступления.
+        Закрытие генератора закрывает соединение, и Ollama прекращает генерацию.
+        """
+        timeout = (OLLAMA_CONNECT_TIMEOUT, OLLAMA_TIMEOUTS[operation])
+        backend = self.router.acquire(payload.get("model"))
+        started = time.monotonic()
+        ok = True
+        try:
+            response = self.session.post(f"{backend.url}/{endpoint}", data=json.dumps(payload), timeout=timeout,
+                                         stream=True)
+            try:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if line:
+                        yield json.loads(line)
+            finally:
+                response.close()
+        except requests.exceptions.RequestException as e:
+            ok = not _is_backend_failure(e)
+            raise
+        finally:
+            self.router.release(backend, endpoint, time.monotonic() - started, ok)
+
+class AsyncOllamaClient:
+    """
+    Асинхронный вариант OllamaClient на httpx.AsyncClient: тот же пул соединений,
+    таймауты, повторы и выбор сервера через OllamaRouter, но запросы не блокируют
+    поток. Создается и используется внутри одного event loop.
+    """
+    RETRY_STATUSES = (502, 503, 504)
+
+    def __init__(self, base_url: Optional[str] = None, pool_size: int = OLLAMA_POOL_SIZE,
+                 max_retries: int = OLLAMA_MAX_RETRIES, backoff_factor: float = OLLAMA_BACKOFF_FACTOR,
+                 router: Optional[OllamaRouter] = None):
+        self.router = router or (OllamaRouter([base_url]) if base_url else get_ollama_router())
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            headers={"Content-Type": "application/json"},
+        )
+
+    async def post(self, endpoint: str, payload: dict, operation: str) -> dict:
+        """
+        Отправляет POST на /api/<endpoint> и возвращает JSON ответа.
+        Бросает httpx.HTTPError при ошибке.
+        """
+        timeout = httpx.Timeout(OLLAMA_TIMEOUTS[operation], connect=OLLAMA_CONNECT_TIMEOUT)
+        failed = []
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            backend = self.router.acquire(payload.get("model"), exclude=failed)
+            started = time.monotonic()
+            try:
+                response = await self.client.post(f"{backend.url}/{endpoint}", content=json.dumps(payload),
+                                                  timeout=timeout)
+                response.raise_for_status()
+                result = response.json()
+            except httpx.HTTPError as e:
+                self.router.release(backend, endpoint, time.monotonic() - started, ok=not _is_backend_failure(e))
+                if not _can_fail_over(e) or last_attempt:
+                    raise
+                # Следующая попытка — на другом сервере, если он есть
+                failed.append(backend)
+            else:
+                self.router.release(backend, endpoint, time.monotonic() - started, ok=True)
+                return result
+            await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+
+    async def stream(self, endpoint: str, payload: dict, operation: str):
+        """
+        Асинхронный вариант OllamaClient.stream (без повторов: поток нельзя повторить с середины).
+        """
+        timeout = httpx.Timeout(OLLAMA_TIMEOUTS[operation], connect=OLLAMA_CONNECT_TIMEOUT)
+        backend = self.router.acquire(payload.get("model"))
+        started = time.monotonic()
+        ok = True
+        try:
+            async with self.client.stream("POST", f"{backend.url}/{endpoint}", content=json.dumps(payload),
+                                          timeout=timeout) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if line:
+                        yield json.loads(line)
+        except httpx.HTTPError as e:
+            ok = not _is_backend_failure(e)
+            raise
+        finally:
+            self.router.release(backend, endpoint, time.monotonic() - started, ok)
+
+    async def aclose(self):
+        await self.client.aclose()
+
+_client: Optional[OllamaClient] = None
+
+def get_ollama_client() -> OllamaClient:
+    """
+    Возвращает общий для процесса OllamaClient.
+    """
+    global _client
+    if _client is None:
+        _client = OllamaClient()
+    return _client
+
+def _embedding_cache_lookup(texts: List[str], model: str):
+    """
+    Нормализует тексты и достает из кэша уже известные эмбеддинги.
+    Возвращает (texts, vectors, missing): missing — уникальные тексты без эмбеддинга.
+    """
+    texts = [normalize_text(text) for text in texts]
+    vectors = get_embedding_cache().get_many(model, texts)
+    missing = list(dict.fromkeys(text for text, vector in zip(texts, vectors) if vector is None))
+    return texts, vectors, missing
+
+def _embedding_cache_fill(texts: List[str], vectors: list, model: str, embedded: dict) -> np.ndarray:
+    """
+    Сохраняет новые эмбеддинги в кэш и собирает итоговую матрицу float32.
+    """
+    get_embedding_cache().set_many(model, list(embedded), list(embedded.values()))
+    vectors = [embedded[text] if vector is None else vector for text, vector in zip(texts, vectors)]
+    if not vectors:
+        return np.zeros((0, 0), dtype=np.float32)
+    return np.vstack(vectors).astype(np.float32)
+
+def get_embeddings_ollama(texts: List[str], model: str) -> Optional[np.ndarray]:
+    """
+    Получает эмбеддинги для списка текстов через /api/embed (массив в поле input),
+    по OLLAMA_EMBED_BATCH_SIZE текстов за запрос. Уже встречавшиеся тексты берутся
+    из кэша эмбеддингов и в Ollama не отправляются.
+    Возвращает матрицу float32 формы (len(texts), dimension) или None при ошибке.
+    """
+    texts, vectors, missing = _embedding_cache_lookup(texts, model)
+    embedded = {}
+    for start in range(0, len(missing), OLLAMA_EMBED_BATCH_SIZE):
+        batch = missing[start:start + OLLAMA_EMBED_BATCH_SIZE]
+        data = {
+            "model": model,
+            "input": batch
+        }
+        try:
+            result = get_ollama_client().post("embed", data, operation="embed")["embeddings"]
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Ошибка при получении эмбеддингов от Ollama (модель: {model}, текстов: {len(batch)}): {e}")
+            return None
+        embedded.update(zip(batch, np.asarray(result, dtype=np.float32)))
+    return _embedding_cache_fill(texts, vectors, model, embedded)
 
 def get_embedding_ollama(text: str, model: str) -> Optional[List[float]]:
     """
     Получает эмбеддинг для заданного текста с помощью Ollama.
     Предполагается, что сервер Ollama запущен, и модель скачана.
     """
-    url = f"{OLLAMA_API_BASE_URL}/embeddings"
-    headers = {"Content-Type": "application/json"}
-    data = {
-        "model": model,
-        "prompt": text
-    }
-    try:
-        response = requests.post(url, headers=headers, data=json.dumps(data), timeout=30)
-        response.raise_for_status() # Вызывает исключение для HTTP ошибок
-        return response.json()["embedding"]
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Ошибка при получении эмбеддинга от Ollama (модель: {model}): {e}")
+    # Тот же эндпоинт /api/embed, что и при построении индекса: он возвращает
+    # нормализованные векторы, и расстояния запроса и базы знаний сопоставимы.
+    embeddings = get_embeddings_ollama([text], model)
+    if embeddings is None or len(embeddings) == 0:
         return None
+    return embeddings[0].tolist()
 
-def classify_email(text: str, model: str) -> bool:
+# Постоянные системные промпты: они не зависят от письма и передаются в /api/chat
+# байт в байт одинаковыми, поэтому Ollama переиспользует их KV-кэш и заново
+# обрабатывает (prefill) только сообщение с письмом. Не подставляйте в них
+# изменяемые данные.
+CLASSIFY_SYSTEM_PROMPT = (
+    "Ты — высокоточный классификатор электронных писем для службы поддержки "
+    "интернет-магазина по продаже одежды. Твоя задача — определить, относится ли "
+    "письмо *строго* к одной из следующих тем: заказы, доставка, возврат, обмен, "
+    "качество одежды, размеры, оплата, наличие товара, ассортимент, работа сайта магазина. "
+    "Если письмо не относится *напрямую* к этим темам интернет-магазина одежды, "
+    "оно считается нерелевантным. "
+    "Отвечай JSON-объектом с полями relevant (true — ДА, письмо относится к этим темам; "
+    "false — НЕТ) и confidence (насколько ты уверен, число от 0 до 1). "
+    "Не добавляй никаких объяснений.\n"
+    "---"
+    "\nПримеры релевантных писем (Ответ: ДА):\n"
+    "Вопрос: 'Мой заказ #12345 не пришел. Что мне делать?'\nОтвет: ДА\n"
+    "Вопрос: 'Я не могу войти в свой аккаунт, помогите!'\nОтвет: ДА\n"
+    "Вопрос: 'Привет, я нашел ошибку на вашем сайте с отображением товаров.'\nОтвет: ДА\n"
+    "Вопрос: 'Как оформить возврат футболки?'\nОтвет: ДА\n"
+    "Вопрос: 'Какой размер мне выбрать для джинсов, если мои параметры 90-70-98?'\nОтвет: ДА\n"
+    "Вопрос: 'Хочу узнать, есть ли еще в наличии та красная куртка?'\nОтвет: ДА\n"
+    "\nПримеры нерелевантных писем (Ответ: НЕТ):\n"
+    "Вопрос: 'Получите скидку 20% на следующую покупку!'\nОтвет: НЕТ\n"
+    "Вопрос: 'Уведомление: Ваш пароль был изменен. Если это были не вы, свяжитесь с нами.'\nОтвет: НЕТ\n"
+    "Вопрос: 'Подтвердите подписку на нашу рассылку.'\nОтвет: НЕТ\n"
+    "Вопрос: 'Пожалуйста, отпишите меня от рассылки.'\nОтвет: НЕТ\n"
+    "Вопрос: 'Спасибо за ваш недавний платеж.'\nОтвет: НЕТ\n"
+    "Вопрос: 'Ваш заказ #67890 отправлен.' (Это уведомление, а не запрос)\nОтвет: НЕТ\n"
+    "Вопрос: 'Проблема с подключением к Wi-Fi.'\nОтвет: НЕТ\n"
+    "Вопрос: 'Бронирование на 20 июля.'\nОтвет: НЕТ\n"
+    "Вопрос: 'Вопрос по учебной программе.'\nОтвет: НЕТ"
+)
+
+GENERATE_SYSTEM_PROMPT = (
+    "Ты — дружелюбный, профессиональный и полезный агент службы поддержки "
+    "клиентов интернет-магазина по продаже одежды. "
+    "Твоя задача — формировать полные и исчерпывающие ответы на вопросы клиентов, "
+    "основываясь ТОЛЬКО на предоставленной 'Информации из базы знаний' и 'Вопросе клиента'. "
+    "Не придумывай информацию, не домысливай и не добавляй лишних деталей, которых нет "
+    "в предоставленных источниках. "
+    "Используй информацию из базы знаний как основной источник для ответа, "
+    "максимально перефразируя ее, если необходимо, но сохраняя точный смысл. "
+    "Информация из базы знаний может содержать несколько пар 'Вопрос/Ответ': используй все, "
+    "что относится к письму, и ответь на каждую часть вопроса клиента в одном письме. "
+    "Если предоставленной информации из базы знаний недостаточно для полного ответа "
+    "на весь вопрос клиента, извинись и вежливо предложи связаться с ними другим способом "
+    "(например, по телефону, через чат на сайте или отправить полную информацию по их запросу), "
+    "или пообещай, что специалисты свяжутся с ними позже. "
+    "Никогда не упоминай, что информация взята из базы знаний, или что ты ИИ. "
+    "Сохраняй тон вежливым, профессиональным и полезным. "
+    "Начинай ответ с приветствия, например 'Здравствуйте, ...' или 'Добрый день, ...'. "
+    "Заканчивай ответ дружелюбным предложением дальнейшей помощи или благодарностью."
+)
+
+# Структурированный ответ классификатора (Ollama "format": JSON-схема)
+CLASSIFY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "relevant": {"type": "boolean"},
+        "confidence": {"type": "number", "minimum": 0, "maximum": 1},
+    },
+    "required": ["relevant", "confidence"],
+}
+
+def _build_classify_request(text: str, model: str) -> dict:
     """
-    Классифицирует электронное письмо: является ли оно запросом в поддержку
-    интернет-магазина одежды.
-    Возвращает True, если релевантно, False в противном случае.
-    """
-    # Улучшенный промпт для классификации, с четким указанием темы магазина одежды
-    prompt = (
-        f"Ты — высокоточный классификатор электронных писем для службы поддержки "
-        f"интернет-магазина по продаже одежды. Твоя задача — определить, относится ли "
-        f"письмо *строго* к одной из следующих тем: заказы, доставка, возврат, обмен, "
-        f"качество одежды, размеры, оплата, наличие товара, ассортимент, работа сайта магазина. "
-        f"Если письмо не относится *напрямую* к этим темам интернет-магазина одежды, "
-        f"оно считается нерелевантным. "
-        f"Отвечай только одним словом: 'ДА' или 'НЕТ'. Не добавляй никаких объяснений, "
-        f"знаков препинания или других символов.\n"
-        f"---"
-        f"\nПримеры релевантных писем (Ответ: ДА):\n"
-        f"Вопрос: 'Мой заказ #12345 не пришел. Что мне делать?'\nОтвет: ДА\n"
-        f"Вопрос: 'Я не могу войти в свой аккаунт, помогите!'\nОтвет: ДА\n"
-        f"Вопрос: 'Привет, я нашел ошибку на вашем сайте с отображением товаров.'\nОтвет: ДА\n"
-        f"Вопрос: 'Как оформить возврат футболки?'\nОтвет: ДА\n"
-        f"Вопрос: 'Какой размер мне выбрать для джинсов, если мои параметры 90-70-98?'\nОтвет: ДА\n"
-        f"Вопрос: 'Хочу узнать, есть ли еще в наличии та красная куртка?'\nОтвет: ДА\n"
-        f"\nПримеры нерелевантных писем (Ответ: НЕТ):\n"
-        f"Вопрос: 'Получите скидку 20% на следующую покупку!'\nОтвет: НЕТ\n"
-        f"Вопрос: 'Уведомление: Ваш пароль был изменен. Если это были не вы, свяжитесь с нами.'\nОтвет: НЕТ\n"
-        f"Вопрос: 'Подтвердите подписку на нашу рассылку.'\nОтвет: НЕТ\n"
-        f"Вопрос: 'Пожалуйста, отпишите меня от рассылки.'\nОтвет: НЕТ\n"
-        f"Вопрос: 'Спасибо за ваш недавний платеж.'\nОтвет: НЕТ\n"
-        f"Вопрос: 'Ваш заказ #67890 отправлен.' (Это уведомление, а не запрос)\nОтвет: НЕТ\n"
-        f"Вопрос: 'Проблема с подключением к Wi-Fi.'\nОтвет: НЕТ\n"
-        f"Вопрос: 'Бронирование на 20 июля.'\nОтвет: НЕТ\n"
-        f"Вопрос: 'Вопрос по учебной программе.'\nОтвет: НЕТ\n"
-        f"---"
-        f"\nАнализируемое письмо: '{text}'\nОтвет:"
-    )
-    url = f"{OLLAMA_API_BASE_URL}/generate"
-    headers = {"Content-Type": "application/json"}
-    data = {
+    Собирает тело запроса /api/chat для классификации письма.
+    """
+    return {
         "model": model,
-        "prompt": prompt,
+        "messages": [
+            {"role": "system", "content": CLASSIFY_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Анализируемое письмо: '{text}'"},
+        ],
         "stream": False,
+        "format": CLASSIFY_SCHEMA,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
         "options": {
             "temperature": 0.05, # Уменьшаем креативность еще больше для очень точной классификации
-            "top_p": 0.9
+            "top_p": 0.9,
+            "num_predict": 32 # {"relevant": true, "confidence": 0.95} — около 15 токенов
         }
     }
+
+class Classification:
+    """
+    Решение классификатора писем.
+
+    status — RELEVANT, IRRELEVANT, NEEDS_REVIEW: ни одна модель каскада не
+    ответила однозначно с уверенностью не ниже CLASSIFY_MIN_CONFIDENCE (такое
+    письмо не игнорируется, а остается непрочитанным для сотрудника) или ERROR:
+    последняя модель каскада недоступна (ошибка запроса), письмо нужно обработать повторно.
+    confidence — уверенность модели (0..1, None для ответа без оценки), model — какая модель ответила.
+    """
+    RELEVANT = "relevant"
+    IRRELEVANT = "irrelevant"
+    NEEDS_REVIEW = "needs_review"
+    ERROR = "error"
+
+    def __init__(self, status: str, confidence: Optional[float] = None, model: Optional[str] = None):
+        self.status = status
+        self.confidence = confidence
+        self.model = model
+
+    @property
+    def relevant(self) -> bool:
+        return self.status == self.RELEVANT
+
+    def __repr__(self):
+        return f"Classification({self.status!r}, confidence={self.confidence!r}, model={self.model!r})"
+
+def _parse_classification(generated_text: str) -> Tuple[Optional[bool], Optional[float]]:
+    """
+    Разбирает ответ классификатора в (relevant, confidence). Кроме JSON по CLASSIFY_SCHEMA
+    принимает ровно "ДА"/"НЕТ" (модели без поддержки format) — без оценки уверенности.
+    (None, None), если ответ неоднозначен.
+    """
+    logging.info(f"Ollama классифицировал письмо как: '{generated_text.strip()}'")
     try:
-        response = requests.post(url, headers=headers, data=json.dumps(data), timeout=30)
-        response.raise_for_status()
-        generated_text = response.json()["response"].strip().upper() # Приводим к верхнему регистру для надежности
-        logging.info(f"Ollama классифицировал письмо как: '{generated_text}'")
+        answer = json.loads(generated_text)
+    except ValueError:
+        answer = None
+    if isinstance(answer, dict) and isinstance(answer.get("relevant"), bool):
+        confidence = answer.get("confidence")
+        if isinstance(confidence, (int, float)) and not isinstance(confidence, bool):
+            return answer["relevant"], min(max(float(confidence), 0.0), 1.0)
+        return answer["relevant"], None
 
-        if generated_text == "ДА": # Уточняем проверку, чтобы было ровно "ДА"
-            return True
-        elif generated_text == "НЕТ": # Уточняем проверку, чтобы было ровно "НЕТ"
-            return False
-        else: # Если LLM ответил неоднозначно (не "ДА" и не "НЕТ"), считаем нерелевантным
-            logging.warning(f"Классификация неоднозначна для письма. Ответ LLM: '{generated_text}'. Считаем нерелевантным.")
-            return False
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Ошибка при классификации письма с помощью Ollama (модель: {model}): {e}")
-        return False
+    generated_text = generated_text.strip().upper() # Приводим к верхнему регистру для надежности
+    if generated_text == "ДА": # Уточняем проверку, чтобы было ровно "ДА"
+        return True, None
+    elif generated_text == "НЕТ": # Уточняем проверку, чтобы было ровно "НЕТ"
+        return False, None
+    logging.warning(f"Классификация неоднозначна для письма. Ответ LLM: '{generated_text}'.")
+    return None, None
 
-def generate_response_ollama(email_text: str, knowledge_base_answer: str, model: str) -> Optional[str]:
+def _classification_tiers(model: str, fallback_model: Optional[str]) -> List[Tuple[str, str]]:
     """
-    Генерирует профессиональный, понятный и вежливый ответ с помощью Ollama,
-    действуя как агент поддержки интернет-магазина одежды и используя информацию из базы знаний.
+    Каскад моделей классификации: [(уровень, модель), ...].
     """
-    prompt = (
-        f"Ты — дружелюбный, профессиональный и полезный агент службы поддержки "
-        f"клиентов интернет-магазина по продаже одежды. "
-        f"Твоя задача — формировать полные и исчерпывающие ответы на вопросы клиентов, "
-        f"основываясь ТОЛЬКО на предоставленной 'Информации из базы знаний' и 'Вопросе клиента'. "
-        f"Не придумывай информацию, не домысливай и не добавляй лишних деталей, которых нет "
-        f"в предоставленных источниках. "
-        f"Используй информацию из базы знаний как основной источник для ответа, "
-        f"максимально перефразируя ее, если необходимо, но сохраняя точный смысл. "
-        f"Если предоставленной информации из базы знаний недостаточно для полного ответа "
-        f"на весь вопрос клиента, извинись и вежливо предложи связаться с ними другим способом "
-        f"(например, по телефону, через чат на сайте или отправить полную информацию по их запросу), "
-        f"или пообещай, что специалисты свяжутся с ними позже. "
-        f"Никогда не упоминай, что информация взята из базы знаний, или что ты ИИ. "
-        f"Сохраняй тон вежливым, профессиональным и полезным. "
-        f"Начинай ответ с приветствия, например 'Здравствуйте, ...' или 'Добрый день, ...'. "
-        f"Заканчивай ответ дружелюбным предложением дальнейшей помощи или благодарностью.\n"
-        f"\n---"
-        f"\nВопрос клиента:\n\"{email_text}\"\n"
+    tiers = [("primary", model)]
+    if fallback_model and fallback_model != model:
+        tiers.append(("fallback", fallback_model))
+    return tiers
+
+def _tier_decision(tier: str, model: str, content: Optional[str], min_confidence: float) -> Optional[Classification]:
+    """
+    Решение одной модели каскада или None, если нужно спросить следующую
+    (запрос не удался, ответ неоднозначен или уверенность ниже min_confidence).
+    """
+    if content is None:
+        result, decision = "error", None
+    else:
+        relevant, confidence = _parse_classification(content)
+        if relevant is None:
+            result, decision = "ambiguous", None
+        elif confidence is not None and confidence < min_confidence:
+            result, decision = "low_confidence", None
+        else:
+            status = Classification.RELEVANT if relevant else Classification.IRRELEVANT
+            result, decision = "decided", Classification(status, confidence, model)
+    metrics.incr("classification_requests", tier=tier, model=model, result=result)
+    return decision
+
+def _undecided(model: str, failed: bool) -> Classification:
+    """
+    Итог каскада без решения: ERROR, если последняя модель не ответила из-за ошибки
+    запроса (сбой Ollama не должен отправлять письма сотруднику), иначе NEEDS_REVIEW.
+    """
+    if failed:
+        logging.error("Письмо не классифицировано: Ollama недоступна, письмо будет обработано повторно.")
+        return Classification(Classification.ERROR, model=model)
+    logging.warning("Письмо не удалось уверенно классифицировать, оно оставлено для сотрудника.")
+    return Classification(Classification.NEEDS_REVIEW, model=model)
+
+def classify_email(text: str, model: str, fallback_model: Optional[str] = None,
+                   min_confidence: float = CLASSIFY_MIN_CONFIDENCE) -> Classification:
+    """
+    Классифицирует электронное письмо: является ли оно запросом в поддержку
+    интернет-магазина одежды.
+    Сначала спрашивает model (маленькую модель); если ее ответ неоднозначен, уверенность
+    ниже min_confidence или запрос не удался, письмо классифицирует fallback_model
+    (большая модель). Если не решила и она — Classification.NEEDS_REVIEW,
+    если ее запрос не удался — Classification.ERROR.
+    """
+    for tier, current_model in _classification_tiers(model, fallback_model):
+        data = _build_classify_request(text, current_model)
+        try:
+            content = get_ollama_client().post("chat", data, operation="classify")["message"]["content"]
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Ошибка при классификации письма с помощью Ollama (модель: {current_model}): {e}")
+            content = None
+        decision = _tier_decision(tier, current_model, content, min_confidence)
+        if decision is not None:
+            return decision
+    return _undecided(current_model, failed=content is None)
+
+GENERATION_ERROR_REPLY = "Извините, произошла техническая ошибка при генерации ответа. Наши специалисты свяжутся с вами в ближайшее время."
+
+def _build_generate_request(email_text: str, knowledge_base_answer: str, model: str, stream: bool = False) -> dict:
+    """
+    Собирает тело запроса /api/chat для ответа клиенту.
+    knowledge_base_answer — контекст из базы знаний (см. rag_service.pack_context).
+    stream=True — потоковый запрос с лимитом GENERATE_MAX_TOKENS и маркером конца ответа.
+    """
+    user_message = (
+        f"Вопрос клиента:\n\"{email_text}\"\n"
         f"\nИнформация из базы знаний:\n\"{knowledge_base_answer}\"\n"
         f"\n---"
         f"\nСгенерируй ответ:"
     )
-    url = f"{OLLAMA_API_BASE_URL}/generate"
-    headers = {"Content-Type": "application/json"}
-    data = {
+    request = {
         "model": model,
-        "prompt": prompt,
+        "messages": [
+            {"role": "system", "content": GENERATE_SYSTEM_PROMPT},
+            {"role": "user", "content": user_message},
+        ],
         "stream": False,
+        "keep_alive": OLLAMA_KEEP_ALIVE,
         "options": {
             "temperature": 0.4, # Слегка снижаем креативность для большей строгости
             "top_p": 0.9,
             "num_predict": 2048
         }
     }
+    if stream:
+        request["stream"] = True
+        # Ollama сама остановится на лимите токенов и на маркере
+        request["options"]["num_predict"] = GENERATE_MAX_TOKENS
+        if GENERATE_STOP_MARKER:
+            request["options"]["stop"] = [GENERATE_STOP_MARKER]
+    return request
+
+def _trim_to_sentence(text: str) -> str:
+    """
+    Обрезает текст по концу последнего законченного предложения.
+    """
+    end = max(text.rfind(mark) for mark in ".!?")
+    return text[:end + 1] if end >= 0 else ""
+
+class GenerationStream:
+    """
+    Собирает ответ из потока /api/chat и следит за бюджетами: время с начала
+    запроса (max_seconds), число токенов (max_tokens) и маркер конца ответа.
+    feed() возвращает False, когда чтение нужно прекратить; result() возвращает
+    ответ и записывает метрики: время до первого токена, токенов в секунду и
+    причину остановки (generation_stops).
+    """
+
+    def __init__(self, model: str, max_seconds: float = GENERATE_MAX_SECONDS, max_tokens: int = GENERATE_MAX_TOKENS,
+                 stop_marker: str = GENERATE_STOP_MARKER):
+        self.model = model
+        self.max_seconds = max_seconds
+        self.max_tokens = max_tokens
+        self.stop_marker = stop_marker
+        self.started = time.monotonic()
+        self.first_token_at = None
+        self.text = ""
+        self.tokens = 0
+        self.eval_rate = None
+        self.stop_reason = None
+
+    def feed(self, chunk: dict) -> bool:
+        if "error" in chunk:
+            logging.error(f"Ollama прервала генерацию (модель: {self.model}): {chunk['error']}")
+            self.stop_reason = "error"
+            return False
+        piece = chunk.get("message", {}).get("content", "")
+        if piece:
+            if self.first_token_at is None:
+                self.first_token_at = time.monotonic()
+            self.text += piece
+            self.tokens += 1
+        if chunk.get("done"):
+            self.stop_reason = "token_budget" if chunk.get("done_reason") == "length" else "done"
+            if chunk.get("eval_count") and chunk.get("eval_duration"):
+                self.eval_rate = chunk["eval_count"] / (chunk["eval_duration"] / 1e9)
+            return False
+        if self.stop_marker and self.stop_marker in self.text:
+            self.stop_reason = "stop_marker"
+        elif self.tokens >= self.max_tokens:
+            self.stop_reason = "token_budget"
+        elif time.monotonic() - self.started >= self.max_seconds:
+            self.stop_reason = "time_budget"
+        return self.stop_reason is None
+
+    def result(self) -> str:
+        now = time.monotonic()
+        reason = self.stop_reason or "error" # Поток оборвался без done
+        metrics.incr("generation_stops", reason=reason)
+        if self.first_token_at is not None:
+            metrics.observe("generation_time_to_first_token_seconds", self.first_token_at - self.started, model=self.model)
+            rate = self.eval_rate
+            if rate is None and now > self.first_token_at:
+                rate = self.tokens / (now - self.first_token_at)
+            if rate is not None:
+                metrics.observe("generation_tokens_per_second", rate, model=self.model)
+
+        text = self.text.split(self.stop_marker)[0] if self.stop_marker else self.text
+        if reason in ("token_budget", "time_budget"):
+            # Ответ на полуслове клиенту не отправляем
+            text = _trim_to_sentence(text)
+        elif reason not in ("done", "stop_marker"):
+            text = ""
+        text = text.strip()
+        if not text and reason not in ("done", "stop_marker"):
+            logging.warning(f"Генерация остановлена ({reason}) через {now - self.started:.1f} с, "
+                            f"токенов: {self.tokens}")
+        return text if text else GENERATION_ERROR_REPLY
+
+def generate_response_ollama(email_text: str, knowledge_base_answer: str, model: str) -> Optional[str]:
+    """
+    Генерирует профессиональный, понятный и вежливый ответ с помощью Ollama,
+    действуя как агент поддержки интернет-магазина одежды и используя информацию из базы знаний.
+    """
+    if OLLAMA_GENERATE_STREAM:
+        return _generate_streaming(email_text, knowledge_base_answer, model)
+    data = _build_generate_request(email_text, knowledge_base_answer, model)
     try:
-        response = requests.post(url, headers=headers, data=json.dumps(data), timeout=30)
-        response.raise_for_status()
-        return response.json()["response"].strip()
+        return get_ollama_client().post("chat", data, operation="generate")["message"]["content"].strip()
     except requests.exceptions.RequestException as e:
         logging.error(f"Ошибка при генерации ответа с помощью Ollama (модель: {model}): {e}")
-        return "Извините, произошла техническая ошибка при генерации ответа. Наши специалисты свяжутся с вами в ближайшее время."
\ No newline at end of file
+        return GENERATION_ERROR_REPLY
+
+def _generate_streaming(email_text: str, knowledge_base_answer: str, model: str) -> str:
+    """
+    Потоковый вариант generate_response_ollama с бюджетами GenerationStream.
+    """
+    data = _build_generate_request(email_text, knowledge_base_answer, model, stream=True)
+    generation = GenerationStream(model)
+    try:
+        with contextlib.closing(get_ollama_client().stream("chat", data, operation="generate")) as chunks:
+            for chunk in chunks:
+                if not generation.feed(chunk):
+                    break
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Ошибка при генерации ответа с помощью Ollama (модель: {model}): {e}")
+    return generation.result()
+
+async def get_embeddings_ollama_async(client: AsyncOllamaClient, texts: List[str], model: str) -> Optional[np.ndarray]:
+    """
+    Асинхронный вариант get_embeddings_ollama. Кэш эмбеддингов (Redis) читается
+    и пополняется в пуле потоков, чтобы не блокировать event loop.
+    """
+    loop = asyncio.get_running_loop()
+    texts, vectors, missing = await loop.run_in_executor(None, _embedding_cache_lookup, texts, model)
+    embedded = {}
+    for start in range(0, len(missing), OLLAMA_EMBED_BATCH_SIZE):
+        batch = missing[start:start + OLLAMA_EMBED_BATCH_SIZE]
+        data = {
+            "model": model,
+            "input": batch
+        }
+        try:
+            result = (await client.post("embed", data, operation="embed"))["embeddings"]
+        except httpx.HTTPError as e:
+            logging.error(f"Ошибка при получении эмбеддингов от Ollama (модель: {model}, текстов: {len(batch)}): {e}")
+            return None
+        embedded.update(zip(batch, np.asarray(result, dtype=np.float32)))
+    return await loop.run_in_executor(None, _embedding_cache_fill, texts, vectors, model, embedded)
+
+async def classify_email_async(client: AsyncOllamaClient, text: str, model: str, fallback_model: Optional[str] = None,
+                               min_confidence: float = CLASSIFY_MIN_CONFIDENCE) -> Classification:
+    """
+    Асинхронный вариант classify_email.
+    """
+    for tier, current_model in _classification_tiers(model, fallback_model):
+        data = _build_classify_request(text, current_model)
+        try:
+            content = (await client.post("chat", data, operation="classify"))["message"]["content"]
+        except httpx.HTTPError as e:
+            logging.error(f"Ошибка при классификации письма с помощью Ollama (модель: {current_model}): {e}")
+            content = None
+        decision = _tier_decision(tier, current_model, content, min_confidence)
+        if decision is not None:
+            return decision
+    return _undecided(current_model, failed=content is None)
+
+async def generate_response_ollama_async(client: AsyncOllamaClient, email_text: str, knowledge_base_answer: str, model: str) -> Optional[str]:
+    """
+    Асинхронный вариант generate_response_ollama.
+    """
+    if OLLAMA_GENERATE_STREAM:
+        return await _generate_streaming_async(client, email_text, knowledge_base_answer, model)
+    data = _build_generate_request(email_text, knowledge_base_answer, model)
+    try:
+        return (await client.post("chat", data, operation="generate"))["message"]["content"].strip()
+    except httpx.HTTPError as e:
+        logging.error(f"Ошибка при генерации ответа с помощью Ollama (модель: {model}): {e}")
+        return GENERATION_ERROR_REPLY
+
+async def _generate_streaming_async(client: AsyncOllamaClient, email_text: str, knowledge_base_answer: str, model: str) -> str:
+    """
+    Асинхронный вариант _generate_streaming.
+    """
+    data = _build_generate_request(email_text, knowledge_base_answer, model, stream=True)
+    generation = GenerationStream(model)
+    try:
+        async with contextlib.aclosing(client.stream("chat", data, operation="generate")) as chunks:
+            async for chunk in chunks:
+                if not generation.feed(chunk):
+                    break
+    except httpx.HTTPError as e:
+        logging.error(f"Ошибка при генерации ответа с помощью Ollama (модель: {model}): {e}")
+    return generation.result()
@@ -0,0 +1,188 @@
+import atexit
+import os
+import threading
+import time
+from collections import defaultdict
+import redis
+from prometheus_client.core import CounterMetricFamily, HistogramMetricFamily, SummaryMetricFamily
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
+# Workers and the API run in different processes, so worker-side metrics are
+# accumulated in Redis hashes (like the dashboard counters) and exported by
+# the API's /metrics endpoint through RedisMetricsCollector.
+COUNTERS_KEY = 'metrics:counters'
+SUMMARIES_KEY = 'metrics:summaries'
+HISTOGRAMS_KEY = 'metrics:histograms'
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Updates are aggregated in process memory and written to Redis this often,
+# so recording a metric never waits on Redis in the request path
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', 5))
+
+_redis = None
+
+def _get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.from_url(REDIS_URL)
+    return _redis
+
+def _field(name, labels):
+    if not labels:
+        return name
+    return name + '|' + ','.join(f'{key}={value}' for key, value in sorted(labels.items()))
+
+def _parse_field(field):
+    name, _, label_string = field.partition('|')
+    labels = dict(pair.split('=', 1) for pair in label_string.split(',')) if label_string else {}
+    return name, labels
+
+class MetricsBuffer:
+    """
+    Pending increments of this process, {(hash key, field): amount}.
+    flush() writes them in one pipeline; on failure they are kept and merged
+    into the next flush, so the buffer stays bounded by the number of series.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = defaultdict(float)
+
+    def add(self, key, field, amount):
+        with self.lock:
+            self.pending[(key, field)] += amount
+
+    def flush(self, redis_conn):
+        with self.lock:
+            pending, self.pending = self.pending, defaultdict(float)
+        if not pending:
+            return
+        try:
+            pipe = redis_conn.pipeline(transaction=False)
+            for (key, field), amount in pending.items():
+                pipe.hincrbyfloat(key, field, amount)
+            pipe.execute()
+        except Exception:
+            with self.lock:
+                for series, amount in pending.items():
+                    self.pending[series] += amount
+            raise
+
+_buffer = MetricsBuffer()
+_flusher = None
+_flusher_lock = threading.Lock()
+
+def flush():
+    """
+    Writes the metrics buffered in this process to Redis. Runs every
+    METRICS_FLUSH_SECONDS in a background thread and at interpreter exit.
+    """
+    try:
+        _buffer.flush(_get_redis())
+    except Exception as e:
+        logger.debug("metrics_flush_failed", error=str(e))
+
+def _start_flusher():
+    global _flusher
+    with _flusher_lock:
+        if _flusher is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(METRICS_FLUSH_SECONDS)
+                flush()
+
+        _flusher = threading.Thread(target=run, daemon=True, name='metrics-flush')
+        _flusher.start()
+        atexit.register(flush)
+
+def _add(key, field, amount):
+    _buffer.add(key, field, amount)
+    if _flusher is None:
+        _start_flusher()
+
+def incr(name, amount=1, **labels):
+    """
+    Increments a counter, e.g. incr('embedding_cache_requests', result='miss').
+    """
+    if amount == 0:
+        return
+    _add(COUNTERS_KEY, _field(name, labels), amount)
+
+def observe(name, value, **labels):
+    """
+    Records one observation of a summary (count and sum), e.g. a latency in seconds.
+    """
+    field = _field(name, labels)
+    _add(SUMMARIES_KEY, f'{field}|sum', value)
+    _add(SUMMARIES_KEY, f'{field}|count', 1)
+
+def observe_histogram(name, value, buckets=LATENCY_BUCKETS, **labels):
+    """
+    Records one observation in a histogram with the given bucket upper bounds.
+    """
+    field = _field(name, labels)
+    for bound in buckets: # Cumulative, every bucket written so all exist
+        _add(HISTOGRAMS_KEY, f'{field}|{bound}', 1 if value <= bound else 0)
+    _add(HISTOGRAMS_KEY, f'{field}|+Inf', 1)
+    _add(HISTOGRAMS_KEY, f'{field}|sum', value)
+
+class RedisMetricsCollector:
+    """
+    Prometheus collector exposing the counters, summaries and histograms written
+    by incr/observe/observe_histogram.
+    """
+
+    def __init__(self, redis_conn=None):
+        self.redis = redis_conn
+
+    def collect(self):
+        try:
+            r = self.redis or _get_redis()
+            counters = r.hgetall(COUNTERS_KEY)
+            summaries = r.hgetall(SUMMARIES_KEY)
+            histograms = r.hgetall(HISTOGRAMS_KEY)
+        except Exception as e:
+            logger.error("metrics_collect_failed", error=str(e))
+            return
+
+        families = {}
+        for field, value in counters.items():
+            name, labels = _parse_field(field.decode())
+            family = families.get(name)
+            if family is None:
+                family = families[name] = CounterMetricFamily(name, f'{name} (worker counter)', labels=sorted(labels))
+            family.add_metric([labels[key] for key in sorted(labels)], float(value))
+
+        observations = {}
+        for field, value in summaries.items():
+            series, _, part = field.decode().rpartition('|')
+            observations.setdefault(series, {})[part] = float(value)
+        for series, parts in observations.items():
+            name, labels = _parse_field(series)
+            family = families.get(name)
+            if family is None:
+                family = families[name] = SummaryMetricFamily(name, f'{name} (worker summary)', labels=sorted(labels))
+            family.add_metric([labels[key] for key in sorted(labels)], parts.get('count', 0), parts.get('sum', 0.0))
+
+        buckets = {}
+        for field, value in histograms.items():
+            series, _, bound = field.decode().rpartition('|')
+            buckets.setdefault(series, {})[bound] = float(value)
+        for series, parts in buckets.items():
+            name, labels = _parse_field(series)
+            family = families.get(name)
+            if family is None:
+                family = families[name] = HistogramMetricFamily(name, f'{name} (worker histogram)', labels=sorted(labels))
+            total = parts.pop('sum', 0.0)
+            count = parts.pop('+Inf', 0.0)
+            bounds = sorted(parts, key=float)
+            family.add_metric([labels[key] for key in sorted(labels)],
+                              [(bound, parts[bound]) for bound in bounds] + [('+Inf', count)], total)
+
+        yield from families.values()
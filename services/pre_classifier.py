@@ -0,0 +1,208 @@
+import json
+import os
+import re
+import zlib
+import numpy as np
+import redis
+from services import metrics
+from services.lexical_index import tokenize
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+# Comma-separated addresses or @domains that are always relevant / never relevant
+PRECLASSIFIER_ALLOW_SENDERS = os.getenv('PRECLASSIFIER_ALLOW_SENDERS', '')
+PRECLASSIFIER_DENY_SENDERS = os.getenv('PRECLASSIFIER_DENY_SENDERS', '')
+PRECLASSIFIER_MODEL_PATH = os.getenv('PRECLASSIFIER_MODEL_PATH', 'embeddings/preclassifier.json')
+# The linear model decides on its own only outside (LOW, HIGH); in between the LLM decides
+PRECLASSIFIER_HIGH = float(os.getenv('PRECLASSIFIER_HIGH', 0.9))
+PRECLASSIFIER_LOW = float(os.getenv('PRECLASSIFIER_LOW', 0.1))
+# LLM decisions (hashed features, no email text) are logged here as training data for scripts/train_preclassifier.py
+SAMPLES_KEY = 'preclassifier:samples'
+MAX_SAMPLES = int(os.getenv('PRECLASSIFIER_MAX_SAMPLES', 20000))
+
+N_FEATURES = 1 << 14
+AUTOMATED_SENDER = re.compile(r'(^|[<\s"])(no-?reply|do-?not-?reply|mailer-daemon|postmaster|notifications?)@', re.IGNORECASE)
+
+def _parse_senders(value):
+    return {entry.strip().lower() for entry in value.split(',') if entry.strip()}
+
+def _sender_address(sender):
+    match = re.search(r'<([^>]+)>', sender)
+    return (match.group(1) if match else sender).strip().lower()
+
+def _sender_listed(address, entries):
+    return address in entries or ('@' + address.partition('@')[2]) in entries
+
+def features(subject, text):
+    """
+    Hashed bag-of-words indices (stemmed terms of subject and body, subject terms kept apart).
+    """
+    indices = {zlib.crc32(f's:{term}'.encode('utf-8')) % N_FEATURES for term in tokenize(subject)}
+    indices.update(zlib.crc32(term.encode('utf-8')) % N_FEATURES for term in tokenize(text))
+    return sorted(indices)
+
+class PreClassification:
+    """
+    Outcome of the pre-classifier: relevant is True/False when it decided,
+    None when the email must be escalated to the LLM.
+    """
+
+    def __init__(self, relevant, reason, probability=None):
+        self.relevant = relevant
+        self.reason = reason
+        self.probability = probability
+
+    @property
+    def escalate(self):
+        return self.relevant is None
+
+class LinearModel:
+    """
+    Logistic regression over hashed features, stored as sparse JSON weights.
+    """
+
+    def __init__(self, bias, weights):
+        self.bias = bias
+        self.weights = weights # {feature index: weight}
+
+    def probability(self, subject, text):
+        return self.feature_probability(features(subject, text))
+
+    def feature_probability(self, indices):
+        score = self.bias + sum(self.weights.get(index, 0.0) for index in indices)
+        return 1.0 / (1.0 + np.exp(-score))
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return cls(data['bias'], {int(index): weight for index, weight in data['weights'].items()})
+        except Exception as e:
+            logger.error("preclassifier_model_load_failed", path=path, error=str(e))
+            return None
+
+    def save(self, path, **info):
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'bias': self.bias, 'weights': {str(i): w for i, w in self.weights.items()}, **info}, f)
+        os.replace(tmp_path, path)
+
+def sample_features(sample):
+    """
+    Feature indices of a logged sample; samples logged before hashing carry subject and text.
+    """
+    if 'features' in sample:
+        return sample['features']
+    return features(sample.get('subject', ''), sample.get('text', ''))
+
+def train_linear_model(samples, epochs=200, learning_rate=0.5, l2=1e-4):
+    """
+    Trains a LinearModel on [{'features', 'relevant'}, ...] as logged by
+    PreClassifier.log_decision (full-batch gradient descent).
+    """
+    rows = [sample_features(sample) for sample in samples]
+    labels = np.array([1.0 if sample['relevant'] else 0.0 for sample in samples])
+    used = sorted({index for row in rows for index in row})
+    column = {index: position for position, index in enumerate(used)}
+    x = np.zeros((len(rows), len(used)), dtype=np.float32)
+    for row_number, row in enumerate(rows):
+        x[row_number, [column[index] for index in row]] = 1.0
+
+    weights, bias = fit_logistic(x, labels, epochs, learning_rate, l2)
+    return LinearModel(bias, {index: float(weights[column[index]]) for index in used if weights[column[index]] != 0.0})
+
+def fit_logistic(x, labels, epochs=200, learning_rate=0.5, l2=1e-4):
+    """
+    Logistic regression by full-batch gradient descent; returns (weights, bias).
+    """
+    weights = np.zeros(x.shape[1])
+    bias = float(np.log((labels.mean() + 1e-6) / (1 - labels.mean() + 1e-6)))
+    for _ in range(epochs):
+        predictions = 1.0 / (1.0 + np.exp(-(x @ weights + bias)))
+        error = predictions - labels
+        weights -= learning_rate * (x.T @ error / len(x) + l2 * weights)
+        bias -= learning_rate * float(error.mean())
+    return weights, bias
+
+class PreClassifier:
+    """
+    Cheap local relevance check run before the LLM classify_email call.
+
+    In order: sender allow/deny lists, bulk-mail headers (List-Unsubscribe,
+    Precedence, Auto-Submitted) and automated senders, then the linear model
+    trained from logged LLM decisions. Anything not confidently decided is
+    escalated to the LLM.
+    """
+
+    def __init__(self, redis_conn=None, model=None, allow=PRECLASSIFIER_ALLOW_SENDERS, deny=PRECLASSIFIER_DENY_SENDERS,
+                 high=PRECLASSIFIER_HIGH, low=PRECLASSIFIER_LOW):
+        self.redis = redis_conn
+        self.model = model
+        self.allow = _parse_senders(allow)
+        self.deny = _parse_senders(deny)
+        self.high = high
+        self.low = low
+
+    def classify(self, email):
+        decision = self._classify(email)
+        outcome = 'escalated' if decision.escalate else ('relevant' if decision.relevant else 'irrelevant')
+        metrics.incr('preclassifier_decisions', outcome=outcome, reason=decision.reason)
+        return decision
+
+    def _classify(self, email):
+        address = _sender_address(email.sender)
+        if _sender_listed(address, self.allow):
+            return PreClassification(True, 'allowlist')
+        if _sender_listed(address, self.deny):
+            return PreClassification(False, 'denylist')
+
+        headers = {name.lower(): value for name, value in (getattr(email, 'headers', None) or {}).items()}
+        if 'list-unsubscribe' in headers:
+            return PreClassification(False, 'list_unsubscribe')
+        if headers.get('precedence', '').strip().lower() in ('bulk', 'list', 'junk'):
+            return PreClassification(False, 'precedence')
+        if headers.get('auto-submitted', 'no').strip().lower() != 'no':
+            return PreClassification(False, 'auto_submitted')
+        if AUTOMATED_SENDER.search(email.sender):
+            return PreClassification(False, 'automated_sender')
+
+        if self.model is not None:
+            probability = self.model.probability(email.subject, email.text)
+            if probability >= self.high:
+                return PreClassification(True, 'model', probability)
+            if probability <= self.low:
+                return PreClassification(False, 'model', probability)
+            return PreClassification(None, 'model_uncertain', probability)
+        return PreClassification(None, 'no_rule')
+
+    def log_decision(self, email, relevant):
+        """
+        Records an LLM decision as a training sample for the linear model.
+        Only the hashed feature indices are stored, never the email itself.
+        """
+        if self.redis is None:
+            return
+        sample = json.dumps({'features': features(email.subject, email.text), 'relevant': bool(relevant)})
+        try:
+            pipe = self.redis.pipeline()
+            pipe.lpush(SAMPLES_KEY, sample)
+            pipe.ltrim(SAMPLES_KEY, 0, MAX_SAMPLES - 1)
+            pipe.execute()
+        except Exception as e:
+            logger.error("preclassifier_log_failed", error=str(e))
+
+_pre_classifier = None
+
+def get_pre_classifier():
+    """
+    Returns the process-wide PreClassifier (model loaded once per worker).
+    """
+    global _pre_classifier
+    if _pre_classifier is None:
+        _pre_classifier = PreClassifier(redis.from_url(REDIS_URL), LinearModel.load(PRECLASSIFIER_MODEL_PATH))
+    return _pre_classifier
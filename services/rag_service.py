@@ -2,10 +2,12 @@
 import faiss
 import numpy as np
 import os
-import pickle # Для сохранения/загрузки списка документов
+import pickle # Для загрузки списка документов старых сборок (documents.pkl)
 import glob # Для поиска файлов в директории
+import hashlib
 import logging # Для более информативного вывода
-from typing import List, Optional
+from typing import List, Optional, Tuple
+from services.retrieval_cache import get_retrieval_cache
 
 # Настройка логирования для этого модуля
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -89,153 +91,187 @@ def load_knowledge_base(directory: str) -> List[KnowledgeDocument]:
     logging.info(f"Загружено {len(documents)} документов из базы знаний.")
     return documents
 
-def build_and_save_faiss_index(documents: List[KnowledgeDocument], embedding_model: str, dimension: int, index_path: str, documents_path: str) -> Optional[faiss.Index]:
-    """
-    Строит FAISS индекс из эмбеддингов документов и сохраняет его вместе с документами.
-    """
-    # Импортируем get_embedding_ollama здесь, чтобы избежать циклической зависимости
-    # и чтобы ollama_utils мог быть импортирован без faiss_utils
-    from services.llm_service import get_embedding_ollama
-
-    if not documents:
-        logging.warning("Нет документов для построения FAISS индекса.")
-        return None
-
-    logging.info("Строим эмбеддинги базы знаний...")
-    embeddings = []
-    indexed_documents = [] # Сохраняем документы, для которых успешно получен эмбеддинг
-
-    for i, doc in enumerate(documents):
-        # Используем вопрос + ответ для эмбеддинга
-        content_for_embedding = f"Вопрос: {doc.question}\nОтвет: {doc.answer}"
-        emb = get_embedding_ollama(content_for_embedding, embedding_model)
-        if emb is not None: # Проверяем, что эмбеддинг получен успешно (не None)
-            embeddings.append(emb)
-            indexed_documents.append(doc)
-        else:
-            logging.error(f"Не удалось получить эмбеддинг для документа из {doc.source_file}. Пропускаем.")
-            # Если эмбеддинг не получен, это может быть проблемой, поэтому
-            # можно прекратить построение индекса или продолжить с оставшимися.
-            # Для надежности - пока логируем ошибку, но продолжаем, если есть другие эмбеддинги.
-
-    if not embeddings:
-        logging.error("Не удалось получить ни одного эмбеддинга для построения индекса.")
-        return None
-
-    embeddings_array = np.array(embeddings).astype('float32')
-    
-    # Инициализация FAISS индекса
-    index = faiss.IndexFlatL2(dimension) # L2 расстояние
-    index.add(embeddings_array)
-
-    # Создаем директорию для сохранения, если ее нет
-    os.makedirs(os.path.dirname(index_path), exist_ok=True)
-
-    # Сохранение индекса и списка документов (indexed_documents)
-    try:
-        faiss.write_index(index, index_path)
-        with open(documents_path, 'wb') as f:
-            pickle.dump(indexed_documents, f) # Сохраняем только те документы, которые были проиндексированы
-        logging.info(f"FAISS индекс построен и сохранен в {index_path}")
-        logging.info(f"Документы базы знаний сохранены в {documents_path}")
-        return index
-    except Exception as e:
-        logging.error(f"Ошибка при сохранении FAISS индекса или документов: {e}")
-        return None
+# Векторы индекса отображаются в память (mmap) только для чтения: процессы воркеров
+# на одном узле делят страницы файла через page cache вместо копии в каждом процессе.
+# IO_FLAG_MMAP_IFC (faiss >= 1.8) отображает и коды IndexFlat, IO_FLAG_MMAP — только списки IVF.
+INDEX_MMAP_FLAGS = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
 
-def load_faiss_index(index_path: str) -> Optional[faiss.Index]:
+def load_faiss_index(index_path: str, mmap: bool = True) -> Optional[faiss.Index]:
     """
     Загружает ранее построенный FAISS индекс.
+    По умолчанию индекс отображается в память и доступен только для поиска;
+    mmap=False загружает изменяемую копию (нужно при инкрементальной сборке).
     """
     if not os.path.exists(index_path):
         logging.info(f"FAISS индекс не найден по пути {index_path}")
         return None
     try:
-        index = faiss.read_index(index_path)
+        index = faiss.read_index(index_path, INDEX_MMAP_FLAGS) if mmap else faiss.read_index(index_path)
         logging.info(f"FAISS индекс загружен из {index_path}")
         return index
     except Exception as e:
         logging.error(f"Ошибка при загрузке FAISS индекса из {index_path}: {e}")
         return None
 
-def load_indexed_documents(documents_path: str) -> List[KnowledgeDocument]:
+def load_indexed_documents(documents_path: str):
     """
-    Загружает список документов, которые были использованы для построения FAISS индекса.
+    Загружает документы, которые были использованы для построения FAISS индекса:
+    DocumentStore (mmap, {id: документ}) или, для старых сборок, список из documents.pkl.
     """
+    from services.document_store import DocumentStore, is_document_store
+
     if not os.path.exists(documents_path):
         logging.warning(f"Файл документов {documents_path} не найден.")
         return []
     try:
-        with open(documents_path, 'rb') as f:
-            documents = pickle.load(f) # nosec B301
+        if is_document_store(documents_path):
+            documents = DocumentStore(documents_path)
+        else:
+            with open(documents_path, 'rb') as f:
+                documents = pickle.load(f) # nosec B301
         logging.info(f"Загружено {len(documents)} документов из {documents_path}.")
         return documents
     except Exception as e:
         logging.error(f"Ошибка при загрузке документов из {documents_path}: {e}")
         return []
 
-def check_index_and_documents_match(index_path: str, documents_path: str, current_raw_doc_count: int) -> bool:
+# Поиск: сколько документов брать, порог L2 расстояния и бюджет контекста для генерации (в токенах).
+# /api/embed возвращает нормированные векторы, поэтому квадрат L2 расстояния лежит в [0, 4]
+# и равен 2 - 2 * cos: порог 1.0 пропускает документы с косинусным сходством не ниже 0.5.
+# Порог нужно подбирать на реальных письмах (ср. RELEVANCE_NEAR_DISTANCE=0.6).
+RAG_TOP_K = int(os.getenv('RAG_TOP_K', 3))
+RAG_MAX_DISTANCE = float(os.getenv('RAG_MAX_DISTANCE', 1.0))
+RAG_CONTEXT_TOKENS = int(os.getenv('RAG_CONTEXT_TOKENS', 1024))
+
+def file_fingerprint(path: str) -> Optional[str]:
     """
-    Проверяет, соответствует ли существующий FAISS индекс и сохраненные документы
-    текущему количеству документов в базе знаний.
+    Возвращает короткий sha256 содержимого файла (версию индекса) или None, если файла нет.
+    Одинаков во всех процессах, загрузивших один и тот же индекс.
     """
-    if not os.path.exists(index_path) or not os.path.exists(documents_path):
-        logging.info("FAISS индекс или файл документов не найдены.")
-        return False
-    try:
-        index = faiss.read_index(index_path)
-        with open(documents_path, 'rb') as f:
-            indexed_documents = pickle.load(f) # nosec B301
-        
-        # Мы сравниваем количество элементов в индексе и в списке проиндексированных документов
-        # с количеством документов, которые были успешно загружены из markdown файлов.
-        # В идеале все 3 счетчика должны совпадать.
-        if index.ntotal == len(indexed_documents) and index.ntotal == current_raw_doc_count:
-            logging.info(f"FAISS индекс ({index.ntotal}), сохраненные документы ({len(indexed_documents)}) и текущая база знаний ({current_raw_doc_count}) соответствуют.")
-            return True
-        else:
-            logging.warning(f"FAISS индекс ({index.ntotal}) или сохраненные документы ({len(indexed_documents)}) не соответствуют текущей базе знаний ({current_raw_doc_count}). Индекс будет перестроен.")
-            return False
-    except Exception as e:
-        logging.error(f"Ошибка при проверке FAISS индекса и документов: {e}. Индекс будет перестроен.")
-        return False
+    if not os.path.exists(path):
+        return None
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
 
-from services.cache_manager import cache
+def _search_index_batch(index: faiss.Index, query_matrix: np.ndarray, k: int, index_version: Optional[str] = None) -> List[List[Tuple[int, float]]]:
+    """
+    Выполняет поиск в FAISS для каждой строки матрицы (n, d) одним вызовом index.search
+    и возвращает для каждой строки [(id документа, L2 расстояние), ...].
+    Если указана версия индекса, результаты берутся из кэша поиска / кладутся в него (один запрос к Redis на пачку).
+    """
+    query_matrix = np.ascontiguousarray(query_matrix, dtype=np.float32).reshape(-1, index.d)
+    results = [None] * len(query_matrix)
+    if index_version is not None:
+        results = get_retrieval_cache().get_many(index_version, query_matrix, k)
+    missing = [row for row, hits in enumerate(results) if hits is None]
+    if not missing:
+        return results
 
-@cache.cached(prefix='rag_search', ttl=3600)
-def search_knowledge_base(index: faiss.Index, query_embedding: List[float], documents: List[KnowledgeDocument], k: int = 1) -> Optional[KnowledgeDocument]:
+    query_vectors = query_matrix[missing] # Копия: нормирование ниже не меняет запросы вызывающего
+    inner_product = index.metric_type == faiss.METRIC_INNER_PRODUCT
+    if inner_product:
+        faiss.normalize_L2(query_vectors)
+    distances, indices = index.search(query_vectors, k)
+    if inner_product:
+        # Для нормированных векторов ||a - b||^2 = 2 - 2 * <a, b>: порог остается в шкале L2
+        distances = 2.0 - 2.0 * distances
+    for position, row in enumerate(missing):
+        results[row] = [(int(doc_id), float(distance))
+                        for doc_id, distance in zip(indices[position], distances[position]) if doc_id != -1]
+
+    if index_version is not None:
+        get_retrieval_cache().set_many(index_version, query_matrix[missing], k, [results[row] for row in missing])
+    return results
+
+def _search_index(index: faiss.Index, query_embedding: List[float], k: int, index_version: Optional[str] = None) -> List[Tuple[int, float]]:
     """
-    Ищет в FAISS индексе наиболее похожий документ.
-    Возвращает KnowledgeDocument, если совпадение достаточно хорошее, иначе None.
+    Выполняет поиск в FAISS для одного запроса и возвращает [(id документа, L2 расстояние), ...].
+    """
+    return _search_index_batch(index, np.array([query_embedding], dtype=np.float32), k, index_version)[0]
+
+def retrieve_documents(index: faiss.Index, query_embedding: List[float], documents, k: int = RAG_TOP_K,
+                       max_distance: float = RAG_MAX_DISTANCE, index_version: Optional[str] = None) -> List[Tuple[KnowledgeDocument, float]]:
+    """
+    Ищет до k ближайших документов и возвращает [(документ, L2 расстояние), ...] по возрастанию расстояния.
+    Отбрасывает совпадения дальше max_distance и дубликаты (один и тот же ответ в нескольких файлах).
+    index_version включает кэш результатов поиска (см. file_fingerprint).
     """
     if index is None:
         logging.error("FAISS индекс не загружен. Невозможно выполнить поиск.")
-        return None
-
-    query_vector = np.array([query_embedding]).astype('float32')
-    distances, indices = index.search(query_vector, k)
+        return []
+    return _resolve_hits(_search_index(index, query_embedding, k, index_version), documents, max_distance)
 
-    # --- КРИТИЧНОЕ ДОБАВЛЕНИЕ: ПОРОГ СХОДСТВА ---
-    # Для all-minilm:latest (который вы используете для эмбеддингов), L2 расстояние.
-    # Меньшее значение = более высокое сходство.
-    # 0.8 - хорошее стартовое значение, но его нужно будет настроить.
-    SIMILARITY_THRESHOLD = 5.0 # ЭКСПЕРИМЕНТИРУЙТЕ С ЭТИМ ЗНАЧЕНИЕМ!
+def retrieve_documents_batch(index: faiss.Index, query_matrix: np.ndarray, documents, k: int = RAG_TOP_K,
+                             max_distance: float = RAG_MAX_DISTANCE, index_version: Optional[str] = None) -> List[List[Tuple[KnowledgeDocument, float]]]:
+    """
+    Пакетный вариант retrieve_documents: для матрицы запросов (n, d) выполняет один поиск в FAISS
+    и возвращает список совпадений для каждой строки.
+    """
+    if index is None:
+        logging.error("FAISS индекс не загружен. Невозможно выполнить поиск.")
+        return [[] for _ in range(len(query_matrix))]
+    return [_resolve_hits(hits, documents, max_distance)
+            for hits in _search_index_batch(index, query_matrix, k, index_version)]
 
-    if indices.size > 0 and indices[0][0] != -1:
-        best_match_index = indices[0][0]
-        best_match_distance = distances[0][0] # Получаем фактическое расстояние
-        
-        logging.info(f"Найдено наилучшее совпадение (индекс: {best_match_index}, расстояние L2: {best_match_distance:.4f})")
-
-        if best_match_distance < SIMILARITY_THRESHOLD:
-            if 0 <= best_match_index < len(documents):
-                return documents[best_match_index]
-            else:
-                logging.warning(f"Найденный индекс {best_match_index} вне диапазона списка документов. Возможно, список документов устарел.")
-                return None
-        else:
-            logging.info(f"Наилучшее совпадение слишком далеко (расстояние L2: {best_match_distance:.4f} >= порога {SIMILARITY_THRESHOLD}).")
-            return None # Совпадение не найдено, так как расстояние слишком велико
-    else:
+def _resolve_hits(hits: List[Tuple[int, float]], documents, max_distance: float) -> List[Tuple[KnowledgeDocument, float]]:
+    """
+    Превращает результаты поиска в [(документ, расстояние), ...]: порог расстояния и удаление дубликатов.
+    """
+    if not hits:
         logging.info("В FAISS индексе не найдено соответствующего документа.")
-        return None
\ No newline at end of file
+        return []
+    logging.info(f"Найдено наилучшее совпадение (индекс: {hits[0][0]}, расстояние L2: {hits[0][1]:.4f})")
+
+    matches = []
+    seen_answers = set()
+    for doc_id, distance in hits:
+        if distance >= max_distance:
+            logging.info(f"Совпадение {doc_id} слишком далеко (расстояние L2: {distance:.4f} >= порога {max_distance}).")
+            break # Результаты упорядочены по расстоянию
+        # documents — список (старый формат) или словарь {id: документ} для IndexIDMap
+        try:
+            document = documents[doc_id]
+        except (IndexError, KeyError):
+            logging.warning(f"Найденный индекс {doc_id} отсутствует в списке документов. Возможно, список документов устарел.")
+            continue
+        answer_key = ' '.join(document.answer.split()).lower()
+        if answer_key in seen_answers:
+            continue
+        seen_answers.add(answer_key)
+        matches.append((document, distance))
+    return matches
+
+def search_knowledge_base(index: faiss.Index, query_embedding: List[float], documents, k: int = 1, index_version: Optional[str] = None) -> Optional[KnowledgeDocument]:
+    """
+    Ищет в FAISS индексе наиболее похожий документ.
+    Возвращает KnowledgeDocument, если совпадение достаточно хорошее, иначе None.
+    """
+    matches = retrieve_documents(index, query_embedding, documents, k=k, index_version=index_version)
+    return matches[0][0] if matches else None
+
+def estimate_tokens(text: str) -> int:
+    """
+    Грубая оценка числа токенов без токенизатора модели (~3 символа на токен для русского текста).
+    """
+    return len(text) // 3 + 1
+
+def pack_context(matches: List[Tuple[KnowledgeDocument, float]], token_budget: int = RAG_CONTEXT_TOKENS) -> str:
+    """
+    Собирает контекст для генерации из найденных документов в порядке релевантности,
+    пока он помещается в token_budget. Лучший документ включается всегда (при необходимости обрезается).
+    """
+    sections = []
+    used_tokens = 0
+    for document, _ in matches:
+        section = f"Вопрос: {document.question}\nОтвет: {document.answer}"
+        section_tokens = estimate_tokens(section)
+        if used_tokens + section_tokens > token_budget:
+            if not sections:
+                sections.append(section[:token_budget * 3])
+            break
+        sections.append(section)
+        used_tokens += section_tokens
+    return "\n\n".join(sections)
@@ -0,0 +1,158 @@
+import base64
+import json
+import os
+import numpy as np
+import redis
+from services import metrics
+from services.pre_classifier import PreClassification, fit_logistic
+from services.rag_service import RAG_MAX_DISTANCE
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+# 'llm': emails the pre-classifier escalates go to classify_email.
+# 'embedding': they are embedded and searched first and relevance is decided
+# from the embedding; classify_email is only called when that is uncertain.
+RELEVANCE_MODE = os.getenv('RELEVANCE_MODE', 'llm')
+RELEVANCE_HEAD_PATH = os.getenv('RELEVANCE_HEAD_PATH', 'embeddings/relevance_head.json')
+RELEVANCE_HIGH = float(os.getenv('RELEVANCE_HIGH', 0.9))
+RELEVANCE_LOW = float(os.getenv('RELEVANCE_LOW', 0.1))
+# Without a trained head: an email this close (L2) to a knowledge-base question is relevant
+RELEVANCE_NEAR_DISTANCE = float(os.getenv('RELEVANCE_NEAR_DISTANCE', 0.6))
+# LLM decisions with their embeddings, for scripts/train_relevance_head.py
+SAMPLES_KEY = 'relevance:samples'
+MAX_SAMPLES = int(os.getenv('RELEVANCE_MAX_SAMPLES', 5000))
+
+def nearest_distance(matches, max_distance=RAG_MAX_DISTANCE):
+    """
+    Distance to the closest knowledge-base document; max_distance when nothing is within the cut-off.
+    """
+    return min((distance for _, distance in matches), default=max_distance)
+
+def _head_features(embedding, distance, max_distance=RAG_MAX_DISTANCE):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    unit = vector / norm if norm > 0 else vector
+    return np.append(unit, min(distance, max_distance) / max_distance)
+
+class RelevanceHead:
+    """
+    Logistic head over the unit email embedding plus the (scaled) distance to
+    the nearest knowledge-base document. Only valid for the embedding model
+    it was trained with.
+    """
+
+    def __init__(self, weights, bias, model):
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.bias = bias
+        self.model = model
+
+    @property
+    def dimension(self):
+        return len(self.weights) - 1
+
+    def probability(self, embedding, distance):
+        score = self.bias + float(_head_features(embedding, distance) @ self.weights)
+        return 1.0 / (1.0 + np.exp(-score))
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return cls(data['weights'], data['bias'], data['model'])
+        except Exception as e:
+            logger.error("relevance_head_load_failed", path=path, error=str(e))
+            return None
+
+    def save(self, path, **info):
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'model': self.model, 'bias': self.bias, 'weights': self.weights.tolist(), **info}, f)
+        os.replace(tmp_path, path)
+
+def train_relevance_head(samples, model, epochs=300, learning_rate=1.0, l2=1e-4):
+    """
+    Trains a RelevanceHead on [{'vector', 'distance', 'relevant'}, ...] as logged by EmbeddingRelevance.
+    """
+    x = np.array([_head_features(_decode(sample['vector']), sample['distance']) for sample in samples])
+    labels = np.array([1.0 if sample['relevant'] else 0.0 for sample in samples])
+    weights, bias = fit_logistic(x, labels, epochs, learning_rate, l2)
+    return RelevanceHead(weights, bias, model)
+
+def _encode(embedding):
+    return base64.b64encode(np.asarray(embedding, dtype=np.float32).tobytes()).decode('ascii')
+
+def _decode(vector):
+    return np.frombuffer(base64.b64decode(vector), dtype=np.float32)
+
+class EmbeddingRelevance:
+    """
+    Decides relevance from the email embedding and its knowledge-base matches,
+    so relevant emails need two Ollama calls (embed, generate) instead of three.
+
+    With a trained head, its probability is trusted outside
+    (RELEVANCE_LOW, RELEVANCE_HIGH). Without one (or for another embedding
+    model) only a near match to the knowledge base decides, as relevant.
+    Everything else is escalated to classify_email.
+    """
+
+    def __init__(self, redis_conn=None, head=None, model=None, high=RELEVANCE_HIGH, low=RELEVANCE_LOW,
+                 near_distance=RELEVANCE_NEAR_DISTANCE):
+        self.redis = redis_conn
+        if head is not None and model is not None and head.model != model:
+            logger.warning("relevance_head_model_mismatch", head_model=head.model, model=model)
+            head = None
+        self.head = head
+        self.high = high
+        self.low = low
+        self.near_distance = near_distance
+
+    def decide(self, embedding, matches):
+        decision = self._decide(embedding, nearest_distance(matches))
+        outcome = 'escalated' if decision.escalate else ('relevant' if decision.relevant else 'irrelevant')
+        metrics.incr('relevance_decisions', outcome=outcome, reason=decision.reason)
+        return decision
+
+    def _decide(self, embedding, distance):
+        if self.head is not None and self.head.dimension == len(embedding):
+            probability = self.head.probability(embedding, distance)
+            if probability >= self.high:
+                return PreClassification(True, 'head', probability)
+            if probability <= self.low:
+                return PreClassification(False, 'head', probability)
+            return PreClassification(None, 'head_uncertain', probability)
+        if distance <= self.near_distance:
+            return PreClassification(True, 'near_match')
+        return PreClassification(None, 'no_near_match')
+
+    def log_decision(self, embedding, matches, relevant):
+        """
+        Records an LLM decision with the email embedding as a training sample for the head.
+        """
+        if self.redis is None:
+            return
+        sample = json.dumps({'vector': _encode(embedding), 'distance': nearest_distance(matches),
+                             'relevant': bool(relevant)})
+        try:
+            pipe = self.redis.pipeline()
+            pipe.lpush(SAMPLES_KEY, sample)
+            pipe.ltrim(SAMPLES_KEY, 0, MAX_SAMPLES - 1)
+            pipe.execute()
+        except Exception as e:
+            logger.error("relevance_log_failed", error=str(e))
+
+_embedding_relevance = None
+
+def get_embedding_relevance(model):
+    """
+    Returns the process-wide EmbeddingRelevance for the given embedding model.
+    """
+    global _embedding_relevance
+    if _embedding_relevance is None:
+        _embedding_relevance = EmbeddingRelevance(redis.from_url(REDIS_URL), RelevanceHead.load(RELEVANCE_HEAD_PATH),
+                                                  model)
+    return _embedding_relevance
@@ -0,0 +1,196 @@
+import base64
+import hashlib
+import json
+import os
+import re
+import numpy as np
+import redis
+from services import metrics
+from services.embedding_cache import normalize_text
+from services.lexical_index import STOP_WORDS
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL_SECONDS', 24 * 3600))
+# Cosine similarity between email embeddings above which a stored reply is reused
+RESPONSE_CACHE_MIN_SIMILARITY = float(os.getenv('RESPONSE_CACHE_MIN_SIMILARITY', 0.95))
+RESPONSE_CACHE_MAX_PER_CONTEXT = int(os.getenv('RESPONSE_CACHE_MAX_PER_CONTEXT', 50))
+
+ORDER_NUMBER_PLACEHOLDER = '{order_number}'
+# "№ 12345", "#12345", "заказ 12345" or a bare run of 5+ digits
+ORDER_NUMBER_PATTERN = re.compile(r'(?:№|#|заказ\w*\s*)\s*(\d{3,})|\b(\d{5,})\b', re.IGNORECASE)
+
+def find_order_number(text):
+    match = ORDER_NUMBER_PATTERN.search(text)
+    return (match.group(1) or match.group(2)) if match else None
+
+def _question_key(text):
+    # Near-identical wording with a different order number is the same question
+    return normalize_text(ORDER_NUMBER_PATTERN.sub(ORDER_NUMBER_PLACEHOLDER, text)).lower()
+
+# Cached replies are served to other customers. The greeting, which usually
+# names the customer, is replaced with a neutral one; a reply that still repeats
+# words or numbers of the email (names, addresses, phones) that are not in the
+# knowledge-base context is not cached.
+NEUTRAL_GREETING = 'Здравствуйте!'
+GREETING_PATTERN = re.compile(
+    r'^\s*(?:здравствуй\w*|добр\w+\s+(?:день|утро|вечер)|доброго\s+времени\s+суток|привет\w*|уважаем\w*|hello|hi|dear)\b'
+    r'[^.!?\n]*[.!?]*', re.IGNORECASE)
+# Words are compared by their first letters, so "Мария" matches "Марии"
+PERSONAL_STEM_LENGTH = 4
+LATIN_TO_CYRILLIC = [
+    ('shch', 'щ'), ('sch', 'щ'), ('zh', 'ж'), ('kh', 'х'), ('ts', 'ц'), ('ch', 'ч'), ('sh', 'ш'), ('yu', 'ю'),
+    ('ya', 'я'), ('yo', 'е'), ('ye', 'е'), ('a', 'а'), ('b', 'б'), ('c', 'к'), ('d', 'д'), ('e', 'е'), ('f', 'ф'),
+    ('g', 'г'), ('h', 'х'), ('i', 'и'), ('j', 'й'), ('k', 'к'), ('l', 'л'), ('m', 'м'), ('n', 'н'), ('o', 'о'),
+    ('p', 'п'), ('q', 'к'), ('r', 'р'), ('s', 'с'), ('t', 'т'), ('u', 'у'), ('v', 'в'), ('w', 'в'), ('x', 'кс'),
+    ('y', 'й'), ('z', 'з'),
+]
+
+def _stems(text):
+    words = re.findall(r'[^\W\d_]+', text.lower().replace('ё', 'е'))
+    return {word[:PERSONAL_STEM_LENGTH] for word in words if len(word) >= 3 and word not in STOP_WORDS}
+
+# Courtesy words any email and reply may share
+COMMON_STEMS = frozenset(_stems(
+    'здравствуйте добрый день вечер утро спасибо пожалуйста благодарим уважением вопрос ответ помощь помочь '
+    'подскажите мой моя мое мои вашего вашей вашему hello thanks please'
+))
+
+def _transliterate(word):
+    for latin, cyrillic in LATIN_TO_CYRILLIC:
+        word = word.replace(latin, cyrillic)
+    return word
+
+def _sender_words(sender):
+    # Display name and mailbox (not the domain) of 'Иван Петров <ivan.petrov@example.com>'
+    name, _, address = sender.partition('<')
+    if not address:
+        name, address = '', name
+    mailbox = address.split('@')[0] if '@' in address else ''
+    return f'{name} {mailbox}'
+
+def _personal_stems(sender, subject, text, context):
+    """
+    Stems of words in the email and its sender that the knowledge-base context does not contain.
+    A Latin name in the header ("Oleg") also counts in Cyrillic ("Олег").
+    """
+    header = _sender_words(sender).lower()
+    stems = _stems(header) | _stems(_transliterate(header)) | _stems(f'{subject} {text}')
+    return stems - _stems(context) - COMMON_STEMS
+
+def depersonalize(reply):
+    """
+    Replaces the greeting line of a reply with NEUTRAL_GREETING.
+    """
+    return GREETING_PATTERN.sub(NEUTRAL_GREETING, reply, count=1)
+
+class ResponseCache:
+    """
+    Reuses generated replies for near-duplicate questions.
+
+    Replies are grouped by the exact knowledge-base context they were
+    generated from (hash of the packed FAQ documents + model), so editing a
+    FAQ answer changes the key and old replies are never served. Within a
+    group a reply is reused when the new email's embedding has cosine
+    similarity >= RESPONSE_CACHE_MIN_SIMILARITY with the stored one, or,
+    when there is no embedding (keyword-only retrieval), when the wording
+    matches after normalization. Order numbers are templated.
+    """
+
+    def __init__(self, redis_conn, ttl=RESPONSE_CACHE_TTL, min_similarity=RESPONSE_CACHE_MIN_SIMILARITY,
+                 max_per_context=RESPONSE_CACHE_MAX_PER_CONTEXT):
+        self.redis = redis_conn
+        self.ttl = ttl
+        self.min_similarity = min_similarity
+        self.max_per_context = max_per_context
+
+    @staticmethod
+    def key(context, model):
+        digest = hashlib.sha256(f'{model}\0{context}'.encode('utf-8')).hexdigest()
+        return f'resp:{digest}'
+
+    def get(self, context, model, text, embedding=None):
+        """
+        Returns a stored reply adapted to this email, or None.
+        """
+        try:
+            entries = self.redis.hgetall(self.key(context, model))
+        except Exception as e:
+            logger.error("response_cache_get_failed", error=str(e))
+            entries = {}
+        reply = self._best_reply(entries.values(), text, embedding)
+        metrics.incr('response_cache_requests', result='hit' if reply is not None else 'miss')
+        return reply
+
+    def _best_reply(self, entries, text, embedding):
+        question_key = _question_key(text)
+        query = _unit(embedding) if embedding is not None else None
+        best_reply, best_similarity = None, self.min_similarity
+        for raw in entries:
+            entry = json.loads(raw)
+            if entry['question'] == question_key:
+                similarity = 1.0
+            elif query is not None and entry.get('vector'):
+                vector = np.frombuffer(base64.b64decode(entry['vector']), dtype=np.float32)
+                similarity = float(np.dot(query, vector)) if vector.shape == query.shape else 0.0
+            else:
+                continue
+            if similarity >= best_similarity:
+                best_reply, best_similarity = entry['reply'], similarity
+        if best_reply is None:
+            return None
+        if ORDER_NUMBER_PLACEHOLDER in best_reply:
+            order_number = find_order_number(text)
+            if order_number is None:
+                return None # The stored reply needs an order number this email does not have
+            best_reply = best_reply.replace(ORDER_NUMBER_PLACEHOLDER, order_number)
+        return best_reply
+
+    def set(self, context, model, text, reply, sender='', embedding=None, subject=''):
+        """
+        Stores a generated reply with a neutral greeting and the order number
+        templated, unless it is still specific to this customer.
+        """
+        reply = depersonalize(reply)
+        order_number = find_order_number(text)
+        if order_number is not None:
+            reply = re.sub(rf'(?<!\d){order_number}(?!\d)', ORDER_NUMBER_PLACEHOLDER, reply)
+        numbers = set(re.findall(r'\d{3,}', f'{subject} {text}')) - set(re.findall(r'\d{3,}', context))
+        if _stems(reply) & _personal_stems(sender, subject, text, context) or numbers & set(re.findall(r'\d+', reply)):
+            logger.info("response_not_cached", reason="personalized")
+            return
+        question_key = _question_key(text)
+        entry = {
+            'question': question_key,
+            'vector': base64.b64encode(_unit(embedding).tobytes()).decode('ascii') if embedding is not None else None,
+            'reply': reply,
+        }
+        key = self.key(context, model)
+        field = hashlib.sha256(question_key.encode('utf-8')).hexdigest()[:16]
+        try:
+            if self.redis.hlen(key) >= self.max_per_context and not self.redis.hexists(key, field):
+                return
+            pipe = self.redis.pipeline()
+            pipe.hset(key, field, json.dumps(entry, ensure_ascii=False))
+            pipe.expire(key, self.ttl)
+            pipe.execute()
+        except Exception as e:
+            logger.error("response_cache_set_failed", error=str(e))
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+_cache = None
+
+def get_response_cache():
+    """
+    Returns the process-wide ResponseCache.
+    """
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache(redis.from_url(REDIS_URL))
+    return _cache
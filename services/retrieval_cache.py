@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+import numpy as np
+import redis
+from services import metrics
+from utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+RAG_CACHE_TTL = int(os.getenv('RAG_CACHE_TTL_SECONDS', 3600))
+# Query vectors are rounded to this step before hashing, so float noise from
+# re-embedding the same text does not produce a new key.
+RAG_CACHE_QUANTIZATION = float(os.getenv('RAG_CACHE_QUANTIZATION', 1e-3))
+
+class RetrievalCache:
+    """
+    Caches raw FAISS search results as (document ID, distance) pairs.
+
+    Key = (index version, k, hash of the quantized query vector): stable across
+    processes and small, and a rebuilt index gets a new version so stale
+    results are never served. Values are JSON, not pickled documents.
+    """
+
+    def __init__(self, redis_conn, ttl=RAG_CACHE_TTL, quantization=RAG_CACHE_QUANTIZATION):
+        self.redis = redis_conn
+        self.ttl = ttl
+        self.quantization = quantization
+
+    def key(self, index_version, query_vector, k):
+        quantized = np.round(np.asarray(query_vector, dtype=np.float32) / self.quantization).astype(np.int32)
+        digest = hashlib.sha256(quantized.tobytes()).hexdigest()
+        return f'rag:{index_version}:{k}:{digest}'
+
+    def get(self, index_version, query_vector, k):
+        """
+        Returns [(doc_id, distance), ...] or None on a miss.
+        """
+        return self.get_many(index_version, [query_vector], k)[0]
+
+    def get_many(self, index_version, query_vectors, k):
+        """
+        Batch get in one round trip: a list aligned with query_vectors.
+        """
+        try:
+            values = self.redis.mget([self.key(index_version, vector, k) for vector in query_vectors])
+        except Exception as e:
+            logger.error("rag_cache_get_failed", error=str(e))
+            values = [None] * len(query_vectors)
+        hits = sum(1 for value in values if value is not None)
+        metrics.incr('rag_cache_requests', hits, result='hit')
+        metrics.incr('rag_cache_requests', len(values) - hits, result='miss')
+        return [None if value is None else [(int(doc_id), float(distance)) for doc_id, distance in json.loads(value)]
+                for value in values]
+
+    def set(self, index_version, query_vector, k, hits):
+        self.set_many(index_version, [query_vector], k, [hits])
+
+    def set_many(self, index_version, query_vectors, k, hits_per_query):
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for vector, hits in zip(query_vectors, hits_per_query):
+                payload = json.dumps([[int(doc_id), float(distance)] for doc_id, distance in hits])
+                pipe.set(self.key(index_version, vector, k), payload, ex=self.ttl)
+            pipe.execute()
+        except Exception as e:
+            logger.error("rag_cache_set_failed", error=str(e))
+
+_cache = None
+
+def get_retrieval_cache():
+    """
+    Returns the process-wide RetrievalCache.
+    """
+    global _cache
+    if _cache is None:
+        _cache = RetrievalCache(redis.from_url(REDIS_URL))
+    return _cache
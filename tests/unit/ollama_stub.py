@@ -0,0 +1,64 @@
+"""
+Local stub of the Ollama HTTP API for tests: answers /api/* with canned JSON
+and records requests and the number of TCP connections accepted.
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class OllamaStub:
+    def __init__(self, responses=None, status=200):
+        # responses: endpoint ('generate', 'embeddings', ...) -> dict, list of NDJSON chunks
+        # or callable(payload) -> either
+        self.responses = responses or {}
+        self.status = status
+        self.requests = []
+        self.connections = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # Keep-alive
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                stub.connections += 1
+
+            def do_GET(self):
+                self._reply(200, b'Ollama is running', 'text/plain')
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers['Content-Length'])) or b'{}')
+                endpoint = self.path.rsplit('/', 1)[-1]
+                stub.requests.append((endpoint, payload))
+                response = stub.responses.get(endpoint, {})
+                if callable(response):
+                    response = response(payload)
+                if isinstance(response, list): # Streamed reply: one JSON object per line
+                    body = ''.join(json.dumps(chunk) + '\n' for chunk in response).encode()
+                    self._reply(stub.status, body, 'application/x-ndjson')
+                else:
+                    self._reply(stub.status, json.dumps(response).encode(), 'application/json')
+
+            def _reply(self, status, body, content_type):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
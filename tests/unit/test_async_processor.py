@@ -0,0 +1,134 @@
+import asyncio
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+import fakeredis
+import numpy as np
+from services import async_processor
+from services.async_processor import AsyncEmailProcessor
+from services.dedup import MessageClaims
+from services.email_processor import KnowledgeBase
+from services.gmail_service import EmailMessage
+from services.llm_service import Classification
+from services.rag_service import KnowledgeDocument
+from services.pre_classifier import PreClassifier
+from services.relevance_head import EmbeddingRelevance
+from services.response_cache import ResponseCache
+
+
+class TestAsyncEmailProcessor(unittest.TestCase):
+    def setUp(self):
+        self.processor = MagicMock()
+        self.processor._get_claims.return_value = MessageClaims(fakeredis.FakeRedis())
+        self.processor.knowledge_base = KnowledgeBase(MagicMock(), [], 'v1')
+        for patcher in (patch('services.response_cache._cache', ResponseCache(fakeredis.FakeRedis())),
+                        patch('services.pre_classifier._pre_classifier', PreClassifier(fakeredis.FakeRedis()))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.active = 0
+        self.max_active = 0
+
+    async def fake_generate(self, client, text, answer, model):
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(0.01)
+        self.active -= 1
+        return f"Reply to {text}"
+
+    @patch.dict(async_processor.STAGE_CONCURRENCY, {'generate': 2})
+    @patch('services.async_processor.send_email_reply')
+    @patch('services.async_processor.mark_email_as_read')
+    @patch('services.async_processor.retrieve_documents_batch',
+           side_effect=lambda index, matrix, *args: [[(KnowledgeDocument("Q", "A", "", "faq.md"), 0.1)]] * len(matrix))
+    @patch('services.async_processor.get_embeddings_ollama_async')
+    @patch('services.async_processor.classify_email_async')
+    def test_batch_runs_concurrently_within_stage_limits(self, mock_classify, mock_embed, mock_search,
+                                                          mock_mark_read, mock_send):
+        mock_classify.return_value = Classification(Classification.RELEVANT, 0.9, 'm')
+        mock_embed.side_effect = lambda client, texts, model: np.ones((len(texts), 2), dtype=np.float32)
+        emails = [EmailMessage(str(i), 'client@test.com', 'me', 'Help', f'Question {i}', f't{i}') for i in range(6)]
+
+        async def run():
+            with patch('services.async_processor.generate_response_ollama_async', side_effect=self.fake_generate):
+                return await AsyncEmailProcessor(self.processor, client=MagicMock()).process_batch(emails)
+
+        asyncio.run(run())
+
+        self.assertEqual(self.max_active, 2)
+        self.assertEqual(mock_send.call_count, 6)
+        self.assertEqual(mock_mark_read.call_count, 6)
+        self.assertEqual(self.processor._track_success.call_count, 6)
+        mock_embed.assert_called_once() # All six emails embedded in one request
+        mock_search.assert_called_once() # ... and searched in one FAISS call
+        self.assertEqual(mock_search.call_args.args[1].shape, (6, 2))
+
+
+    @patch('services.email_processor.RELEVANCE_MODE', 'embedding')
+    @patch('services.async_processor.send_email_reply')
+    @patch('services.async_processor.mark_email_as_read')
+    @patch('services.async_processor.retrieve_documents_batch',
+           side_effect=lambda index, matrix, *args: [[(KnowledgeDocument("Q", "A", "", "faq.md"), 0.1)]] * len(matrix))
+    @patch('services.async_processor.get_embeddings_ollama_async')
+    @patch('services.async_processor.classify_email_async')
+    def test_embedding_mode_two_ollama_calls(self, mock_classify, mock_embed, mock_search, mock_mark_read, mock_send):
+        mock_embed.side_effect = lambda client, texts, model: np.ones((len(texts), 2), dtype=np.float32)
+        emails = [EmailMessage(str(i), 'client@test.com', 'me', 'Help', f'Question {i}', f't{i}') for i in range(3)]
+
+        async def run():
+            with patch('services.async_processor.generate_response_ollama_async', side_effect=self.fake_generate):
+                return await AsyncEmailProcessor(self.processor, client=MagicMock()).process_batch(emails)
+
+        with patch('services.relevance_head._embedding_relevance', EmbeddingRelevance()):
+            asyncio.run(run())
+
+        mock_classify.assert_not_called()
+        mock_embed.assert_called_once()
+        mock_search.assert_called_once()
+        self.assertEqual(mock_send.call_count, 3)
+
+    def test_batch_with_failed_email_raises(self):
+        emails = [EmailMessage(str(i), 'client@test.com', 'me', 'Help', f'Question {i}', f't{i}') for i in range(3)]
+        processed = []
+
+        async def process_email(email):
+            if email.id == '1':
+                raise RuntimeError("generation failed")
+            processed.append(email.id)
+
+        async def run():
+            processor = AsyncEmailProcessor(self.processor, client=MagicMock())
+            processor.process_email = process_email
+            await processor.process_batch(emails)
+
+        with self.assertRaisesRegex(RuntimeError, '1 of 3 emails failed: 1'):
+            asyncio.run(run())
+        self.assertEqual(processed, ['0', '2']) # The others are still processed
+
+    @patch('services.async_processor.mark_email_as_read')
+    @patch('services.async_processor.classify_email_async')
+    def test_redis_calls_stay_off_the_event_loop(self, mock_classify, mock_mark_read):
+        mock_classify.return_value = Classification(Classification.IRRELEVANT, 0.9, 'm')
+        claims = MessageClaims(fakeredis.FakeRedis())
+        threads = []
+
+        def record(method):
+            def wrapper(*args):
+                threads.append(threading.get_ident())
+                return method(*args)
+            return wrapper
+
+        claims.begin, claims.complete = record(claims.begin), record(claims.complete)
+        self.processor._get_claims.return_value = claims
+
+        async def run():
+            processor = AsyncEmailProcessor(self.processor, client=MagicMock())
+            await processor.process_batch([EmailMessage('1', 'client@test.com', 'me', 'Hi', 'Hello', 't1')])
+            return threading.get_ident()
+
+        loop_thread = asyncio.run(run())
+
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(loop_thread, threads)
+
+if __name__ == '__main__':
+    unittest.main()
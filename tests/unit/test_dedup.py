@@ -0,0 +1,54 @@
+import unittest
+import fakeredis
+from services.dedup import MessageClaims
+
+
+class TestMessageClaims(unittest.TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.producer_a = MessageClaims(self.redis)
+        self.producer_b = MessageClaims(self.redis)
+
+    def test_only_one_producer_enqueues(self):
+        self.assertTrue(self.producer_a.claim_for_enqueue('m1'))
+        self.assertFalse(self.producer_b.claim_for_enqueue('m1'))
+
+    def test_done_message_is_not_processed_again(self):
+        worker_a, worker_b = MessageClaims(self.redis), MessageClaims(self.redis)
+        self.assertTrue(worker_a.begin('m1'))
+        self.assertFalse(worker_b.begin('m1')) # In flight elsewhere
+        worker_a.complete('m1')
+
+        self.assertFalse(worker_b.begin('m1'))
+        self.assertFalse(self.producer_a.claim_for_enqueue('m1'))
+
+    def test_unclaimed_skips_queued_and_done(self):
+        self.producer_a.claim_for_enqueue('queued')
+        worker = MessageClaims(self.redis)
+        worker.begin('done')
+        worker.complete('done')
+
+        self.assertEqual(self.producer_b.unclaimed(['new', 'queued', 'done', 'other']), ['new', 'other'])
+
+    def test_abort_allows_retry(self):
+        worker = MessageClaims(self.redis)
+        self.assertTrue(worker.begin('m1'))
+        worker.abort('m1')
+        self.assertTrue(worker.begin('m1'))
+
+    def test_aborted_message_can_be_enqueued_again(self):
+        self.assertTrue(self.producer_a.claim_for_enqueue('m1'))
+        worker = MessageClaims(self.redis)
+        self.assertTrue(worker.begin('m1'))
+        worker.abort('m1')
+        self.assertTrue(self.producer_b.claim_for_enqueue('m1'))
+
+    def test_abort_keeps_claim_owned_by_another_worker(self):
+        worker_a, worker_b = MessageClaims(self.redis), MessageClaims(self.redis)
+        self.assertTrue(worker_b.begin('m1'))
+        worker_a.abort('m1')
+        self.assertFalse(worker_a.begin('m1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+import unittest
+import faiss
+import numpy as np
+from services.document_store import DocumentStore, write_document_store
+from services.rag_service import KnowledgeDocument, load_faiss_index, load_indexed_documents, search_knowledge_base
+
+
+class TestDocumentStore(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.documents = {
+            7: KnowledgeDocument('Где мой заказ?', 'В личном кабинете.', 'заказ', 'faq_4.md'),
+            2: KnowledgeDocument('Как вернуть товар?', 'В течение 14 дней.', '', 'faq_3.md'),
+        }
+        self.path = os.path.join(self.root, 'documents.kbdocs')
+        write_document_store(self.path, self.documents)
+
+    def test_round_trip_by_id(self):
+        store = DocumentStore(self.path)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store[7].answer, 'В личном кабинете.')
+        self.assertEqual(store[2].keywords, '')
+        self.assertNotIn(3, store)
+        with self.assertRaises(KeyError):
+            store[3]
+        self.assertEqual(sorted(dict(store.items())), [2, 7])
+
+    def test_mmapped_index_and_store_serve_search(self):
+        index = faiss.IndexIDMap(faiss.IndexFlatL2(2))
+        index.add_with_ids(np.array([[1.0, 0.0], [0.0, 1.0]], dtype=np.float32), np.array([7, 2], dtype=np.int64))
+        index_path = os.path.join(self.root, 'knowledge_base.index')
+        faiss.write_index(index, index_path)
+
+        documents = load_indexed_documents(self.path)
+        match = search_knowledge_base(load_faiss_index(index_path), [0.1, 0.9], documents)
+
+        self.assertIsInstance(documents, DocumentStore)
+        self.assertEqual(match.source_file, 'faq_3.md')
+
+
+if __name__ == '__main__':
+    unittest.main()
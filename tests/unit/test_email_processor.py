@@ -1,7 +1,24 @@
+import os
+import shutil
+import tempfile
 import unittest
 from unittest.mock import MagicMock, patch
-from services.email_processor import EmailProcessor
+import fakeredis
+import numpy as np
+from services import email_processor, metrics
+from services.email_processor import EmailProcessor, KnowledgeBase
 from services.gmail_service import EmailMessage
+from services.dedup import MessageClaims
+from services.index_builder import build_index
+from services.llm_service import Classification
+from services.rag_service import KnowledgeDocument
+from services.pre_classifier import SAMPLES_KEY, PreClassifier
+from services.relevance_head import EmbeddingRelevance
+from services.response_cache import ResponseCache
+
+RELEVANT = Classification(Classification.RELEVANT, 0.9, 'm')
+IRRELEVANT = Classification(Classification.IRRELEVANT, 0.9, 'm')
+
 
 class TestEmailProcessor(unittest.TestCase):
     @patch('services.email_processor.get_gmail_service')
@@ -10,12 +27,23 @@ class TestEmailProcessor(unittest.TestCase):
     def setUp(self, mock_load_docs, mock_load_index, mock_get_service):
         self.processor = EmailProcessor()
         self.mock_gmail = mock_get_service.return_value
+        # Claims and dashboard tracking on fakeredis: a local Redis must not leak state between runs
+        self.redis = self.processor.redis_conn = fakeredis.FakeRedis()
+        self.claims = self.processor.claims = MessageClaims(self.redis)
+        self.response_cache = ResponseCache(fakeredis.FakeRedis())
+        self.pre_classifier = PreClassifier(fakeredis.FakeRedis())
+        for patcher in (patch('services.response_cache._cache', self.response_cache),
+                        patch('services.pre_classifier._pre_classifier', self.pre_classifier),
+                        patch.object(metrics, '_redis', fakeredis.FakeRedis()),
+                        patch.object(metrics, '_buffer', metrics.MetricsBuffer())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
 
     @patch('services.email_processor.classify_email')
     @patch('services.email_processor.mark_email_as_read')
     def test_process_irrelevant_email(self, mock_mark_read, mock_classify):
         # Setup
-        mock_classify.return_value = False
+        mock_classify.return_value = IRRELEVANT
         email = EmailMessage('1', 'sender@test.com', 'me', 'Spam', 'Buy crypto', 't1')
         
         # Execute
@@ -27,15 +55,16 @@ class TestEmailProcessor(unittest.TestCase):
 
     @patch('services.email_processor.classify_email')
     @patch('services.email_processor.get_embedding_ollama')
-    @patch('services.email_processor.search_knowledge_base')
+    @patch('services.email_processor.retrieve_documents')
     @patch('services.email_processor.generate_response_ollama')
     @patch('services.email_processor.send_email_reply')
     @patch('services.email_processor.mark_email_as_read')
     def test_process_relevant_email_success(self, mock_mark_read, mock_send, mock_gen, mock_search, mock_embed, mock_classify):
         # Setup
-        mock_classify.return_value = True
+        mock_classify.return_value = RELEVANT
         mock_embed.return_value = [0.1, 0.2]
-        mock_search.return_value = MagicMock(question="Q", answer="A")
+        mock_search.return_value = [(KnowledgeDocument("Где заказ?", "В кабинете.", "", "faq_4.md"), 0.2),
+                                    (KnowledgeDocument("Сроки доставки?", "3 дня.", "", "faq_2.md"), 0.4)]
         mock_gen.return_value = "Generated Answer"
         
         email = EmailMessage('2', 'client@test.com', 'me', 'Help', 'Where is my order?', 't2')
@@ -46,6 +75,226 @@ class TestEmailProcessor(unittest.TestCase):
         # Verify
         mock_send.assert_called_with(self.processor.gmail_service, '2', 'client@test.com', 'Help', 'Generated Answer', 't2')
         mock_mark_read.assert_called_with(self.processor.gmail_service, '2')
+        context = mock_gen.call_args.args[1] # Both topics go into the single generate call
+        self.assertIn("В кабинете.", context)
+        self.assertIn("3 дня.", context)
+
+    @patch('services.email_processor.classify_email', return_value=RELEVANT)
+    @patch('services.email_processor.get_embedding_ollama')
+    @patch('services.email_processor.generate_response_ollama', return_value="Generated Answer")
+    @patch('services.email_processor.send_email_reply')
+    @patch('services.email_processor.mark_email_as_read')
+    def test_decisive_keyword_match_skips_embedding(self, mock_mark_read, mock_send, mock_gen, mock_embed, mock_classify):
+        documents = {4: KnowledgeDocument("Где мой заказ?", "В личном кабинете.", "статус заказа, где заказ", "faq_4.md"),
+                     6: KnowledgeDocument("Где таблица размеров?", "На странице товара.", "размер", "faq_6.md")}
+        self.processor.knowledge_base = KnowledgeBase(MagicMock(), documents, 'v1')
+        email = EmailMessage('5', 'client@test.com', 'me', 'Заказ', 'где заказ #123', 't5')
+
+        self.processor.process_email(email)
+
+        mock_embed.assert_not_called()
+        self.assertIn("В личном кабинете.", mock_gen.call_args.args[1])
+
+    @patch('services.email_processor.classify_email', return_value=RELEVANT)
+    @patch('services.email_processor.get_embedding_ollama', return_value=[0.6, 0.8])
+    @patch('services.email_processor.retrieve_documents',
+           return_value=[(KnowledgeDocument("Где заказ?", "В кабинете.", "", "faq_4.md"), 0.2)])
+    @patch('services.email_processor.generate_response_ollama', return_value="Заказ 12345 в пути.")
+    @patch('services.email_processor.send_email_reply')
+    @patch('services.email_processor.mark_email_as_read')
+    def test_near_duplicate_question_reuses_reply(self, mock_mark_read, mock_send, mock_gen, mock_search, mock_embed,
+                                                   mock_classify):
+        self.processor.process_email(EmailMessage('6', 'a@test.com', 'me', 'Заказ', 'Где заказ 12345?', 't6'))
+        self.processor.process_email(EmailMessage('7', 'b@test.com', 'me', 'Заказ', 'Где заказ 67890?', 't7'))
+
+        mock_gen.assert_called_once()
+        self.assertEqual(mock_send.call_args.args[4], "Заказ 67890 в пути.")
+
+    @patch('services.email_processor.RELEVANCE_MODE', 'embedding')
+    @patch('services.email_processor.classify_email')
+    @patch('services.email_processor.get_embedding_ollama', return_value=[0.1, 0.2])
+    @patch('services.email_processor.retrieve_documents')
+    @patch('services.email_processor.generate_response_ollama', return_value="Generated Answer")
+    @patch('services.email_processor.send_email_reply')
+    @patch('services.email_processor.mark_email_as_read')
+    def test_embedding_mode_near_match_skips_classify(self, mock_mark_read, mock_send, mock_gen, mock_search,
+                                                      mock_embed, mock_classify):
+        relevance = EmbeddingRelevance(fakeredis.FakeRedis())
+        mock_search.return_value = [(KnowledgeDocument("Где заказ?", "В кабинете.", "", "faq_4.md"), 0.2)]
+
+        with patch('services.relevance_head._embedding_relevance', relevance):
+            self.processor.process_email(EmailMessage('10', 'client@test.com', 'me', 'Help', 'Where is my order?', 't10'))
+
+        mock_classify.assert_not_called()
+        mock_embed.assert_called_once() # Reused for retrieval
+        mock_search.assert_called_once()
+        mock_send.assert_called_once()
+
+    @patch('services.email_processor.RELEVANCE_MODE', 'embedding')
+    @patch('services.email_processor.classify_email', return_value=IRRELEVANT)
+    @patch('services.email_processor.get_embedding_ollama', return_value=[0.1, 0.2])
+    @patch('services.email_processor.retrieve_documents', return_value=[])
+    @patch('services.email_processor.mark_email_as_read')
+    def test_embedding_mode_escalates_far_email(self, mock_mark_read, mock_search, mock_embed, mock_classify):
+        relevance = EmbeddingRelevance(fakeredis.FakeRedis())
+
+        with patch('services.relevance_head._embedding_relevance', relevance):
+            self.processor.process_email(EmailMessage('11', 'client@test.com', 'me', 'Hi', 'Buy crypto', 't11'))
+
+        mock_classify.assert_called_once()
+        self.assertEqual(relevance.redis.llen('relevance:samples'), 1)
+
+    @patch('services.email_processor.classify_email',
+           return_value=Classification(Classification.NEEDS_REVIEW, model='m'))
+    @patch('services.email_processor.send_email_reply')
+    @patch('services.email_processor.mark_email_as_read')
+    def test_unclear_email_left_for_review(self, mock_mark_read, mock_send, mock_classify):
+        with patch.object(self.processor, '_track_status') as mock_status:
+            self.processor.process_email(EmailMessage('12', 'client@test.com', 'me', 'Hm', 'Посмотрите', 't12'))
+
+        mock_status.assert_called_with("NeedsReview")
+        mock_mark_read.assert_not_called() # Stays unread in the inbox
+        mock_send.assert_not_called()
+        self.assertEqual(self.pre_classifier.redis.llen(SAMPLES_KEY), 0)
+
+    @patch('services.email_processor.classify_email', return_value=RELEVANT)
+    @patch('services.email_processor.get_embedding_ollama', return_value=[0.1, 0.2])
+    @patch('services.email_processor.retrieve_documents', return_value=[])
+    @patch('services.email_processor.send_email_reply')
+    @patch('services.email_processor.mark_email_as_read', side_effect=[RuntimeError('Gmail 500'), None])
+    def test_retry_after_send_does_not_reply_twice(self, mock_mark_read, mock_send, mock_search, mock_embed,
+                                                   mock_classify):
+        claims = self.claims
+        email = EmailMessage('14', 'client@test.com', 'me', 'Hi', 'Где мой заказ?', 't14')
+
+        with self.assertRaises(RuntimeError):
+            EmailProcessor.process_email.__wrapped__(self.processor, email)
+        EmailProcessor.process_email.__wrapped__(self.processor, email) # The retry
+
+        mock_send.assert_called_once()
+        self.assertEqual(mock_mark_read.call_count, 2)
+        mock_classify.assert_called_once() # Nothing but mark-read is redone
+        self.assertFalse(claims.begin('14')) # Completed
+
+    @patch('services.email_processor.classify_email', return_value=RELEVANT)
+    @patch('services.email_processor.get_embedding_ollama', return_value=[0.1, 0.2])
+    @patch('services.email_processor.retrieve_documents', return_value=[])
+    @patch('services.email_processor.send_email_reply', return_value=None) # Gmail error, logged and swallowed
+    @patch('services.email_processor.mark_email_as_read')
+    def test_failed_send_is_not_recorded_as_replied(self, mock_mark_read, mock_send, mock_search, mock_embed,
+                                                     mock_classify):
+        email = EmailMessage('15', 'client@test.com', 'me', 'Hi', 'Где мой заказ?', 't15')
+
+        with self.assertRaises(RuntimeError):
+            EmailProcessor.process_email.__wrapped__(self.processor, email)
+
+        mock_mark_read.assert_not_called()
+        self.assertFalse(self.claims.replied('15'))
+        self.assertTrue(self.claims.begin('15')) # The retry sends it again
+
+    @patch('services.email_processor.classify_email',
+           return_value=Classification(Classification.ERROR, model='m'))
+    @patch('services.email_processor.mark_email_as_read')
+    def test_ollama_outage_releases_claim_for_retry(self, mock_mark_read, mock_classify):
+        claims = self.claims
+        email = EmailMessage('13', 'client@test.com', 'me', 'Hi', 'Где мой заказ?', 't13')
+        self.assertTrue(claims.claim_for_enqueue('13'))
+
+        with self.assertRaises(RuntimeError):
+            EmailProcessor.process_email.__wrapped__(self.processor, email) # One attempt, without tenacity waits
+
+        mock_mark_read.assert_not_called()
+        self.assertTrue(claims.claim_for_enqueue('13')) # The next poll can enqueue it again once retries run out
+        self.assertTrue(claims.begin('13')) # Not completed: the retry may claim it again
+
+    @patch('services.email_processor.classify_email')
+    @patch('services.email_processor.mark_email_as_read')
+    def test_bulk_mail_ignored_without_llm(self, mock_mark_read, mock_classify):
+        email = EmailMessage('8', 'Shop <news@shop.com>', 'me', 'Скидки', 'Распродажа!', 't8',
+                             headers={'List-Unsubscribe': '<mailto:unsubscribe@shop.com>'})
+
+        self.processor.process_email(email)
+
+        mock_classify.assert_not_called()
+        mock_mark_read.assert_called_with(self.processor.gmail_service, '8')
+
+    @patch('services.email_processor.classify_email', return_value=IRRELEVANT)
+    @patch('services.email_processor.mark_email_as_read')
+    def test_llm_decision_logged_for_training(self, mock_mark_read, mock_classify):
+        self.processor.process_email(EmailMessage('9', 'client@test.com', 'me', 'Hi', 'Hello there', 't9'))
+
+        mock_classify.assert_called_once()
+        self.assertEqual(self.pre_classifier.redis.llen(SAMPLES_KEY), 1)
+
+    @patch('services.email_processor.classify_email')
+    @patch('services.email_processor.mark_email_as_read')
+    def test_duplicate_email_processed_once(self, mock_mark_read, mock_classify):
+        mock_classify.return_value = IRRELEVANT
+        email = EmailMessage('3', 'sender@test.com', 'me', 'Spam', 'Buy crypto', 't3')
+
+        self.processor.process_email(email)
+        self.processor.process_email(email)
+
+        mock_classify.assert_called_once()
+
+class TestProcessorSingleton(unittest.TestCase):
+    def setUp(self):
+        email_processor._processor = None
+
+    def tearDown(self):
+        email_processor._processor = None
+
+    @patch('services.email_processor.EmailProcessor')
+    def test_processor_built_once_per_process(self, mock_processor_cls):
+        email_processor.warm_up()
+        email_processor.process_email(MagicMock(id='1'))
+        email_processor.process_email(MagicMock(id='2'))
+
+        mock_processor_cls.assert_called_once()
+        self.assertEqual(mock_processor_cls.return_value.process_email.call_count, 2)
+
+class TestKnowledgeBaseReload(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.kb_dir = os.path.join(self.root, 'kb')
+        self.out_dir = os.path.join(self.root, 'embeddings')
+        os.makedirs(self.kb_dir)
+        for patcher in (patch.object(email_processor, 'EMBEDDINGS_DIR', self.out_dir),
+                        patch.object(email_processor, 'FAISS_INDEX_PATH', os.path.join(self.out_dir, 'none.index')),
+                        patch.object(email_processor, 'KB_RELOAD_CHECK_SECONDS', 0),
+                        patch('services.email_processor.get_gmail_service'),
+                        patch('services.llm_service.get_embeddings_ollama',
+                              side_effect=lambda texts, model: np.ones((len(texts), 2), dtype=np.float32))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def publish(self, name, answer):
+        with open(os.path.join(self.kb_dir, name), 'w', encoding='utf-8') as f:
+            f.write(f"# Вопрос\nQ {name}\n# Ответ\n{answer}\n")
+        return build_index(self.kb_dir, 'm', self.out_dir)['version']
+
+    def test_new_version_swapped_in_between_jobs(self):
+        first = self.publish('a.md', 'Old answer')
+        processor = EmailProcessor()
+        old_kb = processor.knowledge_base
+        self.assertEqual(old_kb.version, first)
+
+        second = self.publish('b.md', 'New answer')
+        new_kb = processor.refresh_knowledge_base()
+
+        self.assertEqual(new_kb.version, second)
+        self.assertEqual(new_kb.faiss_index.ntotal, 2)
+        self.assertEqual(len(old_kb.documents), 1) # A job holding the old snapshot is unaffected
+
+    def test_broken_version_keeps_current(self):
+        self.publish('a.md', 'Answer')
+        processor = EmailProcessor()
+        current = processor.knowledge_base
+
+        self.publish('b.md', 'New answer')
+        with patch('services.email_processor.load_faiss_index', return_value=None):
+            self.assertIs(processor.refresh_knowledge_base(), current)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,58 @@
+import unittest
+import unittest.mock
+import fakeredis
+import numpy as np
+from prometheus_client import CollectorRegistry, generate_latest
+from services import metrics
+from services.embedding_cache import EmbeddingCache
+from services.metrics import RedisMetricsCollector
+
+
+class TestEmbeddingCache(unittest.TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+
+    def test_vectors_shared_through_redis_as_raw_float32(self):
+        writer = EmbeddingCache(self.redis)
+        writer.set_many('all-minilm', ['Где мой заказ?'], [[0.5, 0.25]])
+
+        raw = self.redis.get(EmbeddingCache.key('all-minilm', 'Где мой заказ?'))
+        self.assertEqual(raw, np.array([0.5, 0.25], dtype=np.float32).tobytes())
+
+        reader = EmbeddingCache(self.redis)
+        vectors = reader.get_many('all-minilm', ['Где   мой заказ?', 'Возврат'])
+        self.assertEqual(vectors[0].tolist(), [0.5, 0.25])
+        self.assertIsNone(vectors[1])
+        self.assertEqual(reader.stats, {'local_hit': 0, 'redis_hit': 1, 'miss': 1})
+
+        reader.get_many('all-minilm', ['Где мой заказ?'])
+        self.assertEqual(reader.stats['local_hit'], 1)
+
+    def test_key_depends_on_model(self):
+        self.assertNotEqual(EmbeddingCache.key('a', 'text'), EmbeddingCache.key('b', 'text'))
+
+    def test_local_tier_is_lru(self):
+        cache = EmbeddingCache(redis_conn=None, local_size=2)
+        cache.set_many('m', ['a', 'b'], [[1.0], [2.0]])
+        cache.get_many('m', ['a'])
+        cache.set_many('m', ['c'], [[3.0]])
+
+        self.assertEqual([v is not None for v in cache.get_many('m', ['a', 'b', 'c'])], [True, False, True])
+
+    def test_hit_and_miss_counters_exported(self):
+        with unittest.mock.patch.object(metrics, '_redis', self.redis), \
+                unittest.mock.patch.object(metrics, '_buffer', metrics.MetricsBuffer()):
+            cache = EmbeddingCache(self.redis)
+            cache.set_many('m', ['a'], [[1.0]])
+            cache.get_many('m', ['a', 'b'])
+            metrics.flush()
+
+        registry = CollectorRegistry()
+        registry.register(RedisMetricsCollector(self.redis))
+        output = generate_latest(registry).decode()
+        self.assertIn('embedding_cache_requests_total{result="local_hit"} 1.0', output)
+        self.assertIn('embedding_cache_requests_total{result="miss"} 1.0', output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import base64
+import unittest
+from unittest.mock import MagicMock, patch
+from services import gmail_service
+from services.gmail_service import get_new_emails, list_message_ids
+
+
+def make_message(message_id, subject='Help', body='Where is my order?', extra_headers=None):
+    headers = [
+        {'name': 'From', 'value': 'client@test.com'},
+        {'name': 'To', 'value': 'me'},
+        {'name': 'Subject', 'value': subject},
+    ] + (extra_headers or [])
+    return {
+        'id': message_id,
+        'threadId': f't{message_id}',
+        'payload': {
+            'headers': headers,
+            'body': {'data': base64.urlsafe_b64encode(body.encode()).decode()},
+        },
+    }
+
+
+class FakeBatch:
+    def __init__(self, callback, messages, log):
+        self.callback = callback
+        self.messages = messages
+        self.requests = []
+        self.log = log
+
+    def add(self, request, request_id):
+        self.requests.append((request, request_id))
+
+    def execute(self):
+        self.log.append([request_id for _, request_id in self.requests])
+        for request, request_id in self.requests:
+            self.callback(request_id, self.messages[request_id], None)
+
+
+class FakeGmail:
+    """Minimal stand-in for the discovery client: paged list + batch get."""
+
+    def __init__(self, messages, page_size):
+        self.messages = messages
+        self.page_size = page_size
+        self.batches = []
+        self.get_calls = []
+        self._users = MagicMock()
+        self._users.messages.return_value.list.side_effect = self._list
+        self._users.messages.return_value.get.side_effect = self._get
+
+    def users(self):
+        return self._users
+
+    def new_batch_http_request(self, callback):
+        return FakeBatch(callback, self.messages, self.batches)
+
+    def _list(self, userId, q, maxResults, pageToken=None):
+        ids = sorted(self.messages)
+        start = int(pageToken or 0)
+        response = {'messages': [{'id': i} for i in ids[start:start + self.page_size]]}
+        if start + self.page_size < len(ids):
+            response['nextPageToken'] = str(start + self.page_size)
+        return MagicMock(execute=MagicMock(return_value=response))
+
+    def _get(self, **params):
+        self.get_calls.append(params)
+        return params
+
+
+class TestGmailBatchFetch(unittest.TestCase):
+    def setUp(self):
+        messages = {f'{i:03d}': make_message(f'{i:03d}') for i in range(120)}
+        messages['050'] = make_message('050', subject='Sale', extra_headers=[{'name': 'Precedence', 'value': 'bulk'}])
+        self.service = FakeGmail(messages, page_size=40)
+
+    def test_list_follows_next_page_token(self):
+        ids = list_message_ids(self.service)
+        self.assertEqual(len(ids), 120)
+
+    @patch.object(gmail_service, 'GMAIL_BATCH_SIZE', 50)
+    def test_bodies_fetched_in_batches(self):
+        emails = get_new_emails(self.service)
+
+        self.assertEqual(len(emails), 120)
+        self.assertEqual([len(b) for b in self.service.batches], [50, 50, 20])
+        self.assertEqual(emails[0].text, 'Where is my order?')
+        self.assertEqual(emails[0].thread_id, 't000')
+
+    def test_metadata_filter_skips_full_download(self):
+        emails = get_new_emails(self.service, message_filter=lambda headers: 'Precedence' not in headers)
+
+        self.assertEqual(len(emails), 119)
+        full_ids = [c['id'] for c in self.service.get_calls if c['format'] == 'full']
+        self.assertNotIn('050', full_ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+from unittest.mock import MagicMock, patch
+import fakeredis
+from googleapiclient.errors import HttpError
+from services.inbox_sync import InboxSync, HISTORY_ID_KEY, LAST_FULL_SYNC_KEY
+
+
+@patch('services.inbox_sync.get_emails_by_ids', side_effect=lambda service, ids, **kw: [MagicMock(id=i) for i in ids])
+class TestInboxSync(unittest.TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.sync = InboxSync(MagicMock(), self.redis)
+
+    @patch('services.inbox_sync.list_message_ids', return_value=['a', 'b'])
+    @patch('services.inbox_sync.get_current_history_id', return_value='100')
+    def test_first_run_does_full_sync(self, mock_history_id, mock_list, mock_get):
+        emails, history_id = self.sync.fetch_changes()
+
+        self.assertEqual([e.id for e in emails], ['a', 'b'])
+        self.assertEqual(history_id, '100')
+        self.assertIsNone(self.redis.get(HISTORY_ID_KEY)) # Not committed until enqueued
+        self.sync.commit(history_id)
+        self.assertEqual(self.redis.get(HISTORY_ID_KEY), b'100')
+
+    @patch('services.inbox_sync.list_message_ids')
+    @patch('services.inbox_sync.list_history_message_ids', return_value=(['c'], '120'))
+    def test_incremental_sync_uses_checkpoint(self, mock_history, mock_list, mock_get):
+        self.redis.set(HISTORY_ID_KEY, '100')
+        self.redis.set(LAST_FULL_SYNC_KEY, 10**12)
+
+        emails, history_id = self.sync.fetch_changes()
+
+        mock_history.assert_called_once_with(self.sync.service, '100', user_id='me')
+        mock_list.assert_not_called()
+        self.assertEqual([e.id for e in emails], ['c'])
+        self.assertEqual(history_id, '120')
+
+    @patch('services.inbox_sync.list_message_ids', return_value=['a'])
+    @patch('services.inbox_sync.get_current_history_id', return_value='500')
+    @patch('services.inbox_sync.list_history_message_ids',
+           side_effect=HttpError(MagicMock(status=404), b'historyId too old'))
+    def test_expired_history_falls_back_to_full_sync(self, mock_history, mock_history_id, mock_list, mock_get):
+        self.redis.set(HISTORY_ID_KEY, '1')
+        self.redis.set(LAST_FULL_SYNC_KEY, 10**12)
+
+        emails, history_id = self.sync.fetch_changes()
+
+        self.assertEqual([e.id for e in emails], ['a'])
+        self.assertEqual(history_id, '500')
+
+    @patch('services.inbox_sync.list_message_ids', return_value=['a', 'b', 'c'])
+    @patch('services.inbox_sync.get_current_history_id', return_value='100')
+    def test_full_sync_downloads_only_filtered_ids(self, mock_history_id, mock_list, mock_get):
+        emails, _ = self.sync.fetch_changes(id_filter=lambda ids: [i for i in ids if i != 'b'])
+
+        self.assertEqual(mock_get.call_args.args[1], ['a', 'c'])
+        self.assertEqual([e.id for e in emails], ['a', 'c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+import numpy as np
+from services.index_builder import build_index, resolve_index_files
+from services.rag_service import _search_index, load_faiss_index, load_indexed_documents
+
+
+def fake_embeddings(texts, model):
+    # Deterministic 4-d vector per text
+    return np.array([[len(text), sum(map(ord, text)) % 97, 1.0, 0.0] for text in texts], dtype=np.float32)
+
+
+class TestBuildIndex(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.kb_dir = os.path.join(self.root, 'kb')
+        self.out_dir = os.path.join(self.root, 'embeddings')
+        os.makedirs(self.kb_dir)
+        self.addCleanup(shutil.rmtree, self.root)
+        patcher = patch('services.llm_service.get_embeddings_ollama', side_effect=fake_embeddings)
+        self.mock_embed = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write_doc(self, name, question, answer):
+        with open(os.path.join(self.kb_dir, name), 'w', encoding='utf-8') as f:
+            f.write(f"# Вопрос\n{question}\n# Ответ\n{answer}\n# Ключевые слова\nkw\n")
+
+    def embedded_texts(self):
+        return [text for call in self.mock_embed.call_args_list for text in call.args[0]]
+
+    def load(self):
+        index_path, documents_path, manifest = resolve_index_files(self.out_dir, None, None)
+        return load_faiss_index(index_path), load_indexed_documents(documents_path), manifest
+
+    def test_only_changed_files_are_reembedded(self):
+        self.write_doc('a.md', 'Delivery?', 'Three days')
+        self.write_doc('b.md', 'Returns?', '30 days')
+        first = build_index(self.kb_dir, 'm', self.out_dir)
+        self.assertEqual(len(self.embedded_texts()), 2)
+
+        self.mock_embed.reset_mock()
+        self.assertEqual(build_index(self.kb_dir, 'm', self.out_dir)['version'], first['version'])
+        self.mock_embed.assert_not_called()
+
+        self.write_doc('b.md', 'Returns?', '14 days')
+        second = build_index(self.kb_dir, 'm', self.out_dir)
+        self.assertEqual(len(self.embedded_texts()), 1)
+        self.assertIn('14 days', self.embedded_texts()[0])
+        self.assertNotEqual(second['version'], first['version'])
+
+        index, documents, manifest = self.load()
+        b_id = manifest['files']['b.md']['id']
+        self.assertEqual(b_id, first['files']['b.md']['id']) # Stable ID across edits
+        self.assertEqual(index.ntotal, 2)
+        self.assertEqual(documents[b_id].answer, '14 days')
+
+    def test_deleted_file_is_removed(self):
+        self.write_doc('a.md', 'Delivery?', 'Three days')
+        self.write_doc('b.md', 'Returns?', '30 days')
+        first = build_index(self.kb_dir, 'm', self.out_dir)
+
+        os.remove(os.path.join(self.kb_dir, 'a.md'))
+        build_index(self.kb_dir, 'm', self.out_dir)
+
+        index, documents, manifest = self.load()
+        self.assertEqual(index.ntotal, 1)
+        self.assertEqual(list(manifest['files']), ['b.md'])
+        self.assertNotIn(first['files']['a.md']['id'], documents)
+        query = fake_embeddings(["Вопрос: Delivery?\nОтвет: Three days"], 'm')
+        _, ids = index.search(query, 1)
+        self.assertEqual(ids[0][0], manifest['files']['b.md']['id'])
+
+    def test_failed_embedding_keeps_previous_version(self):
+        self.write_doc('a.md', 'Delivery?', 'Three days')
+        first = build_index(self.kb_dir, 'm', self.out_dir)
+
+        self.write_doc('b.md', 'Returns?', '30 days')
+        self.mock_embed.side_effect = None
+        self.mock_embed.return_value = None
+        self.assertIsNone(build_index(self.kb_dir, 'm', self.out_dir))
+        self.assertEqual(self.load()[2]['version'], first['version'])
+
+    def test_hnsw_edit_rebuilds_with_stable_ids(self):
+        self.write_doc('a.md', 'Delivery?', 'Three days')
+        self.write_doc('b.md', 'Returns?', '30 days')
+        first = build_index(self.kb_dir, 'm', self.out_dir, index_type='hnsw')
+
+        self.write_doc('b.md', 'Returns?', '14 days')
+        build_index(self.kb_dir, 'm', self.out_dir, index_type='hnsw')
+
+        index, documents, manifest = self.load()
+        self.assertEqual(index.ntotal, 2)
+        self.assertEqual(manifest['files']['a.md']['id'], first['files']['a.md']['id'])
+        self.assertEqual(documents[manifest['files']['b.md']['id']].answer, '14 days')
+
+    def test_inner_product_index_searched_on_l2_scale(self):
+        self.write_doc('a.md', 'Delivery?', 'Three days')
+        self.write_doc('b.md', 'Returns?', '30 days')
+        build_index(self.kb_dir, 'm', self.out_dir, metric='ip')
+        index, documents, manifest = self.load()
+
+        query = fake_embeddings(["Вопрос: Returns?\nОтвет: 30 days"], 'm')[0] * 3 # Scale must not matter
+        hits = _search_index(index, query.tolist(), 1)
+
+        self.assertEqual(hits[0][0], manifest['files']['b.md']['id'])
+        self.assertAlmostEqual(hits[0][1], 0.0, places=5) # Squared L2 between unit vectors
+
+    def test_config_change_triggers_full_rebuild(self):
+        self.write_doc('a.md', 'Delivery?', 'Three days')
+        first = build_index(self.kb_dir, 'm', self.out_dir)
+        self.mock_embed.reset_mock()
+
+        second = build_index(self.kb_dir, 'm', self.out_dir, metric='ip')
+
+        self.assertEqual(len(self.embedded_texts()), 1)
+        self.assertNotEqual(second['version'], first['version'])
+        self.assertEqual(second['metric'], 'ip')
+
+    def test_without_manifest_legacy_paths_are_used(self):
+        self.assertEqual(resolve_index_files(self.out_dir, 'legacy.index', 'legacy.pkl'),
+                         ('legacy.index', 'legacy.pkl', None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+import fakeredis
+from services.leader_election import LeaderElection
+
+
+class TestLeaderElection(unittest.TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        self.first = LeaderElection(self.redis, 'producer:leader', ttl=15)
+        self.second = LeaderElection(self.redis, 'producer:leader', ttl=15)
+
+    def test_single_leader(self):
+        self.assertTrue(self.first.acquire_or_renew())
+        self.assertFalse(self.second.acquire_or_renew())
+        self.assertTrue(self.first.acquire_or_renew()) # Renewal keeps the lease
+
+    def test_standby_takes_over_when_lease_expires(self):
+        self.first.acquire_or_renew()
+        self.redis.delete('producer:leader') # Lease expired
+
+        self.assertTrue(self.second.acquire_or_renew())
+        self.assertFalse(self.first.acquire_or_renew())
+        self.assertFalse(self.first.is_leader)
+
+    def test_stop_releases_lease(self):
+        self.first.acquire_or_renew()
+        self.first.stop()
+
+        self.assertTrue(self.second.acquire_or_renew())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+from services.lexical_index import LexicalIndex, hybrid_matches, reciprocal_rank_fusion, tokenize
+from services.rag_service import KnowledgeDocument
+
+
+class TestLexicalIndex(unittest.TestCase):
+    def setUp(self):
+        self.documents = {
+            4: KnowledgeDocument('Где мой заказ? Мой заказ отправлен?', 'В личном кабинете.',
+                                 'статус заказа, где заказ, отследить заказ', 'faq_4.md'),
+            2: KnowledgeDocument('Какие сроки доставки? Когда мой заказ прибудет?', 'От 1 до 3 дней.',
+                                 'доставка, сроки, когда придет, заказ', 'faq_2.md'),
+            6: KnowledgeDocument('Где найти таблицу размеров?', 'На странице товара.',
+                                 'размер, таблица размеров', 'faq_6.md'),
+        }
+        self.index = LexicalIndex(self.documents)
+
+    def test_tokenize_stems_and_drops_numbers(self):
+        self.assertEqual(tokenize('Где ЗАКАЗЫ #12345 и заказ?'), ['где', 'заказ', 'заказ'])
+
+    def test_short_email_answered_lexically(self):
+        matches = self.index.decisive_matches('где заказ #123')
+        self.assertEqual([document.source_file for document, _ in matches], ['faq_4.md'])
+
+    def test_long_or_ambiguous_email_not_decisive(self):
+        self.assertEqual(self.index.decisive_matches('заказ'), []) # Two documents score alike
+        long_email = 'Здравствуйте, подскажите пожалуйста когда придет заказ и где найти таблицу размеров'
+        self.assertEqual(self.index.decisive_matches(long_email), [])
+
+    def test_rrf_rewards_agreement(self):
+        vector = [(self.documents[2], 0.3), (self.documents[4], 0.5)]
+        lexical = [(self.documents[4], 5.0), (self.documents[6], 1.0)]
+        fused = reciprocal_rank_fusion(vector, lexical, k=2)
+        self.assertEqual([document.source_file for document, _ in fused], ['faq_4.md', 'faq_2.md'])
+
+    def test_hybrid_adds_lexical_only_match(self):
+        vector = [(self.documents[2], 0.3)]
+        fused = hybrid_matches(self.index, 'когда придет заказ и где таблица размеров', vector, k=3)
+        self.assertIn('faq_6.md', [document.source_file for document, _ in fused])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,287 @@
+import asyncio
+import socket
+import unittest
+from unittest.mock import patch
+import fakeredis
+from prometheus_client import CollectorRegistry, generate_latest
+from services import llm_service
+from services.llm_service import (
+    GENERATION_ERROR_REPLY, AsyncOllamaClient, Classification, GenerationStream, OllamaClient, OllamaRouter,
+    classify_email, classify_email_async, generate_response_ollama, generate_response_ollama_async,
+    get_embedding_ollama, get_embeddings_ollama
+)
+from services import metrics
+from services.embedding_cache import EmbeddingCache
+from services.metrics import RedisMetricsCollector
+from ollama_stub import OllamaStub
+
+
+class TestOllamaClient(unittest.TestCase):
+    def setUp(self):
+        cache_patcher = patch('services.embedding_cache._cache', EmbeddingCache(redis_conn=None))
+        cache_patcher.start()
+        self.addCleanup(cache_patcher.stop)
+
+    def test_calls_share_one_connection(self):
+        responses = {'embed': {'embeddings': [[0.5, 0.25]]}, 'chat': {'message': {'role': 'assistant', 'content': 'ДА'}}}
+        with OllamaStub(responses) as stub:
+            with patch.object(llm_service, '_client', OllamaClient(base_url=f'{stub.url}/api')):
+                self.assertEqual(get_embedding_ollama('text', model='m'), [0.5, 0.25])
+                self.assertTrue(classify_email('Где мой заказ?', model='m').relevant)
+                self.assertEqual(generate_response_ollama('q', 'a', model='m'), 'ДА')
+
+        self.assertEqual([endpoint for endpoint, _ in stub.requests], ['embed', 'chat', 'chat'])
+        self.assertEqual(stub.connections, 1)
+
+    def test_system_prompts_are_a_stable_prefix(self):
+        with OllamaStub({'chat': {'message': {'role': 'assistant', 'content': 'НЕТ'}}}) as stub:
+            with patch.object(llm_service, '_client', OllamaClient(base_url=f'{stub.url}/api')):
+                classify_email('Где мой заказ?', model='m')
+                classify_email('Купите рекламу', model='m')
+                generate_response_ollama('Где мой заказ?', 'В кабинете.', model='m')
+
+        first, second, generate = (payload['messages'] for _, payload in stub.requests)
+        self.assertEqual(first[0], second[0]) # Only the user message differs between emails
+        self.assertNotEqual(first[1], second[1])
+        self.assertEqual(generate[0]['content'], llm_service.GENERATE_SYSTEM_PROMPT)
+        self.assertIn('Где мой заказ?', generate[1]['content'])
+        self.assertTrue(all(payload['keep_alive'] for _, payload in stub.requests))
+
+    def test_retries_unavailable_backend(self):
+        with OllamaStub({'embed': {'embeddings': [[1.0]]}}, status=503) as stub:
+            client = OllamaClient(base_url=f'{stub.url}/api', max_retries=2, backoff_factor=0)
+            with patch.object(llm_service, '_client', client):
+                self.assertIsNone(get_embedding_ollama('text', model='m'))
+
+        self.assertEqual(len(stub.requests), 3)
+
+    @patch.object(llm_service, 'OLLAMA_EMBED_BATCH_SIZE', 2)
+    def test_batched_embeddings(self):
+        def embed(payload):
+            return {'embeddings': [[float(len(text)), 1.0] for text in payload['input']]}
+
+        with OllamaStub({'embed': embed}) as stub:
+            with patch.object(llm_service, '_client', OllamaClient(base_url=f'{stub.url}/api')):
+                embeddings = get_embeddings_ollama(['a', 'bb', 'ccc'], model='m')
+
+        self.assertEqual(embeddings.dtype.name, 'float32')
+        self.assertEqual(embeddings.shape, (3, 2))
+        self.assertEqual(embeddings[:, 0].tolist(), [1.0, 2.0, 3.0])
+        self.assertEqual([len(payload['input']) for _, payload in stub.requests], [2, 1])
+
+    def test_cached_texts_are_not_re_embedded(self):
+        def embed(payload):
+            return {'embeddings': [[float(len(text))] for text in payload['input']]}
+
+        with OllamaStub({'embed': embed}) as stub:
+            with patch.object(llm_service, '_client', OllamaClient(base_url=f'{stub.url}/api')):
+                get_embeddings_ollama(['Где мой заказ?', 'Возврат'], model='m')
+                embeddings = get_embeddings_ollama(['Где  мой\nзаказ?', 'Размеры', 'Размеры'], model='m')
+
+        self.assertEqual(embeddings[:, 0].tolist(), [14.0, 7.0, 7.0])
+        self.assertEqual([payload['input'] for _, payload in stub.requests],
+                         [['Где мой заказ?', 'Возврат'], ['Размеры']])
+
+
+
+class TestClassificationCascade(unittest.TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        for patcher in (patch.object(metrics, '_redis', self.redis), patch.object(metrics, '_buffer', metrics.MetricsBuffer())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_cascade(self, answers, classify=classify_email):
+        def chat(payload):
+            return {'message': {'role': 'assistant', 'content': answers[payload['model']]}}
+
+        with OllamaStub({'chat': chat}) as stub:
+            with patch.object(llm_service, '_client', OllamaClient(base_url=f'{stub.url}/api')):
+                decision = classify('Где мой заказ?', model='small', fallback_model='large')
+        self.assertTrue(all(payload['format'] == llm_service.CLASSIFY_SCHEMA for _, payload in stub.requests))
+        return decision.status, [payload['model'] for _, payload in stub.requests]
+
+    def counter(self, **labels):
+        metrics.flush()
+        field = metrics._field('classification_requests', labels)
+        return float(self.redis.hget(metrics.COUNTERS_KEY, field) or 0)
+
+    def test_small_model_answer_is_final(self):
+        self.assertEqual(self.run_cascade({'small': '{"relevant": false, "confidence": 0.97}', 'large': 'ДА'}),
+                         (Classification.IRRELEVANT, ['small']))
+        self.assertEqual(self.counter(tier='primary', model='small', result='decided'), 1)
+
+    def test_ambiguous_answer_escalates(self):
+        self.assertEqual(self.run_cascade({'small': 'Скорее да, это вопрос о заказе', 'large': 'ДА'}),
+                         (Classification.RELEVANT, ['small', 'large']))
+        self.assertEqual(self.counter(tier='primary', model='small', result='ambiguous'), 1)
+        self.assertEqual(self.counter(tier='fallback', model='large', result='decided'), 1)
+
+    def test_low_confidence_escalates(self):
+        answers = {'small': '{"relevant": true, "confidence": 0.55}', 'large': '{"relevant": true, "confidence": 0.9}'}
+        self.assertEqual(self.run_cascade(answers), (Classification.RELEVANT, ['small', 'large']))
+        self.assertEqual(self.counter(tier='primary', model='small', result='low_confidence'), 1)
+
+    def test_undecided_email_needs_review(self):
+        answers = {'small': '?', 'large': '{"relevant": false, "confidence": 0.5}'}
+        self.assertEqual(self.run_cascade(answers), (Classification.NEEDS_REVIEW, ['small', 'large']))
+
+    def test_unavailable_ollama_is_an_error_not_review(self):
+        with OllamaStub({'chat': {'error': 'model is loading'}}, status=503) as stub:
+            client = OllamaClient(base_url=f'{stub.url}/api', max_retries=0)
+            with patch.object(llm_service, '_client', client):
+                decision = classify_email('Где мой заказ?', model='small', fallback_model='large')
+
+        self.assertEqual(decision.status, Classification.ERROR)
+        self.assertEqual(self.counter(tier='fallback', model='large', result='error'), 1)
+
+    def test_async_cascade(self):
+        async def classify(url):
+            client = AsyncOllamaClient(base_url=f'{url}/api')
+            try:
+                return await classify_email_async(client, 'Где мой заказ?', model='small', fallback_model='large')
+            finally:
+                await client.aclose()
+
+        answers = {'small': 'Не уверен', 'large': '{"relevant": true, "confidence": 0.8}'}
+        with OllamaStub({'chat': lambda payload: {'message': {'content': answers[payload['model']]}}}) as stub:
+            decision = asyncio.run(classify(stub.url))
+
+        self.assertEqual((decision.status, decision.confidence, decision.model), (Classification.RELEVANT, 0.8, 'large'))
+
+
+def tokens(*pieces, done_reason='stop'):
+    return [{'message': {'role': 'assistant', 'content': piece}, 'done': False} for piece in pieces] + \
+           [{'message': {'role': 'assistant', 'content': ''}, 'done': True, 'done_reason': done_reason, 'eval_count': len(pieces), 'eval_duration': 10 ** 9}]
+
+
+@patch.object(llm_service, 'OLLAMA_GENERATE_STREAM', True)
+class TestStreamingGeneration(unittest.TestCase):
+    def test_reply_assembled_from_stream(self):
+        with OllamaStub({'chat': tokens('Здравствуйте', ', заказ', ' в пути.')}) as stub:
+            with patch.object(llm_service, '_client', OllamaClient(base_url=f'{stub.url}/api')):
+                self.assertEqual(generate_response_ollama('q', 'a', model='m'), 'Здравствуйте, заказ в пути.')
+
+        payload = stub.requests[0][1]
+        self.assertTrue(payload['stream'])
+        self.assertEqual(payload['options']['num_predict'], llm_service.GENERATE_MAX_TOKENS)
+
+    def test_async_reply_stops_at_marker(self):
+        async def run(url):
+            client = AsyncOllamaClient(base_url=f'{url}/api')
+            try:
+                return await generate_response_ollama_async(client, 'q', 'a', model='m')
+            finally:
+                await client.aclose()
+
+        with OllamaStub({'chat': tokens('Добрый день.', '\n---', '\nВопрос клиента')}) as stub:
+            self.assertEqual(asyncio.run(run(stub.url)), 'Добрый день.')
+
+    def test_token_budget_cuts_at_sentence_end(self):
+        generation = GenerationStream('m', max_tokens=3)
+        for chunk in tokens('Заказ в пути.', ' Срок', ' доставки'):
+            if not generation.feed(chunk):
+                break
+        self.assertEqual(generation.stop_reason, 'token_budget')
+        self.assertEqual(generation.result(), 'Заказ в пути.')
+
+    def test_time_budget_cuts_at_sentence_end(self):
+        generation = GenerationStream('m', max_seconds=0)
+        self.assertFalse(generation.feed({'message': {'content': 'Заказ в пути. Срок'}, 'done': False}))
+        self.assertEqual(generation.stop_reason, 'time_budget')
+        self.assertEqual(generation.result(), 'Заказ в пути.')
+
+    def test_time_budget_without_sentence_returns_error_reply(self):
+        generation = GenerationStream('m', max_seconds=0)
+        self.assertFalse(generation.feed({'message': {'content': 'Здравствуйте'}, 'done': False}))
+        self.assertEqual(generation.stop_reason, 'time_budget')
+        self.assertEqual(generation.result(), GENERATION_ERROR_REPLY)
+
+    def test_broken_stream_returns_error_reply(self):
+        with OllamaStub({'chat': tokens('Здравствуйте')[:1]}) as stub:
+            with patch.object(llm_service, '_client', OllamaClient(base_url=f'{stub.url}/api')):
+                self.assertEqual(generate_response_ollama('q', 'a', model='m'), GENERATION_ERROR_REPLY)
+
+
+def dead_url():
+    with socket.socket() as sock: # A port nothing listens on
+        sock.bind(('127.0.0.1', 0))
+        return f'http://127.0.0.1:{sock.getsockname()[1]}/api'
+
+
+class TestOllamaRouter(unittest.TestCase):
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis()
+        for patcher in (patch.object(metrics, '_redis', self.redis), patch.object(metrics, '_buffer', metrics.MetricsBuffer())):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_least_outstanding(self):
+        router = OllamaRouter(['http://a/api', 'http://b/api', 'http://c/api'])
+        busy = [router.acquire('m') for _ in range(3)]
+        self.assertEqual(len(set(busy)), 3)
+        router.release(busy[1], 'chat', 0.1, ok=True)
+        self.assertIs(router.acquire('m'), busy[1]) # The only idle backend
+
+    def test_model_hash_is_sticky_and_fails_over(self):
+        router = OllamaRouter([f'http://host{i}/api' for i in range(4)], routing='model_hash', failure_threshold=1)
+        backend = router.acquire('gemma:7b')
+        router.release(backend, 'chat', 0.1, ok=True)
+        self.assertTrue(all(router.acquire('gemma:7b') is backend for _ in range(5)))
+
+        router.release(backend, 'chat', 0.1, ok=False) # Breaker opens
+        self.assertIsNot(router.acquire('gemma:7b'), backend)
+
+    def test_dead_backend_skipped_and_breaker_opened(self):
+        with OllamaStub({'embed': {'embeddings': [[1.0]]}}) as stub:
+            router = OllamaRouter([dead_url(), f'{stub.url}/api'], failure_threshold=1, reset_seconds=60)
+            client = OllamaClient(router=router, max_retries=0)
+            for _ in range(4):
+                self.assertEqual(client.post('embed', {'model': 'm', 'input': ['x']}, operation='embed'),
+                                 {'embeddings': [[1.0]]})
+
+        dead = router.backends[0]
+        self.assertEqual(dead.failures, 1) # Tried once, then left alone while the breaker is open
+        self.assertEqual(len(stub.requests), 4)
+
+    def test_async_client_fails_over(self):
+        async def run(router):
+            client = AsyncOllamaClient(router=router, backoff_factor=0)
+            try:
+                return await client.post('embed', {'model': 'm', 'input': ['x']}, operation='embed')
+            finally:
+                await client.aclose()
+
+        with OllamaStub({'embed': {'embeddings': [[1.0]]}}) as stub:
+            router = OllamaRouter([dead_url(), f'{stub.url}/api'], routing='model_hash')
+            results = [asyncio.run(run(router)) for _ in range(3)]
+
+        self.assertEqual(results, [{'embeddings': [[1.0]]}] * 3)
+        self.assertTrue(all(backend.outstanding == 0 for backend in router.backends))
+
+    def test_health_check_opens_and_closes_breaker(self):
+        with OllamaStub() as stub:
+            router = OllamaRouter([dead_url(), f'{stub.url}/api'], failure_threshold=3)
+            router.check_health(timeout=1)
+            self.assertEqual([backend.failures >= 3 for backend in router.backends], [True, False])
+
+            router.backends[0].url = f'{stub.url}/api' # The node came back
+            router.check_health(timeout=1)
+            self.assertEqual(router.backends[0].failures, 0)
+
+    def test_latency_histogram_per_backend(self):
+        router = OllamaRouter(['http://a/api'])
+        router.release(router.acquire('m'), 'chat', 0.3, ok=True)
+        router.release(router.acquire('m'), 'chat', 7.0, ok=True)
+        self.assertFalse(self.redis.exists(metrics.HISTOGRAMS_KEY)) # Nothing written in the request path
+        metrics.flush()
+
+        registry = CollectorRegistry()
+        registry.register(RedisMetricsCollector(self.redis))
+        output = generate_latest(registry).decode()
+        self.assertIn('ollama_request_seconds_bucket{backend="http://a/api",endpoint="chat",le="0.5"} 1.0', output)
+        self.assertIn('ollama_request_seconds_bucket{backend="http://a/api",endpoint="chat",le="+Inf"} 2.0', output)
+        self.assertIn('ollama_request_seconds_count{backend="http://a/api",endpoint="chat"} 2.0', output)
+
+if __name__ == '__main__':
+    unittest.main()
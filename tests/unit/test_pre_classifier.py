@@ -0,0 +1,49 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import fakeredis
+from services.gmail_service import EmailMessage
+from services.pre_classifier import SAMPLES_KEY, LinearModel, PreClassifier, train_linear_model
+
+
+def email(sender='client@test.com', subject='Вопрос', text='Где мой заказ?', headers=None):
+    return EmailMessage('1', sender, 'me', subject, text, 't1', headers=headers)
+
+
+class TestPreClassifier(unittest.TestCase):
+    def test_header_rules(self):
+        classifier = PreClassifier()
+        self.assertFalse(classifier.classify(email(headers={'Precedence': 'bulk'})).relevant)
+        self.assertFalse(classifier.classify(email(headers={'Auto-Submitted': 'auto-generated'})).relevant)
+        self.assertFalse(classifier.classify(email(sender='Service <no-reply@bank.com>')).relevant)
+        self.assertTrue(classifier.classify(email()).escalate)
+
+    def test_sender_lists(self):
+        classifier = PreClassifier(allow='vip@client.com', deny='@spam.com')
+        self.assertTrue(classifier.classify(email(sender='VIP <vip@client.com>', headers={'Precedence': 'bulk'})).relevant)
+        self.assertEqual(classifier.classify(email(sender='a@spam.com')).reason, 'denylist')
+
+    def test_linear_model_decides_confident_cases_only(self):
+        logger = PreClassifier(fakeredis.FakeRedis())
+        for i in range(30):
+            logger.log_decision(email(subject='Заказ', text=f'Где мой заказ {i}? Когда доставка?'), True)
+            logger.log_decision(email(subject='Предложение', text=f'Купите рекламу и криптовалюту {i}'), False)
+        logged = logger.redis.lrange(SAMPLES_KEY, 0, -1)
+        samples = [json.loads(raw) for raw in logged]
+        self.assertTrue(all(set(sample) == {'features', 'relevant'} for sample in samples)) # No email text
+        model = train_linear_model(samples)
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, 'model.json')
+        model.save(path)
+        classifier = PreClassifier(model=LinearModel.load(path))
+
+        self.assertTrue(classifier.classify(email(text='Где заказ? Доставка задерживается')).relevant)
+        self.assertFalse(classifier.classify(email(subject='Предложение', text='Реклама и криптовалюта')).relevant)
+        self.assertTrue(classifier.classify(email(subject='Привет', text='Совсем другая тема')).escalate)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+import unittest
+from unittest.mock import patch
+import faiss
+import fakeredis
+import numpy as np
+from services.rag_service import (
+    KnowledgeDocument, estimate_tokens, pack_context, retrieve_documents, retrieve_documents_batch, search_knowledge_base
+)
+from services.retrieval_cache import RetrievalCache
+
+
+class TestSearchKnowledgeBase(unittest.TestCase):
+    def setUp(self):
+        self.documents = [
+            KnowledgeDocument('Где мой заказ?', 'В личном кабинете.', 'заказ', 'faq_4.md'),
+            KnowledgeDocument('Как вернуть товар?', 'В течение 14 дней.', 'возврат', 'faq_3.md'),
+        ]
+        self.index = faiss.IndexFlatL2(2)
+        self.index.add(np.array([[1.0, 0.0], [0.0, 1.0]], dtype=np.float32))
+        self.cache = RetrievalCache(fakeredis.FakeRedis())
+        patcher = patch('services.rag_service.get_retrieval_cache', return_value=self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_finds_nearest_document(self):
+        match = search_knowledge_base(self.index, [0.1, 0.9], self.documents)
+        self.assertEqual(match.source_file, 'faq_3.md')
+
+    def test_cache_keyed_on_index_version_and_query(self):
+        search_knowledge_base(self.index, [0.1, 0.9], self.documents, index_version='v1')
+        hits = self.cache.get('v1', [0.1, 0.9], 1)
+        self.assertEqual([doc_id for doc_id, _ in hits], [1]) # Document IDs, not pickled documents
+        # Float noise below the quantization step maps to the same key
+        self.assertIsNotNone(self.cache.get('v1', [0.1000001, 0.9], 1))
+        # A new index version never sees old results
+        self.assertIsNone(self.cache.get('v2', [0.1, 0.9], 1))
+
+    def test_cached_ids_resolve_against_current_documents(self):
+        self.cache.set('v1', [0.1, 0.9], 1, [(0, 0.5)])
+        with patch.object(self.index, 'search') as mock_search:
+            match = search_knowledge_base(self.index, [0.1, 0.9], self.documents, index_version='v1')
+
+        mock_search.assert_not_called()
+        self.assertEqual(match.source_file, 'faq_4.md')
+
+    def test_batch_search_matches_single_searches_in_one_call(self):
+        self.cache.set('v1', [0.1, 0.9], 1, [(0, 0.5)]) # Row 0 is served from the cache
+        queries = np.array([[0.1, 0.9], [0.9, 0.1], [0.2, 0.8]], dtype=np.float32)
+        with patch.object(self.index, 'search', wraps=self.index.search) as mock_search:
+            batch = retrieve_documents_batch(self.index, queries, self.documents, k=1, index_version='v1')
+
+        mock_search.assert_called_once()
+        self.assertEqual(mock_search.call_args.args[0].shape, (2, 2))
+        self.assertEqual([matches[0][0].source_file for matches in batch], ['faq_4.md', 'faq_4.md', 'faq_3.md'])
+        self.assertIsNotNone(self.cache.get('v1', [0.2, 0.8], 1)) # Misses were cached
+
+
+class TestRetrieveAndPack(unittest.TestCase):
+    def setUp(self):
+        self.documents = [
+            KnowledgeDocument('Где мой заказ?', 'В личном кабинете.', 'заказ', 'faq_4.md'),
+            KnowledgeDocument('Сроки доставки?', 'От 3 до 5 дней.', 'доставка', 'faq_2.md'),
+            KnowledgeDocument('Сколько идет доставка?', 'От 3 до 5  дней.', 'доставка', 'faq_7.md'),
+            KnowledgeDocument('Таблица размеров', 'См. сайт.', 'размер', 'faq_6.md'),
+        ]
+        self.index = faiss.IndexFlatL2(2)
+        self.index.add(np.array([[1.0, 0.0], [0.0, 1.0], [0.0, 1.1], [9.0, 9.0]], dtype=np.float32))
+
+    def test_top_k_with_cutoff_and_dedup(self):
+        matches = retrieve_documents(self.index, [0.5, 0.5], self.documents, k=4, max_distance=5.0)
+        # faq_7 repeats faq_2's answer, faq_6 is beyond the cut-off
+        self.assertEqual([document.source_file for document, _ in matches], ['faq_4.md', 'faq_2.md'])
+
+    def test_default_cutoff_drops_far_unit_vectors(self):
+        # /api/embed vectors are normalized: squared L2 distance is 2 - 2*cos, at most 4
+        index = faiss.IndexFlatL2(2)
+        angles = np.radians([10.0, 100.0, 180.0])
+        index.add(np.stack([np.cos(angles), np.sin(angles)], axis=1).astype(np.float32))
+        with patch('services.rag_service.get_retrieval_cache'):
+            matches = retrieve_documents(index, [1.0, 0.0], self.documents[:3], k=3)
+        # Only the document at 10 degrees is kept; 100 (distance ~2.35) and 180 (distance 4.0) are dropped
+        self.assertEqual([document.source_file for document, _ in matches], ['faq_4.md'])
+
+    def test_context_respects_token_budget(self):
+        matches = [(document, 0.0) for document in self.documents[:2]]
+        both = pack_context(matches, token_budget=1000)
+        self.assertIn('В личном кабинете.', both)
+        self.assertIn('От 3 до 5 дней.', both)
+
+        first_only = pack_context(matches, token_budget=estimate_tokens(both) - 5)
+        self.assertIn('В личном кабинете.', first_only)
+        self.assertNotIn('От 3 до 5 дней.', first_only)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+import fakeredis
+import numpy as np
+from services.rag_service import KnowledgeDocument
+from services.relevance_head import SAMPLES_KEY, EmbeddingRelevance, RelevanceHead, _encode, train_relevance_head
+
+DOC = KnowledgeDocument("Где заказ?", "В кабинете.", "", "faq_4.md")
+
+
+class TestEmbeddingRelevance(unittest.TestCase):
+    def test_without_head_only_near_match_decides(self):
+        relevance = EmbeddingRelevance(near_distance=0.5)
+        self.assertTrue(relevance.decide([1.0, 0.0], [(DOC, 0.2)]).relevant)
+        self.assertTrue(relevance.decide([1.0, 0.0], [(DOC, 0.8)]).escalate)
+        self.assertTrue(relevance.decide([1.0, 0.0], []).escalate)
+
+    def test_trained_head_decides_confident_cases(self):
+        rng = np.random.default_rng(0)
+        relevant_center, spam_center = np.eye(8)[0], np.eye(8)[1]
+        samples = ([{'vector': _encode(relevant_center + 0.1 * rng.standard_normal(8)), 'distance': 0.3, 'relevant': True}
+                    for _ in range(50)] +
+                   [{'vector': _encode(spam_center + 0.1 * rng.standard_normal(8)), 'distance': 4.0, 'relevant': False}
+                    for _ in range(50)])
+        head = train_relevance_head(samples, 'all-minilm')
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, 'head.json')
+        head.save(path)
+        relevance = EmbeddingRelevance(head=RelevanceHead.load(path), model='all-minilm')
+
+        self.assertTrue(relevance.decide(relevant_center, [(DOC, 0.3)]).relevant)
+        self.assertFalse(relevance.decide(spam_center, []).relevant)
+        self.assertTrue(relevance.decide((relevant_center + spam_center) / 2, [(DOC, 2.0)]).escalate)
+
+    def test_head_for_other_model_ignored(self):
+        head = RelevanceHead(np.zeros(3), 10.0, 'all-minilm')
+        relevance = EmbeddingRelevance(head=head, model='nomic-embed-text', near_distance=0.5)
+        self.assertTrue(relevance.decide([1.0, 0.0], []).escalate)
+
+    def test_llm_decisions_logged_with_embedding(self):
+        relevance = EmbeddingRelevance(fakeredis.FakeRedis())
+        relevance.log_decision([0.5, 0.5], [(DOC, 0.7)], False)
+        self.assertEqual(relevance.redis.llen(SAMPLES_KEY), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
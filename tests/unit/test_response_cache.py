@@ -0,0 +1,56 @@
+import unittest
+import fakeredis
+from services.response_cache import ResponseCache, find_order_number
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResponseCache(fakeredis.FakeRedis(), min_similarity=0.95)
+        self.context = "Вопрос: Где мой заказ?\nОтвет: В личном кабинете."
+
+    def test_similar_embedding_hits_dissimilar_misses(self):
+        self.cache.set(self.context, 'm', 'Где мой заказ?', 'Проверьте личный кабинет.', embedding=[1.0, 0.0])
+
+        self.assertEqual(self.cache.get(self.context, 'm', 'А где заказ?', [0.99, 0.05]), 'Проверьте личный кабинет.')
+        self.assertIsNone(self.cache.get(self.context, 'm', 'Что с заказом?', [0.6, 0.8]))
+
+    def test_changed_faq_invalidates(self):
+        self.cache.set(self.context, 'm', 'Где мой заказ?', 'Проверьте личный кабинет.', embedding=[1.0, 0.0])
+        edited = self.context.replace('личном кабинете', 'приложении')
+        self.assertIsNone(self.cache.get(edited, 'm', 'Где мой заказ?', [1.0, 0.0]))
+
+    def test_order_number_is_templated(self):
+        self.cache.set(self.context, 'm', 'Где заказ №12345?', 'Заказ 12345 отправлен.')
+
+        self.assertEqual(self.cache.get(self.context, 'm', 'где  заказ №777?'), 'Заказ 777 отправлен.')
+        self.assertIsNone(self.cache.get(self.context, 'm', 'Где заказ?')) # No number to fill in
+
+    def test_greeting_with_name_is_replaced(self):
+        self.cache.set(self.context, 'm', 'Где мой заказ?', 'Здравствуйте, Иван! Проверьте личный кабинет.',
+                       sender='Иван Петров <ivan@example.com>')
+        self.assertEqual(self.cache.get(self.context, 'm', 'Где мой заказ?'), 'Здравствуйте! Проверьте личный кабинет.')
+
+    def test_transliterated_sender_name_not_cached(self):
+        text = 'Где мой заказ 99999?'
+        self.cache.set(self.context, 'm', text, 'Олег, заказ 99999 в пути.', sender='Oleg Ivanov <oleg.i@example.com>')
+        self.assertIsNone(self.cache.get(self.context, 'm', text))
+
+        self.cache.set(self.context, 'm', text, 'Здравствуйте, Олег! Заказ 99999 в пути.',
+                       sender='Oleg Ivanov <oleg.i@example.com>')
+        self.assertEqual(self.cache.get(self.context, 'm', 'Где мой заказ 55555?'), 'Здравствуйте! Заказ 55555 в пути.')
+
+    def test_name_and_address_from_body_not_cached(self):
+        text = 'Меня зовут Мария, где мой заказ? Адрес: ул. Шевченко 5, кв 12'
+        self.cache.set(self.context, 'm', text, 'Мария, доставим заказ на ул. Шевченко 5, кв 12.')
+        self.assertIsNone(self.cache.get(self.context, 'm', text))
+
+        self.cache.set(self.context, 'm', 'Где мой заказ? Звоните 050 123 45 67', 'Перезвоним на 050 123 45 67.')
+        self.assertIsNone(self.cache.get(self.context, 'm', 'Где мой заказ? Звоните 050 123 45 67'))
+
+    def test_find_order_number(self):
+        self.assertEqual(find_order_number('где заказ #123'), '123')
+        self.assertIsNone(find_order_number('размер 42'))
+
+
+if __name__ == '__main__':
+    unittest.main()